@@ -5,20 +5,411 @@
 SCons Tool to Build Android Applications
 """
 
+import atexit
+import cPickle
+import filecmp
+import glob
+import hashlib
+import json
 import os
+import re
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from subprocess import Popen, PIPE
+from SCons.Action import Action, CommandAction
 from SCons.Builder import Builder
-from SCons.Defaults import DirScanner, Copy
+from SCons.Defaults import DirScanner, Copy, SharedObjectEmitter
 from SCons.Errors import UserError
-from xml.dom import minidom
+from SCons.Tool import SourceFileScanner
+from xml import sax
+import SCons.Node.FS
+import SCons.Scanner
+import SCons.Scanner.Dir
 import SCons.Tool.javac
+import SCons.Util
 from SCons.Tool.JavaCommon import parse_java_file
 
 NSURI = 'http://schemas.android.com/apk/res/android'
 
+class AndroidManifest(object):
+    """
+    The parts of an AndroidManifest.xml file that the tool cares about.
+    Values are the raw attribute strings, or None if the element is missing.
+    """
+    def __init__(self):
+        self.package = None
+        self.has_code = None
+        self.activities = []
+        self.min_sdk = None
+        self.target_sdk = None
+
+class _ManifestHandler(sax.handler.ContentHandler):
+    """ Fills in an AndroidManifest in a single streaming pass """
+    def __init__(self, manifest):
+        sax.handler.ContentHandler.__init__(self)
+        self.manifest = manifest
+
+    def startElementNS(self, name, qname, attrs):
+        tag = name[1]
+        manifest = self.manifest
+        if tag == 'manifest' and manifest.package is None:
+            manifest.package = attrs.get((None, 'package'), '')
+        elif tag == 'application' and manifest.has_code is None:
+            manifest.has_code = attrs.get((NSURI, 'hasCode'), '')
+        elif tag == 'activity':
+            manifest.activities.append(attrs.get((NSURI, 'name'), ''))
+        elif tag == 'uses-sdk' and manifest.min_sdk is None:
+            manifest.min_sdk = attrs.get((NSURI, 'minSdkVersion'), '')
+            manifest.target_sdk = attrs.get((NSURI, 'targetSdkVersion'), '')
+
+def parse_android_manifest(fname):
+    """ Parse fname into an AndroidManifest """
+    manifest = AndroidManifest()
+    parser = sax.make_parser()
+    parser.setFeature(sax.handler.feature_namespaces, True)
+    parser.setContentHandler(_ManifestHandler(manifest))
+    parser.parse(fname)
+    return manifest
+
+def _file_stamp(fname):
+    """ Cheap signature used to check if a file changed since it was read """
+    stat = os.stat(fname)
+    return (stat.st_mtime, stat.st_size)
+
+def _file_digest(fname):
+    """ Content signature of a file """
+    md5 = hashlib.md5()
+    md5.update(open(fname, 'rb').read())
+    return md5.hexdigest()
+
+# abspath -> (stamp, digest)
+_DIGEST_CACHE = {}
+
+def _cached_file_digest(fname):
+    """ Content signature of a file, only recalculated if the file changes """
+    fname = os.path.abspath(fname)
+    stamp = _file_stamp(fname)
+    cached = _DIGEST_CACHE.get(fname)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    digest = _file_digest(fname)
+    _DIGEST_CACHE[fname] = (stamp, digest)
+    return digest
+
+class MetadataCache(object):
+    """
+    On-disk store of values parsed from manifest, properties and source
+    files. Each entry is validated against the file's stamp and content
+    signature, so an unchanged file is never parsed again, even in a new
+    scons run.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.dirty = False
+        self.entries = {}
+        try:
+            cache_file = open(path, 'rb')
+            try:
+                self.entries = cPickle.load(cache_file)
+            finally:
+                cache_file.close()
+        except IOError:
+            pass
+        except Exception:
+            # corrupt or incompatible cache, start again
+            self.entries = {}
+
+    def lookup(self, kind, fname, parse):
+        """
+        Return the cached value of kind for fname, calling parse(fname) to
+        create it if the file has changed.
+        """
+        key = (kind, fname)
+        stamp = _file_stamp(fname)
+        entry = self.entries.get(key)
+        if entry and entry[0] == stamp:
+            return entry[2]
+        digest = _file_digest(fname)
+        if entry and entry[1] == digest:
+            value = entry[2]
+        else:
+            value = parse(fname)
+        self.entries[key] = (stamp, digest, value)
+        self.dirty = True
+        return value
+
+    def save(self):
+        """ Write the cache back to disk if anything changed """
+        if not self.dirty:
+            return
+        tmpname = self.path + '.tmp'
+        try:
+            cache_file = open(tmpname, 'wb')
+            try:
+                cPickle.dump(self.entries, cache_file, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                cache_file.close()
+            os.rename(tmpname, self.path)
+            self.dirty = False
+        except (IOError, OSError):
+            pass
+
+_METADATA_CACHE = None
+
+def use_metadata_cache(env):
+    """
+    Enable the on-disk metadata cache if ANDROID_METADATA_CACHE names a file.
+    The cache is shared by all Environments and written when scons exits.
+    """
+    global _METADATA_CACHE
+    path = env.get('ANDROID_METADATA_CACHE')
+    if not path or _METADATA_CACHE is not None:
+        return
+    _METADATA_CACHE = MetadataCache(env.File(path).abspath)
+    atexit.register(_METADATA_CACHE.save)
+
+# the builders traced with ANDROID_TRACE and the stage each one is shown as
+_TRACE_STAGES = {
+    'Aapt': 'aapt',
+    'JavaClassFile': 'javac',
+    'JavaClassDir': 'javac',
+    'Proguard': 'proguard',
+    'Dex': 'dx',
+    'PreDex': 'dx',
+    'DexClasses': 'dx',
+    'ApkBuilder': 'apkbuilder',
+    'AssembleApk': 'apkbuilder',
+    'JarSigner': 'jarsigner',
+    'ZipAlign': 'zipalign',
+    'PyZipAlign': 'zipalign',
+    'SharedObject': 'compile',
+    'StaticObject': 'compile',
+    'NdkObject': 'compile',
+    'NdkPch': 'compile',
+    'SharedLibrary': 'link',
+    'StaticLibrary': 'link',
+    'NdkStrip': 'strip',
+}
+
+def _files_size(nodes):
+    """ Total size of the nodes that are files on disk """
+    total = 0
+    for node in nodes:
+        if os.path.isfile(node.abspath):
+            total += os.path.getsize(node.abspath)
+    return total
+
+class BuildTrace(object):
+    """
+    Records when each traced action ran and writes them as a Chrome
+    trace-event file, viewable in chrome://tracing. A summary of the time
+    spent in each stage, overall and on the critical path, is printed when
+    the trace is saved.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.start = time.time()
+        self.events = []
+        self.slots = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage, target, source, start, end):
+        """ Record an action for stage that ran from start to end """
+        self.lock.acquire()
+        try:
+            # each thread running actions is one scons job slot
+            slot = self.slots.setdefault(threading.currentThread(),
+                                         len(self.slots))
+            self.events.append({
+                'stage': stage,
+                'targets': list(target),
+                'start': start - self.start,
+                'duration': end - start,
+                'slot': slot,
+                'label': getattr(target[0].attributes, 'trace_label', ''),
+                'input_bytes': _files_size(source),
+                'output_bytes': _files_size(target)})
+        finally:
+            self.lock.release()
+
+    def critical_path(self):
+        """
+        The events on the longest chain of traced actions that each needed
+        the output of the one before
+        """
+        producers = {}
+        for event in self.events:
+            for node in event['targets']:
+                producers[node] = event
+        chains = {}
+        for event in sorted(self.events,
+                            key=lambda e: e['start'] + e['duration']):
+            length, previous = 0, None
+            for node in event['targets']:
+                for child in node.children(scan=0):
+                    producer = producers.get(child)
+                    if (producer is not None and producer is not event and
+                        id(producer) in chains and
+                        chains[id(producer)][0] > length):
+                        length, previous = chains[id(producer)][0], producer
+            chains[id(event)] = (length + event['duration'], previous)
+        if not chains:
+            return []
+        event = max(self.events, key=lambda e: chains[id(e)][0])
+        path = []
+        while event is not None:
+            path.append(event)
+            event = chains[id(event)][1]
+        path.reverse()
+        return path
+
+    def save(self):
+        """ Write the trace file and print the summary """
+        if not self.events:
+            return
+        trace_events = []
+        for event in self.events:
+            trace_events.append({
+                'name': event['stage'],
+                'cat': event['label'] or event['stage'],
+                'ph': 'X',
+                'ts': int(event['start'] * 1e6),
+                'dur': int(event['duration'] * 1e6),
+                'pid': 1,
+                'tid': event['slot'],
+                'args': {'target': str(event['targets'][0]),
+                         'label': event['label'],
+                         'input_bytes': event['input_bytes'],
+                         'output_bytes': event['output_bytes']}})
+        trace_file = open(self.path, 'w')
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'},
+                  trace_file, indent=1)
+        trace_file.close()
+
+        totals = {}
+        for event in self.events:
+            total = totals.setdefault(event['stage'], [0, 0.0, 0.0])
+            total[0] += 1
+            total[1] += event['duration']
+        for event in self.critical_path():
+            totals[event['stage']][2] += event['duration']
+        print '%-12s %7s %10s %10s' % ('stage', 'actions', 'total', 'critical')
+        for stage, (count, total, critical) in sorted(
+                totals.items(), key=lambda item: -item[1][2]):
+            print '%-12s %7d %9.2fs %9.2fs' % (stage, count, total, critical)
+        print 'trace written to %s' % self.path
+
+class TracedAction(object):
+    """
+    Wraps a builder's action so that each time it runs is recorded in the
+    build trace. Everything else is passed on to the wrapped action.
+    """
+    def __init__(self, action, stage):
+        self.action = action
+        self.stage = stage
+
+    def __getattr__(self, name):
+        return getattr(self.action, name)
+
+    def __str__(self):
+        return str(self.action)
+
+    def __call__(self, target, source, env, *args, **kw):
+        start = time.time()
+        try:
+            return self.action(target, source, env, *args, **kw)
+        finally:
+            # scons passes the nodes through the executor
+            executor = kw.get('executor')
+            if executor:
+                target = executor.get_all_targets()
+                source = executor.get_all_sources()
+            _TRACE.record(self.stage, target, source, start, time.time())
+
+_TRACE = None
+
+def use_trace(env):
+    """
+    Trace the actions of env's Android and NDK builders if ANDROID_TRACE
+    names a file. The trace is written when scons exits. Only nodes created
+    after this call are traced.
+    """
+    global _TRACE
+    path = env.get('ANDROID_TRACE')
+    if not path:
+        return
+    if _TRACE is None:
+        _TRACE = BuildTrace(env.File(path).abspath)
+        atexit.register(_TRACE.save)
+    for name, stage in _TRACE_STAGES.items():
+        if name not in env['BUILDERS']:
+            continue
+        builder = env['BUILDERS'][name]
+        # builders with an action per suffix wrap the real builder
+        builder = getattr(builder, 'builder', builder)
+        # waiting for a jobserver token is not part of the traced time
+        if isinstance(builder.action, JobserverAction):
+            builder = builder.action
+        if not isinstance(builder.action, TracedAction):
+            builder.action = TracedAction(builder.action, stage)
+
+def label_trace(label, nodes):
+    """
+    Label nodes, and the built nodes they depend on that are not labelled
+    yet, as belonging to label in the build trace
+    """
+    pending = list(nodes)
+    while pending:
+        node = pending.pop()
+        if (not node.has_builder() or
+            getattr(node.attributes, 'trace_label', None)):
+            continue
+        node.attributes.trace_label = label
+        pending.extend(node.sources + node.depends)
+
+def _manifest_values(fname):
+    """ Parse fname and return the manifest values as a plain dict """
+    return parse_android_manifest(fname).__dict__
+
+# abspath -> (stamp, AndroidManifest), shared by all Environments
+_MANIFEST_CACHE = {}
+
+def get_android_manifest(fname):
+    """
+    Return the AndroidManifest for fname. The file is only parsed again if
+    it has changed since the last call.
+    """
+    fname = os.path.abspath(fname)
+    stamp = _file_stamp(fname)
+    cached = _MANIFEST_CACHE.get(fname)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    if _METADATA_CACHE is not None:
+        manifest = AndroidManifest()
+        manifest.__dict__.update(
+            _METADATA_CACHE.lookup('manifest', fname, _manifest_values))
+    else:
+        manifest = parse_android_manifest(fname)
+    _MANIFEST_CACHE[fname] = (stamp, manifest)
+    return manifest
+
+def _require(value, element, fname):
+    """ Raise a UserError if the manifest element was not found """
+    if value is None:
+        raise UserError("No <%s> element in %s" % (element, fname))
+    return value
+
 def get_android_has_code(fname):
-    parsed = minidom.parse(open(fname))
-    application = parsed.getElementsByTagName('application')[0]
-    hasCode = application.getAttributeNS(NSURI, 'hasCode')
+    manifest = get_android_manifest(fname)
+    hasCode = _require(manifest.has_code, 'application', fname)
     if not hasCode:
         return True # Default value
 
@@ -33,15 +424,14 @@ def get_android_has_code(fname):
 
 def get_android_package(fname):
     """ Get the value of the package from <manifest package='foo'> """
-    parsed = minidom.parse(open(fname))
-    manifest = parsed.getElementsByTagName('manifest')[0]
-    return manifest.getAttribute('package')
+    manifest = get_android_manifest(fname)
+    return _require(manifest.package, 'manifest', fname)
 
 def get_rfile(package):
     """ Retuns the path to the R.java resource file """
     return os.path.join(package.replace('.', '/'), 'R.java')
 
-def target_from_properties(fname):
+def _read_properties_target(fname):
     """ Get a target value from a properties file """
     for line in open(fname).readlines():
         line = line.strip()
@@ -52,11 +442,19 @@ def target_from_properties(fname):
             return val.split('-')[1]
     return None
 
+def target_from_properties(fname):
+    """ Get a target value from a properties file """
+    if _METADATA_CACHE is not None:
+        return _METADATA_CACHE.lookup('properties', os.path.abspath(fname),
+                                      _read_properties_target)
+    return _read_properties_target(fname)
+
 def get_android_name(fname):
     """ Get the android activity name from <activity android:name='foo'> """
-    parsed = minidom.parse(open(fname))
-    activity = parsed.getElementsByTagName('activity')[0]
-    return activity.getAttributeNS(NSURI, 'name')
+    manifest = get_android_manifest(fname)
+    if not manifest.activities:
+        raise UserError("No <activity> element in %s" % fname)
+    return manifest.activities[0]
 
 def get_android_target(fname):
     """
@@ -65,14 +463,908 @@ def get_android_target(fname):
     Checks the manifest and also default.properties (if it exists)
     """
     properties = os.path.join(os.path.dirname(fname), 'default.properties')
-    parsed = minidom.parse(open(fname))
-    uses_sdk = parsed.getElementsByTagName('uses-sdk')[0]
-    min_sdk = uses_sdk.getAttributeNS(NSURI, 'minSdkVersion')
-    target_sdk = uses_sdk.getAttributeNS(NSURI, 'targetSdkVersion')
+    manifest = get_android_manifest(fname)
+    min_sdk = _require(manifest.min_sdk, 'uses-sdk', fname)
+    target_sdk = manifest.target_sdk
     if os.path.exists(properties):
         target_sdk = target_from_properties(properties)
     return (min_sdk, target_sdk or min_sdk)
 
+def scan_resource_dir(node, env, path=()):
+    """
+    List the files below a resource directory, including those scons builds
+    before their directory exists. A resource generated into a variant
+    directory is then found in the same place from the first build on, so
+    the second build does not run aapt again because the order of the
+    dependencies changed. Directories are walked rather than returned, as
+    aapt only depends on the files.
+    """
+    result = []
+    pending = [node]
+    while pending:
+        directory = pending.pop(0)
+        SCons.Scanner.Dir.scan_on_disk(directory, env, path)
+        for entry in SCons.Scanner.Dir.scan_in_memory(directory, env, path):
+            entry = entry.disambiguate()
+            if isinstance(entry, SCons.Node.FS.Dir):
+                pending.append(entry)
+            elif entry.has_builder() or entry.rexists():
+                result.append(entry)
+    return result
+
+ResourceScanner = SCons.Scanner.Base(scan_resource_dir, 'ResourceScanner',
+                                     node_factory=SCons.Node.FS.Entry)
+
+def make_staging_dir(target, source, env):
+    """
+    Create an empty $GEN_STAGING for aapt to write R.java to, so files it
+    wrote on earlier runs are not taken for generated ones
+    """
+    if env.get('GEN_STAGING'):
+        staging = env.Dir('$GEN_STAGING').abspath
+        if os.path.isdir(staging):
+            shutil.rmtree(staging)
+        os.makedirs(staging)
+    return 0
+
+def sync_generated(target, source, env):
+    """
+    Copy the files aapt wrote to $GEN_STAGING into $GEN. Files whose contents
+    have not changed are left alone, so regenerating an identical R.java does
+    not make the Java classes out of date. Files aapt no longer writes, such
+    as the R.java of a renamed package, are removed from $GEN.
+    """
+    if not env.get('GEN_STAGING'):
+        return 0
+    staging = env.Dir('$GEN_STAGING').abspath
+    gen = env.Dir('$GEN').abspath
+    generated = set()
+    for dirpath, dirnames, filenames in os.walk(staging):
+        for filename in filenames:
+            src = os.path.join(dirpath, filename)
+            generated.add(os.path.relpath(src, staging))
+            dest = os.path.join(gen, os.path.relpath(src, staging))
+            if os.path.exists(dest) and filecmp.cmp(src, dest, shallow=False):
+                continue
+            if not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            shutil.copyfile(src, dest)
+    for dirpath, dirnames, filenames in os.walk(gen, topdown=False):
+        for filename in filenames:
+            fname = os.path.join(dirpath, filename)
+            if os.path.relpath(fname, gen) not in generated:
+                os.remove(fname)
+        if dirpath != gen and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+    return 0
+
+_TOOL_SOURCES = [os.path.join(os.path.dirname(__file__), 'sdklib', name)
+                 for name in ('ApkBuilderMain.java', 'ToolServer.java')]
+
+def tool_classes_dir(env):
+    """
+    The shared directory for the compiled sdklib helper classes. Its name is
+    a signature of the SDK jars they compile against and of their sources, so
+    every Environment and build tree using the same SDK and tool version
+    shares one copy.
+    """
+    md5 = hashlib.md5()
+    for fname in env.subst('$APK_BUILDER_CP').split(os.pathsep) + _TOOL_SOURCES:
+        if os.path.exists(fname):
+            md5.update(_cached_file_digest(fname))
+    cache = env.Dir(env.subst('$ANDROID_TOOL_CACHE'))
+    return os.path.join(cache.abspath, 'toolclasses-' + md5.hexdigest())
+
+_TOOL_CLASSES_LOCK = threading.Lock()
+
+def build_tool_classes(env):
+    """
+    Compile the sdklib helper classes into $ANDROID_TOOL_CLASSES unless a
+    previous build, from any tree, has done so already.
+    """
+    classes = env.subst('$ANDROID_TOOL_CLASSES')
+    _TOOL_CLASSES_LOCK.acquire()
+    try:
+        if os.path.isdir(classes):
+            return
+        parent = os.path.dirname(classes)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        tmpdir = tempfile.mkdtemp(dir=parent)
+        cmd = [env.subst('$JAVAC'), '-classpath', env.subst('$APK_BUILDER_CP'),
+               '-d', tmpdir] + _TOOL_SOURCES
+        if subprocess.call(cmd, env=_tool_environ(env)) != 0:
+            shutil.rmtree(tmpdir)
+            raise UserError('Unable to compile %s' % ' '.join(_TOOL_SOURCES))
+        try:
+            os.rename(tmpdir, classes)
+        except OSError:
+            # another build got there first
+            shutil.rmtree(tmpdir)
+    finally:
+        _TOOL_CLASSES_LOCK.release()
+
+class ToolServer(object):
+    """
+    Client for sdklib/ToolServer.java, a JVM that stays up for the whole scons
+    run and runs the main class of Java tools on request. The server only
+    runs requests that carry the random token it was given on stdin, so other
+    local users cannot use its port to run code as this one.
+    """
+    def __init__(self, java, classpath, flags):
+        cmd = [java] + flags + ['-classpath', classpath,
+                                'android.sdklib.ToolServer']
+        self.token = os.urandom(16).encode('hex')
+        self.process = Popen(cmd, stdin=PIPE, stdout=PIPE)
+        atexit.register(self.stop)
+        self.process.stdin.write(self.token + '\n')
+        self.process.stdin.flush()
+        self.port = int(self.process.stdout.readline())
+        # tool threads outside any request print to the server's stdout,
+        # keep reading it so that a full pipe never blocks the server
+        drain = threading.Thread(target=self.drain)
+        drain.setDaemon(True)
+        drain.start()
+
+    def drain(self):
+        """ Pass on what the server prints outside of requests """
+        for line in iter(self.process.stdout.readline, ''):
+            sys.stdout.write(line)
+
+    def run(self, classpath, main, args):
+        """
+        Run main with args in the server. Returns the exit status and output,
+        or None if the request could not be handled.
+        """
+        if [arg for arg in args if '\n' in arg]:
+            return None
+        lines = [self.token, os.getcwd(), classpath, main,
+                 str(len(args))] + args
+        try:
+            sock = socket.create_connection(('127.0.0.1', self.port))
+            try:
+                sock.sendall('\n'.join(lines) + '\n')
+                reply = []
+                while True:
+                    data = sock.recv(65536)
+                    if not data:
+                        break
+                    reply.append(data)
+            finally:
+                sock.close()
+        except socket.error:
+            return None
+        status, sep, output = ''.join(reply).partition('\n')
+        if not sep or status == '-1':
+            return None
+        return int(status), output
+
+    def stop(self):
+        """ Closing stdin tells the server to exit """
+        if self.process.poll() is None:
+            try:
+                self.process.stdin.close()
+            except IOError:
+                pass
+            self.process.wait()
+
+_TOOL_SERVER = None
+_TOOL_SERVER_LOCK = threading.Lock()
+
+def get_tool_server(env):
+    """
+    Return the ToolServer for this scons run, starting it on first use.
+    Returns None if the server could not be started.
+    """
+    global _TOOL_SERVER
+    _TOOL_SERVER_LOCK.acquire()
+    try:
+        if _TOOL_SERVER is None:
+            try:
+                build_tool_classes(env)
+                _TOOL_SERVER = ToolServer(env.subst('$JAVA'),
+                                  env.subst('$ANDROID_TOOL_CLASSES'),
+                                  env.subst('$ANDROID_TOOL_SERVER_FLAGS').split())
+            except (OSError, IOError, ValueError, UserError):
+                _TOOL_SERVER = False
+        return _TOOL_SERVER or None
+    finally:
+        _TOOL_SERVER_LOCK.release()
+
+class JavaToolAction(CommandAction):
+    """
+    A command line that runs a Java tool. If ANDROID_TOOL_SERVER is set, the
+    tool's main class runs in the shared ToolServer instead and the command
+    line is only used as a fallback. Signatures and output always come from
+    the command line. If uses_tool_classes is set, the sdklib helper classes
+    are compiled first.
+    """
+    def __init__(self, cmd, main, classpath, args, uses_tool_classes=False,
+                 **kw):
+        CommandAction.__init__(self, cmd, **kw)
+        self.main = main
+        self.classpath = classpath
+        self.args = args
+        self.uses_tool_classes = uses_tool_classes
+
+    def execute(self, target, source, env, *args, **kw):
+        if self.uses_tool_classes:
+            build_tool_classes(env)
+        if env.get('ANDROID_TOOL_SERVER'):
+            server = get_tool_server(env)
+            if server:
+                result = server.run(
+                    env.subst(self.classpath, target=target, source=source),
+                    self.main, self.tool_args(target, source, env))
+                if result is not None:
+                    status, output = result
+                    sys.stdout.write(output)
+                    return status
+        return CommandAction.execute(self, target, source, env, *args, **kw)
+
+    def tool_args(self, target, source, env):
+        """ The arguments with any wildcards expanded, as a shell would """
+        result = []
+        for arg in env.subst_list(self.args, 0, target, source)[0]:
+            arg = str(arg)
+            matches = sorted(glob.glob(arg)) if '*' in arg else []
+            result.extend(matches or [arg])
+        return result
+
+# compile cache directories to prune when scons exits, with their size limit
+_COMPILE_CACHES = {}
+_PRUNE_REGISTERED = False
+
+def prune_compile_caches():
+    """
+    Remove the least recently used objects from each compile cache until it
+    fits in its size limit
+    """
+    for cache_dir, max_size in _COMPILE_CACHES.items():
+        entries = []
+        total = 0
+        for root, dirs, files in os.walk(cache_dir):
+            for name in files:
+                fname = os.path.join(root, name)
+                stat = os.stat(fname)
+                entries.append((stat.st_mtime, stat.st_size, fname))
+                total += stat.st_size
+        entries.sort()
+        while entries and total > max_size:
+            mtime, size, fname = entries.pop(0)
+            os.remove(fname)
+            total -= size
+
+def _tool_environ(env):
+    """ The ENV of env as plain strings, for running tools directly """
+    result = {}
+    for key, value in env['ENV'].items():
+        if SCons.Util.is_List(value):
+            value = os.pathsep.join(map(str, value))
+        result[key] = str(value)
+    return result
+
+class CachedCompileAction(CommandAction):
+    """
+    A compile command line that goes through the cache in
+    $NDK_COMPILE_CACHE. The key is the preprocessed source, the command line
+    without file names and the compiler, so a fresh build tree still reuses
+    objects compiled before. The preprocess command line gives the source
+    as the compiler sees it.
+    """
+    def __init__(self, cmd, preprocess, **kw):
+        CommandAction.__init__(self, cmd, **kw)
+        self.command = cmd
+        self.preprocess = preprocess
+
+    def cache_key(self, target, source, env):
+        """ The cache key for the object, or None if it can not be cached """
+        process = Popen(env.subst(self.preprocess, target=target,
+                                  source=source),
+                        shell=True, stdout=PIPE, stderr=PIPE,
+                        env=_tool_environ(env))
+        output = process.communicate()[0]
+        if process.returncode != 0:
+            return None
+        md5 = hashlib.md5(output)
+        # $CPPPATH needs real nodes, so take the file names out afterwards
+        command = env.subst(self.command, target=target, source=source)
+        for name, placeholder in (('$TARGET', 'OBJECT'),
+                                  ('$SOURCES', 'SOURCE')):
+            command = command.replace(env.subst(name, target=target,
+                                                source=source), placeholder)
+        md5.update(command)
+        compiler = command.split()[0]
+        if os.path.exists(compiler):
+            md5.update(repr(_file_stamp(compiler)))
+        return md5.hexdigest()
+
+    def execute(self, target, source, env, *args, **kw):
+        global _PRUNE_REGISTERED
+        cache_dir = env.subst('$NDK_COMPILE_CACHE')
+        key = cache_dir and self.cache_key(target, source, env)
+        if not key:
+            return CommandAction.execute(self, target, source, env,
+                                         *args, **kw)
+        cache_dir = env.Dir(cache_dir).abspath
+        _COMPILE_CACHES[cache_dir] = int(env['NDK_COMPILE_CACHE_SIZE']) << 20
+        if not _PRUNE_REGISTERED:
+            atexit.register(prune_compile_caches)
+            _PRUNE_REGISTERED = True
+        entry = os.path.join(cache_dir, key[:2], key + '.o')
+        if os.path.exists(entry):
+            shutil.copyfile(entry, target[0].abspath)
+            # the modification time orders the entries for eviction
+            os.utime(entry, None)
+            return 0
+        status = CommandAction.execute(self, target, source, env, *args, **kw)
+        if status == 0:
+            if not os.path.isdir(os.path.dirname(entry)):
+                os.makedirs(os.path.dirname(entry))
+            # written under a temporary name, as other builds share the cache
+            tmp_entry = '%s.%d.tmp' % (entry, os.getpid())
+            shutil.copyfile(target[0].abspath, tmp_entry)
+            os.rename(tmp_entry, entry)
+        return status
+
+_LOCAL_HEADER = '<4s2B4HL2L2H'
+_CENTRAL_HEADER = '<4s4B4HL2L5H2L'
+_END_RECORD = '<4s4H2LH'
+
+class AlignedZipWriter(object):
+    """
+    Writes a zip file whose uncompressed entries start on an aligned offset,
+    as zipalign does. Entries from other zip files are copied without being
+    decompressed.
+    """
+    def __init__(self, fname, alignment=4):
+        self.fp = open(fname, 'wb')
+        self.alignment = alignment
+        self.entries = []
+
+    def _write_entry(self, info, data_writer):
+        """
+        Write a local header and the data written by data_writer, which
+        returns (crc, compressed size, size). The header is patched afterwards.
+        """
+        offset = self.fp.tell()
+        name = info.filename
+        padding = 0
+        if info.compress_type == zipfile.ZIP_STORED:
+            data_start = offset + struct.calcsize(_LOCAL_HEADER) + len(name)
+            padding = -data_start % self.alignment
+        header_values = [0x14, 0, info.flag_bits & ~0x08, info.compress_type,
+                         info.time, info.date]
+        self.fp.write(struct.pack(_LOCAL_HEADER, 'PK\003\004',
+                                  *(header_values + [0, 0, 0,
+                                                     len(name), padding])))
+        self.fp.write(name)
+        self.fp.write('\0' * padding)
+        crc, compress_size, file_size = data_writer()
+        end = self.fp.tell()
+        self.fp.seek(offset)
+        self.fp.write(struct.pack(_LOCAL_HEADER, 'PK\003\004',
+                                  *(header_values + [crc, compress_size,
+                                                     file_size, len(name),
+                                                     padding])))
+        self.fp.seek(end)
+        self.entries.append((info, offset, crc, compress_size, file_size))
+
+    def copy_entry(self, source, info):
+        """ Copy info from the open zip file source without recompressing """
+        source.fp.seek(info.header_offset)
+        header = struct.unpack(_LOCAL_HEADER,
+                               source.fp.read(struct.calcsize(_LOCAL_HEADER)))
+        source.fp.seek(header[10] + header[11], 1)
+        def copy_data():
+            remaining = info.compress_size
+            while remaining:
+                data = source.fp.read(min(remaining, 1 << 16))
+                if not data:
+                    raise UserError('%s is truncated' % source.filename)
+                self.fp.write(data)
+                remaining -= len(data)
+            return info.CRC, info.compress_size, info.file_size
+        self._write_entry(_ZipEntry(info.filename, info.date_time,
+                                    info.compress_type, info.flag_bits,
+                                    info.external_attr), copy_data)
+
+    def write_file(self, arcname, fname, compress=True):
+        """ Add the file fname as arcname, streaming it in chunks """
+        if compress:
+            compress_type = zipfile.ZIP_DEFLATED
+        else:
+            compress_type = zipfile.ZIP_STORED
+        info = _ZipEntry(arcname, time.localtime(os.stat(fname).st_mtime)[0:6],
+                         compress_type, external_attr=0644 << 16)
+        def write_data():
+            crc = 0
+            compress_size = file_size = 0
+            if compress:
+                compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                              zlib.DEFLATED, -15)
+            src = open(fname, 'rb')
+            try:
+                while True:
+                    data = src.read(1 << 16)
+                    if not data:
+                        break
+                    file_size += len(data)
+                    crc = zlib.crc32(data, crc)
+                    if compress:
+                        data = compressor.compress(data)
+                    compress_size += len(data)
+                    self.fp.write(data)
+            finally:
+                src.close()
+            if compress:
+                data = compressor.flush()
+                compress_size += len(data)
+                self.fp.write(data)
+            return crc & 0xffffffff, compress_size, file_size
+        self._write_entry(info, write_data)
+
+    def close(self):
+        """ Write the central directory """
+        start = self.fp.tell()
+        for info, offset, crc, compress_size, file_size in self.entries:
+            self.fp.write(struct.pack(_CENTRAL_HEADER, 'PK\001\002',
+                                      0x14, 3, 0x14, 0, info.flag_bits & ~0x08,
+                                      info.compress_type, info.time, info.date,
+                                      crc, compress_size, file_size,
+                                      len(info.filename), 0, 0, 0, 0,
+                                      info.external_attr, offset))
+            self.fp.write(info.filename)
+        size = self.fp.tell() - start
+        self.fp.write(struct.pack(_END_RECORD, 'PK\005\006', 0, 0,
+                                  len(self.entries), len(self.entries),
+                                  size, start, 0))
+        self.fp.close()
+
+class _ZipEntry(object):
+    """
+    The fields of a zip entry header that AlignedZipWriter needs. zipfile
+    reads UTF-8 names as unicode, they are written back as UTF-8 bytes with
+    the language encoding flag set.
+    """
+    def __init__(self, filename, date_time, compress_type, flag_bits=0,
+                 external_attr=0):
+        if isinstance(filename, unicode):
+            filename = filename.encode('utf-8')
+            flag_bits |= 0x800
+        self.filename = filename
+        self.compress_type = compress_type
+        self.flag_bits = flag_bits
+        self.external_attr = external_attr
+        year, month, day, hour, minute, second = date_time
+        self.date = ((max(year, 1980) - 1980) << 9) | (month << 5) | day
+        self.time = (hour << 11) | (minute << 5) | (second // 2)
+
+def zipalign(target, source, env):
+    """ In-process zipalign -f 4 $SOURCE $TARGET """
+    src = zipfile.ZipFile(source[0].abspath)
+    try:
+        out = AlignedZipWriter(target[0].abspath)
+        for info in src.infolist():
+            out.copy_entry(src, info)
+        out.close()
+    finally:
+        src.close()
+    return 0
+
+def _file_crc(fname):
+    """ The zip CRC and size of a file """
+    crc = 0
+    size = 0
+    src = open(fname, 'rb')
+    try:
+        while True:
+            data = src.read(1 << 16)
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+    finally:
+        src.close()
+    return crc & 0xffffffff, size
+
+def assemble_apk(target, source, env):
+    """
+    Write an unsigned, aligned APK in one pass from the aapt package in
+    source[0], the optional classes.dex in source[1] and the native
+    libraries in $NATIVE_FOLDER. Entries from the aapt package are copied
+    without being recompressed. With ANDROID_INCREMENTAL_APK set, files that
+    are unchanged since the previous APK are copied from it rather than
+    compressed again.
+    """
+    apk = target[0].abspath
+    previous = None
+    if env.get('ANDROID_INCREMENTAL_APK') and zipfile.is_zipfile(apk):
+        previous = zipfile.ZipFile(apk)
+    try:
+        out = AlignedZipWriter(apk + '.tmp')
+
+        def add_file(arcname, fname):
+            if previous is not None:
+                try:
+                    info = previous.getinfo(arcname)
+                except KeyError:
+                    info = None
+                if info and (info.CRC, info.file_size) == _file_crc(fname):
+                    out.copy_entry(previous, info)
+                    return
+            out.write_file(arcname, fname)
+
+        package = zipfile.ZipFile(source[0].abspath)
+        try:
+            for info in package.infolist():
+                out.copy_entry(package, info)
+        finally:
+            package.close()
+        if len(source) > 1:
+            add_file('classes.dex', source[1].abspath)
+        if env.get('NATIVE_FOLDER'):
+            native = env.Dir(env['NATIVE_FOLDER']).abspath
+            for abi in sorted(os.listdir(native)):
+                abi_dir = os.path.join(native, abi)
+                if not os.path.isdir(abi_dir):
+                    continue
+                for lib in sorted(os.listdir(abi_dir)):
+                    if lib.endswith('.so'):
+                        add_file('lib/%s/%s' % (abi, lib),
+                                 os.path.join(abi_dir, lib))
+        out.close()
+    finally:
+        if previous is not None:
+            previous.close()
+    os.rename(apk + '.tmp', apk)
+    return 0
+
+class AdbError(Exception):
+    """ An error reported by the adb server or a device """
+
+class AdbClient(object):
+    """
+    Talks to the adb server over its socket protocol, so that installing to
+    and starting apps on several devices shares the one running adb server
+    instead of spawning an adb process for every step.
+    """
+    def __init__(self, port, host='127.0.0.1'):
+        self.host = host
+        self.port = port
+        self.splice_support = {}
+
+    def _recv(self, sock, size):
+        """ Read exactly size bytes """
+        data = []
+        while size:
+            chunk = sock.recv(size)
+            if not chunk:
+                raise AdbError('adb server closed the connection')
+            data.append(chunk)
+            size -= len(chunk)
+        return ''.join(data)
+
+    def _request(self, sock, payload):
+        """ Send a request and check the adb server accepted it """
+        sock.sendall('%04x%s' % (len(payload), payload))
+        status = self._recv(sock, 4)
+        if status != 'OKAY':
+            length = int(self._recv(sock, 4), 16)
+            raise AdbError(self._recv(sock, length))
+
+    def _connect(self, serial=None):
+        """ Open a connection, switched to the device serial if given """
+        sock = socket.create_connection((self.host, self.port))
+        if serial:
+            try:
+                self._request(sock, 'host:transport:' + serial)
+            except:
+                sock.close()
+                raise
+        return sock
+
+    def _read_all(self, sock):
+        data = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return ''.join(data)
+            data.append(chunk)
+
+    def devices(self):
+        """ Serials of the attached devices that are ready for use """
+        sock = self._connect()
+        try:
+            self._request(sock, 'host:devices')
+            length = int(self._recv(sock, 4), 16)
+            listing = self._recv(sock, length)
+        finally:
+            sock.close()
+        serials = []
+        for line in listing.splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[1] == 'device':
+                serials.append(fields[0])
+        return serials
+
+    def shell(self, serial, command):
+        """ Run a shell command on the device and return its output """
+        sock = self._connect(serial)
+        try:
+            self._request(sock, 'shell:' + command)
+            return self._read_all(sock)
+        finally:
+            sock.close()
+
+    def push(self, serial, local, remote, mode=0644):
+        """ Copy the file local to the path remote on the device """
+        sock = self._connect(serial)
+        try:
+            self._request(sock, 'sync:')
+            spec = '%s,%d' % (remote, 0100000 | mode)
+            sock.sendall('SEND' + struct.pack('<L', len(spec)) + spec)
+            src = open(local, 'rb')
+            try:
+                while True:
+                    data = src.read(65536)
+                    if not data:
+                        break
+                    sock.sendall('DATA' + struct.pack('<L', len(data)) + data)
+            finally:
+                src.close()
+            mtime = int(os.stat(local).st_mtime)
+            sock.sendall('DONE' + struct.pack('<L', mtime))
+            status = self._recv(sock, 4)
+            length = struct.unpack('<L', self._recv(sock, 4))[0]
+            if status != 'OKAY':
+                raise AdbError(self._recv(sock, length))
+            sock.sendall('QUIT' + struct.pack('<L', 0))
+        finally:
+            sock.close()
+
+    def can_splice(self, serial):
+        """ Check the device shell has the tail -c and head -c that
+        install_delta uses to put an APK together """
+        if serial not in self.splice_support:
+            probe = self.shell(serial, 'echo hello | tail -c +2 | head -c 3')
+            self.splice_support[serial] = (probe == 'ell')
+        return self.splice_support[serial]
+
+    def install_delta(self, serial, apk, previous, base):
+        """
+        Install apk by only sending the bytes that differ from previous, which
+        must be the APK installed on the device at base. The new APK is put
+        together on the device from the two. Returns False if the device can
+        not do that or the install failed, in which case a full install is
+        needed.
+        """
+        if not self.can_splice(serial):
+            return False
+        ops, patch = apk_delta(previous, apk)
+        remote = '/data/local/tmp/' + os.path.basename(apk)
+        sources = {'old': base, 'patch': remote + '.patch'}
+        script = ['rm -f ' + remote]
+        for source, offset, length in ops:
+            script.append('tail -c +%d %s | head -c %d >> %s' % (
+                          offset + 1, sources[source], length, remote))
+        tmpdir = tempfile.mkdtemp()
+        try:
+            patch_file = os.path.join(tmpdir, 'patch')
+            script_file = os.path.join(tmpdir, 'script')
+            open(patch_file, 'wb').write(patch)
+            open(script_file, 'w').write('\n'.join(script) + '\n')
+            self.push(serial, patch_file, remote + '.patch')
+            self.push(serial, script_file, remote + '.sh')
+        finally:
+            shutil.rmtree(tmpdir)
+        self.shell(serial, 'sh %s.sh' % remote)
+        output = self.shell(serial, 'pm install -r ' + remote)
+        self.shell(serial, 'rm -f %s %s.patch %s.sh' % (remote, remote, remote))
+        return 'Success' in output
+
+    def install(self, serial, apk):
+        """ Push apk to the device and install it with the package manager """
+        remote = '/data/local/tmp/' + os.path.basename(apk)
+        self.push(serial, apk, remote)
+        output = self.shell(serial, 'pm install -r ' + remote)
+        self.shell(serial, 'rm ' + remote)
+        if 'Success' not in output:
+            raise AdbError(output.strip())
+
+_ADB_CLIENTS = {}
+_ADB_LOCK = threading.Lock()
+
+def adb_client(env):
+    """
+    Return the AdbClient for the adb server on $ANDROID_ADB_PORT, starting
+    the server with $ANDROID_ADB if it is not running yet.
+    """
+    port = int(env.subst('$ANDROID_ADB_PORT'))
+    _ADB_LOCK.acquire()
+    try:
+        if port not in _ADB_CLIENTS:
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+            except socket.error:
+                subprocess.call([env.subst('$ANDROID_ADB'), '-P', str(port),
+                                 'start-server'])
+            _ADB_CLIENTS[port] = AdbClient(port)
+        return _ADB_CLIENTS[port]
+    finally:
+        _ADB_LOCK.release()
+
+_DEVICES = None
+
+def android_devices(env):
+    """
+    The serials to create per-device install and run targets for. Uses
+    ANDROID_DEVICES if set, otherwise asks the adb server, but only when an
+    install or run target was requested on the command line.
+    """
+    global _DEVICES
+    if env.get('ANDROID_DEVICES'):
+        return env.Split(env['ANDROID_DEVICES'])
+    if _DEVICES is None:
+        _DEVICES = []
+        import SCons.Script
+        wanted = [t for t in SCons.Script.COMMAND_LINE_TARGETS
+                  if t.startswith('install') or t.startswith('run')]
+        if wanted:
+            try:
+                _DEVICES = adb_client(env).devices()
+            except (AdbError, socket.error, OSError):
+                pass
+    return _DEVICES
+
+def write_marker(target, *details):
+    """ Record when a target was last done, as `date > $TARGET' did """
+    marker = open(target.abspath, 'w')
+    marker.write(' '.join((time.ctime(),) + details) + '\n')
+    marker.close()
+
+def _entry_ranges(fname):
+    """
+    Map each entry name in the zip file fname to the (start, end) offsets of
+    its local header and data
+    """
+    ranges = {}
+    zip_file = zipfile.ZipFile(fname)
+    raw = open(fname, 'rb')
+    try:
+        header_size = struct.calcsize(_LOCAL_HEADER)
+        for info in zip_file.infolist():
+            raw.seek(info.header_offset)
+            header = struct.unpack(_LOCAL_HEADER, raw.read(header_size))
+            end = (info.header_offset + header_size + header[10] + header[11] +
+                   info.compress_size)
+            if header[3] & 0x08:
+                # data descriptor, with or without its optional signature
+                raw.seek(end)
+                if raw.read(4) == 'PK\007\010':
+                    end += 16
+                else:
+                    end += 12
+            ranges[info.filename] = (info.header_offset, end)
+    finally:
+        raw.close()
+        zip_file.close()
+    return ranges
+
+def apk_delta(previous, apk):
+    """
+    Describe apk as byte ranges of previous plus the bytes only found in apk.
+    Entries whose header and data are unchanged are taken from previous.
+    Returns the list of (source, offset, length) ranges, where source is
+    'old' or 'patch', and the patch data.
+    """
+    old_ranges = _entry_ranges(previous)
+    new_ranges = _entry_ranges(apk)
+    old_data = open(previous, 'rb').read()
+    new_data = open(apk, 'rb').read()
+    ops = []
+    patch = []
+    patch_size = [0]
+
+    def add(source, offset, length):
+        if ops and ops[-1][0] == source and sum(ops[-1][1:]) == offset:
+            ops[-1] = (source, ops[-1][1], ops[-1][2] + length)
+        elif length:
+            ops.append((source, offset, length))
+
+    def add_new(start, end):
+        if end > start:
+            patch.append(new_data[start:end])
+            add('patch', patch_size[0], end - start)
+            patch_size[0] += end - start
+
+    pos = 0
+    for start, end, name in sorted((r[0], r[1], n)
+                                   for n, r in new_ranges.items()):
+        add_new(pos, start)
+        old = old_ranges.get(name)
+        if old and old_data[old[0]:old[1]] == new_data[start:end]:
+            add('old', old[0], end - start)
+        else:
+            add_new(start, end)
+        pos = end
+    add_new(pos, len(new_data))
+    return ops, ''.join(patch)
+
+def device_hash_file(package):
+    """ Where the hash of the installed APK is kept on the device """
+    return '/data/local/tmp/%s.scons-hash' % package
+
+def installed_apk(client, serial, package):
+    """
+    Return the path of the APK installed for package on the device and its
+    "ls -l" listing, which changes with the size and modification time of
+    the file. Both are empty if the package is not installed.
+    """
+    package_path = client.shell(serial, 'pm path ' + package).strip()
+    package_path = (package_path.splitlines() or [''])[0]
+    if not package_path.startswith('package:'):
+        return '', ''
+    package_path = package_path[len('package:'):]
+    listing = client.shell(serial, 'ls -l ' + package_path).strip()
+    return package_path, ' '.join(listing.split())
+
+def adb_install(target, source, env):
+    """
+    Install $SOURCE on the device $DEVICE_SERIAL, unless the device already
+    has an identical APK for $APP_PACKAGE_NAME installed. The APK's content
+    hash is kept on the device and in the marker file. The device copy also
+    records the listing of the installed APK, so that an APK replaced by
+    other means is installed again.
+    """
+    serial = env['DEVICE_SERIAL']
+    package = env['APP_PACKAGE_NAME']
+    apk = source[0].abspath
+    digest = _cached_file_digest(apk)
+    hash_file = device_hash_file(package)
+    # the last APK installed from here, the base for delta installs
+    previous = target[0].abspath + '.apk'
+    try:
+        client = adb_client(env)
+        installed = client.shell(serial, 'cat ' + hash_file).strip()
+        installed = installed.split(None, 1)
+        package_path, listing = installed_apk(client, serial, package)
+        if package_path and installed == [digest, listing]:
+            print '%s already installed on %s' % (source[0], serial)
+        else:
+            done = False
+            if (env.get('ANDROID_DELTA_INSTALL') and package_path and
+                os.path.exists(previous) and
+                installed == [_cached_file_digest(previous), listing]):
+                done = client.install_delta(serial, apk, previous,
+                                            package_path)
+            if not done:
+                client.install(serial, apk)
+            package_path, listing = installed_apk(client, serial, package)
+            client.shell(serial, 'echo %s %s > %s' % (digest, listing,
+                                                     hash_file))
+        if env.get('ANDROID_DELTA_INSTALL'):
+            shutil.copyfile(apk, previous)
+    except (AdbError, socket.error), exc:
+        print 'Installing on %s failed: %s' % (serial, exc)
+        return 1
+    write_marker(target[0], digest)
+    return 0
+
+def adb_run(target, source, env):
+    """ Start $APP_COMPONENT on the device $DEVICE_SERIAL """
+    try:
+        output = adb_client(env).shell(env['DEVICE_SERIAL'],
+                    'am start -a android.intent.action.MAIN -n ' +
+                    env['APP_COMPONENT'])
+    except (AdbError, socket.error), exc:
+        print 'Starting on %s failed: %s' % (env['DEVICE_SERIAL'], exc)
+        return 1
+    sys.stdout.write(output)
+    if 'Error' in output:
+        return 1
+    return 0
+
 def add_gnu_tools(env, abi):
     """ Add the NDK GNU compiler tools to the Environment """
     gnu_tools = ['gcc', 'g++', 'gnulink', 'ar', 'gas']
@@ -101,6 +1393,62 @@ def add_gnu_tools(env, abi):
     env['OBJCOPY'] = tool_prefix+'objcopy'
     env['STRIP'] = tool_prefix+'strip'
 
+def predex_jar(env, jar):
+    """
+    Dex a library jar once into $ANDROID_PREDEX_DIR, and dx merges it into
+    classes.dex instead of converting the whole library on every build. The
+    file is named after the contents of the jar and of dx.jar, so an
+    existing one is used as it is, even by a fresh build tree or after the
+    .sconsign file is lost. A jar that is itself built is named after its
+    path and rebuilt as usual.
+    """
+    jar = env.File(jar)
+    dx_jar = env.subst('$DX_JAR')
+    md5 = hashlib.md5()
+    on_disk = os.path.exists(jar.rfile().abspath)
+    if on_disk:
+        md5.update(_cached_file_digest(jar.rfile().abspath))
+    else:
+        md5.update(jar.abspath)
+    if os.path.exists(dx_jar):
+        md5.update(_cached_file_digest(dx_jar))
+    target = env.Dir('$ANDROID_PREDEX_DIR').File(
+            md5.hexdigest()[:12] + '-' + jar.name)
+    if on_disk and os.path.exists(target.abspath):
+        return target
+    predexed = env.PreDex(target, jar)
+    if os.path.exists(dx_jar):
+        env.Depends(predexed, '$DX_JAR')
+    return predexed[0]
+
+def dex_packages(env, safe_name, package, bin_classes, classes, rfile):
+    """
+    Dex the compiled classes one package at a time into safe_name_bin/dex, so
+    a change only converts the classes of the affected package. Returns the
+    intermediate dex jars, which dx then merges into classes.dex. rfile is
+    the generated R.java, whose classes are dexed with the package.
+    """
+    classdir = env.Dir(bin_classes)
+    packages = {}
+    for class_file in classes:
+        pkg_dir = os.path.dirname(os.path.relpath(class_file.abspath,
+                                                  classdir.abspath))
+        packages.setdefault(pkg_dir, []).append(class_file)
+    # javac writes the R classes next to the application's own classes
+    # without them being emitted as targets
+    packages.setdefault(package.replace('.', os.sep), classes)
+    results = []
+    for pkg_dir in sorted(packages.keys()):
+        jar_name = pkg_dir.replace(os.sep, '.') or '_default'
+        dexed = env.DexClasses('%s_bin/dex/%s.jar' % (safe_name, jar_name),
+                               packages[pkg_dir],
+                               PACKAGE_DIR=classdir.Dir(pkg_dir or '.'))
+        if pkg_dir == package.replace('.', os.sep):
+            # so new R classes are dexed when the package's own are the same
+            env.Depends(dexed, rfile)
+        results.extend(dexed)
+    return results
+
 def do_proguard(env, safe_name, classes, bin_classes, gen):
     original_jar_name = 'proguard/' + safe_name + 'original.jar'
     obfuscated_jar = 'proguard/' + safe_name + 'obfuscated.jar'
@@ -141,12 +1489,168 @@ def do_proguard(env, safe_name, classes, bin_classes, gen):
                     'proguard/usage.txt', 'proguard/mapping.txt'], dex_input)
     return dex_input
 
+# the NDK build Environments, see ndk_toolchain_env
+_NDK_TOOLCHAINS = {}
+
+def _env_signature(env):
+    """ A string that changes whenever any construction variable of env does """
+    return repr(sorted(env.Dictionary().items()))
+
+def ndk_toolchain_env(env, abi, in_place=False):
+    """
+    Return a copy of env set up to compile and link abi code with the NDK.
+    Cloning env and adding the GNU tools is slow, so the copy is made once
+    per env, NDK and ABI and shared by later NdkBuild calls. A new copy is
+    made if any construction variable of env has changed since. With
+    in_place set, env itself is also given the NDK compilers and flags.
+    """
+    key = (id(env), env.subst('$ANDROID_NDK'), abi)
+    signature = _env_signature(env)
+    cached = _NDK_TOOLCHAINS.get(key)
+    # the base env is kept in the entry so its id can not be reused
+    if not cached or cached[0] is not env or signature not in cached[1]:
+        cached = (env, set([signature]), _new_toolchain_env(env, abi))
+        _NDK_TOOLCHAINS[key] = cached
+    tmp_env = cached[2]
+    if in_place:
+        changes = dict((name, value) for name, value
+                       in tmp_env.Dictionary().items()
+                       if name not in env or env[name] != value)
+        if changes:
+            env.Replace(**changes)
+            # env is now set up like the copy, which can be used again
+            cached[1].add(_env_signature(env))
+    return tmp_env
+
+def _new_toolchain_env(env, abi):
+    """ A copy of env with the NDK compilers and flags for abi """
+    android_common_cflags = ''' -Wall -Wextra -fpic -ffunction-sections -Os
+                                -funwind-tables
+                                -fno-short-enums -Wno-psabi
+                                -fomit-frame-pointer -fno-strict-aliasing
+                                -Wa,--noexecstack'''.split()
+
+    android_abi_cflags = {'armeabi': '''-mthumb-interwork -march=armv5te
+                                      -fstack-protector
+                                      -mtune=xscale -msoft-float -mthumb
+                                      -finline-limit=64''',
+
+                          'armeabi-v7a': ''' -march=armv7-a -mfloat-abi=softfp
+                                      -fstack-protector
+                                      -mfpu=vfp -mthumb -finline-limit=64 ''',
+
+                          'x86': '''  -finline-limit=300 '''}
+
+    tmp_env = env.Clone()
+    arch = 'arch-%s' % abi[0:3]
+    add_gnu_tools(tmp_env, abi)
+    if abi == 'x86':
+        if int(tmp_env['ANDROID_MIN_TARGET']) < 9:
+            tmp_env['ANDROID_MIN_TARGET'] = '9'
+    target_platform = '$ANDROID_NDK/platforms/android-$ANDROID_MIN_TARGET'
+    if 'CPPPATH' not in tmp_env:
+        tmp_env['CPPPATH'] = []
+    tmp_env['CPPPATH'] += [target_platform + '/%s/usr/include' % arch]
+    if 'CPPDEFINES' not in tmp_env:
+        tmp_env['CPPDEFINES'] = []
+    tmp_env['CPPDEFINES'] += ['-DANDROID']
+    android_cflags = android_abi_cflags[abi].split()
+    android_cflags.extend(android_common_cflags)
+    android_cxxflags = '''-fno-rtti -fno-exceptions'''.split()
+    tmp_env['CFLAGS'] = env.Flatten(['$CFLAGS', android_cflags])
+    tmp_env['CXXFLAGS'] = env.Flatten(['$CXXFLAGS', android_cflags,
+                                       android_cxxflags])
+    if 'LIBPATH' not in tmp_env:
+        tmp_env['LIBPATH'] = []
+    tmp_env['LIBPATH'] += [target_platform + '/%s/usr/lib' % arch]
+    tmp_env['SHOBJSUFFIX'] = '.'+abi+'-os'
+    shflags = '''-Wl,-soname,${TARGET.file}
+        -shared
+        --sysroot=%s/%s
+        -Wl,--no-undefined -Wl,-z,noexecstack''' % (target_platform, arch)
+    tmp_env['SHLINKFLAGS'] = shflags.split()
+    return tmp_env
+
+def _object_signature(env, source):
+    """
+    The command line that compiles source, with source standing in for the
+    object name
+    """
+    com = {'.c': '$SHCCCOM', '.s': '$ASCOM', '.S': '$ASPPCOM'}.get(
+            source.suffix, '$SHCXXCOM')
+    return env.subst(com, target=[source], source=[source])
+
+def precompile_header(env, header, directory):
+    """
+    Precompile the C++ header into directory with the flags of env. Returns
+    the .gch node and the overrides that compile C++ sources using it.
+    """
+    header = env.File(header)
+    gch = env.NdkPch(env.Dir(directory).File(header.name + '.gch'), header)
+    # gcc tries header.gch in each directory it searches for the header, so
+    # the .gch directory goes first and a rejected .gch falls back to the
+    # real header after it
+    search = [gch[0].get_dir().abspath]
+    for header_dir in (header.get_dir(), header.srcnode().get_dir()):
+        if header_dir.abspath not in search:
+            search.append(header_dir.abspath)
+    flags = ['$SHCXXFLAGS', '-Winvalid-pch']
+    for path in search:
+        flags.extend(['-iquote', path])
+    return gch, {'SHCXXFLAGS': flags + ['-include', header.name]}
+
+def write_value(target, source, env):
+    """ Write the contents of the Value source to the target file """
+    output = open(target[0].abspath, 'w')
+    output.write(source[0].get_contents())
+    output.close()
+
+def unity_sources(env, sources, groups, directory):
+    """
+    Combine the C and C++ sources into at most groups generated files each,
+    which include the original sources. A source always goes into the same
+    group, so editing it only rebuilds that group.
+    """
+    directory = env.Dir(directory)
+    extensions = {'.c': '.c', '.cpp': '.cpp', '.cc': '.cpp', '.cxx': '.cpp'}
+    members = {}
+    results = []
+    for source in sources:
+        extension = extensions.get(source.suffix)
+        if not extension:
+            results.append(source)
+            continue
+        path = source.srcnode().path.replace(os.sep, '/')
+        group = int(hashlib.md5(path).hexdigest(), 16) % groups
+        members.setdefault((extension, group), []).append(source)
+    for (extension, group), group_sources in sorted(members.items()):
+        includes = []
+        for source in sorted(group_sources, key=str):
+            path = os.path.relpath(source.srcnode().abspath, directory.abspath)
+            includes.append('#include "%s"\n' % path.replace(os.sep, '/'))
+        target = directory.File('unity_%d%s' % (group, extension))
+        results.extend(env.Command(target, env.Value(''.join(includes)),
+                                   Action(write_value, 'Creating $TARGET')))
+    return results
+
 def NdkBuild(env, library=None, inputs=None,
              manifest='#AndroidManifest.xml',
-             app_abi='armeabi'):
-    """ Use the NDK to build a shared library from the given inputs. """
+             app_abi='armeabi', neutral_inputs=None, pch=None, unity=0,
+             modules=None):
+    """
+    Use the NDK to build a shared library from the given inputs. Sources in
+    neutral_inputs do not depend on the ABI, so they are compiled once for
+    all the ABIs that use the same compiler. If pch is given, that header is
+    precompiled for each ABI and included in every C++ source. If unity is
+    set, the inputs are compiled as that many combined C and C++ files.
+    The library is linked with the NdkImportModule modules in modules, and
+    compiled with the include paths and flags they export.
+    """
     # ensure ANDROID_NDK is set
     get_variable(env, 'ANDROID_NDK')
+    use_metadata_cache(env)
+    use_trace(env)
+    use_jobserver(env)
     android_manifest = env.File(manifest)
     if 'ANDROID_TARGET' not in env:
         min_target, target = get_android_target(android_manifest.abspath)
@@ -169,86 +1673,742 @@ def NdkBuild(env, library=None, inputs=None,
     if len(library) == 1 and libname.find(os.path.sep) == -1:
         library = [('libs/%s/' % abi) + libname for abi in app_abis]
 
+    neutral = env.arg2nodes(neutral_inputs or [], env.fs.File)
+    sources = env.arg2nodes(inputs or [], env.fs.File)
+    if unity:
+        sources = unity_sources(env, sources, unity, 'local/%s.unity' %
+                                os.path.splitext(library[0])[0])
+    sources += neutral
+    # objects by compile command line, so sources that compile the same way
+    # for several ABIs are only built once
+    objects = {}
+    # the first Environment seen for each compiler builds the neutral sources
+    compilers = {}
+    # the precompiled header and the overrides using it, by ABI Environment
+    headers = {}
+    modules = env.Flatten(modules or [])
+    module_overrides = {}
+    module_libs = []
+    if modules:
+        module_overrides = {
+            'CPPPATH': ['$CPPPATH'] + env.Flatten([m.export_includes
+                                                   for m in modules]),
+            'CCFLAGS': ['$CCFLAGS'] + env.Flatten([m.export_cflags
+                                                   for m in modules])}
+        module_libs = env.Flatten([m.export_libs for m in modules])
+
     results = []
-    android_common_cflags = ''' -Wall -Wextra -fpic -ffunction-sections -Os
-                                -funwind-tables
-                                -fno-short-enums -Wno-psabi
-                                -fomit-frame-pointer -fno-strict-aliasing
-                                -Wa,--noexecstack'''.split()
+    for library_name, abi in zip(library, app_abis):
+        # a single library has always set up env itself
+        tmp_env = ndk_toolchain_env(env, abi, in_place=len(library) == 1)
+        # the toolchain Environment may have its own compiler builders
+        use_trace(tmp_env)
+        use_jobserver(tmp_env)
+        compiled = tmp_env['BUILDERS']['SharedObject'].src_suffixes(tmp_env)
+        build_env = compilers.setdefault(tmp_env.subst('$CC'), tmp_env)
+        if pch:
+            headers[id(tmp_env)] = precompile_header(tmp_env, pch,
+                                        'local/%s.pch' % library_name)
+        lib_inputs = []
+        for source in sources:
+            if source.suffix not in compiled:
+                lib_inputs.append(source)
+                continue
+            source_env = tmp_env
+            if source in neutral:
+                source_env = build_env
+            gch, overrides = None, dict(module_overrides)
+            if pch and source.suffix not in ('.c', '.s', '.S'):
+                gch, pch_overrides = headers[id(source_env)]
+                overrides.update(pch_overrides)
+            signature = _object_signature(source_env.Override(overrides),
+                                          source)
+            if signature not in objects:
+                builder = source_env.SharedObject
+                if env['NDK_COMPILE_CACHE']:
+                    builder = source_env.NdkObject
+                objects[signature] = builder(source, **overrides)
+                if gch:
+                    env.Depends(objects[signature], gch)
+            lib_inputs.extend(objects[signature])
+        static_libs = env.Flatten([m.library(tmp_env, abi) for m in modules])
+        lib = tmp_env.SharedLibrary('local/'+library_name, lib_inputs,
+                                    LIBS=static_libs + ['$LIBS'] +
+                                         module_libs + ['c'])
+        stripped = tmp_env.NdkStrip(library_name, lib)
+        if env.get('ANDROID_TRACE'):
+            label_trace('%s %s' % (abi, os.path.basename(library_name)),
+                        stripped)
+        results.append(lib)
+    return results
 
-    android_abi_cflags = {'armeabi': '''-mthumb-interwork -march=armv5te
-                                      -fstack-protector
-                                      -mtune=xscale -msoft-float -mthumb
-                                      -finline-limit=64''',
+_MAKE_VARIABLE = re.compile(r'\$\((\w+)\)')
+_MAKE_ASSIGNMENT = re.compile(r'^(\w+)\s*([:+?]?=)\s*(.*)$')
 
-                          'armeabi-v7a': ''' -march=armv7-a -mfloat-abi=softfp
-                                      -fstack-protector
-                                      -mfpu=vfp -mthumb -finline-limit=64 ''',
+def read_makefile(fname):
+    """
+    Read the variables and modules of an Android.mk or Application.mk file.
+    Only plain assignments and the include lines of the NDK build system are
+    understood, other make constructs are skipped. Returns the variables and
+    a list of modules, each a dict of its LOCAL_ variables with BUILD set to
+    the kind of module, for example SHARED_LIBRARY.
+    """
+    variables = {}
+    modules = []
+    my_dir = os.path.dirname(os.path.abspath(fname))
 
-                          'x86': '''  -finline-limit=300 '''}
+    def expand(value):
+        value = value.replace('$(call my-dir)', my_dir)
+        return _MAKE_VARIABLE.sub(lambda m: variables.get(m.group(1), ''),
+                                  value)
 
-    libs_len = len(library)
-    for i in range(0, libs_len):
-        if libs_len > 1:
-            tmp_env = env.Clone()
-        else:
-            tmp_env = env
-        library_name = library[i]
-        abi = app_abis[i]
-        arch = 'arch-%s' % abi[0:3]
-        add_gnu_tools(tmp_env, abi)
-        if abi == 'x86':
-            if int(tmp_env['ANDROID_MIN_TARGET']) < 9:
-                tmp_env['ANDROID_MIN_TARGET'] = '9'
-        target_platform = '$ANDROID_NDK/platforms/android-$ANDROID_MIN_TARGET'
-        if 'CPPPATH' not in tmp_env:
-            tmp_env['CPPPATH'] = []
-        tmp_env['CPPPATH'] += [target_platform + '/%s/usr/include' % arch]
-        if 'CPPDEFINES' not in tmp_env:
-            tmp_env['CPPDEFINES'] = []
-        tmp_env['CPPDEFINES'] += ['-DANDROID']
-        android_cflags = android_abi_cflags[abi].split()
-        android_cflags.extend(android_common_cflags)
-        android_cxxflags = '''-fno-rtti -fno-exceptions'''.split()
-        tmp_env['CFLAGS'] = env.Flatten(['$CFLAGS', android_cflags])
-        tmp_env['CXXFLAGS'] = env.Flatten(['$CXXFLAGS', android_cflags,
-                                           android_cxxflags])
-        if 'LIBPATH' not in tmp_env:
-            tmp_env['LIBPATH'] = []
-        tmp_env['LIBPATH'] += [target_platform + '/%s/usr/lib' % arch]
-        tmp_env['SHOBJSUFFIX'] = '.'+abi+'-os'
-        shflags = '''-Wl,-soname,${TARGET.file}
-            -shared
-            --sysroot=%s/%s
-            -Wl,--no-undefined -Wl,-z,noexecstack''' % (target_platform, arch)
-        tmp_env['SHLINKFLAGS'] = shflags.split()
-
-        lib = tmp_env.SharedLibrary('local/'+library_name, inputs,
-                                    LIBS=['$LIBS', 'c'])
-        tmp_env.Command(library_name, lib, [Copy('$TARGET', "$SOURCE"),
-                                   '$STRIP --strip-unneeded $TARGET'])
-        results.append(lib)
-    return results
+    text = open(fname).read().replace('\\\n', ' ')
+    for line in text.splitlines():
+        line = line.split('#')[0].strip()
+        if line.startswith('include '):
+            included = line.split(None, 1)[1].strip()
+            if included == '$(CLEAR_VARS)':
+                for name in variables.keys():
+                    if name.startswith('LOCAL_') and name != 'LOCAL_PATH':
+                        del variables[name]
+            elif included.startswith('$(BUILD_') or \
+                 included.startswith('$(PREBUILT_'):
+                module = dict((name, value) for name, value in variables.items()
+                              if name.startswith('LOCAL_'))
+                module['BUILD'] = included[2:-1].replace('BUILD_', '', 1)
+                modules.append(module)
+            continue
+        match = _MAKE_ASSIGNMENT.match(line)
+        if not match:
+            continue
+        name, operator, value = match.groups()
+        if operator == '+=':
+            variables[name] = (variables.get(name, '') + ' ' +
+                               expand(value)).strip()
+        elif operator != '?=' or name not in variables:
+            variables[name] = expand(value)
+    return variables, modules
+
+def _android_mk_modules(fname):
+    """ The modules of the Android.mk file fname """
+    return read_makefile(fname)[1]
+
+# abspath -> (stamp, modules), shared by all Environments
+_ANDROID_MK_CACHE = {}
+
+def get_android_mk_modules(fname):
+    """
+    Return the modules of the Android.mk file fname, as read_makefile does.
+    The file is only parsed again if it has changed since the last call.
+    """
+    fname = os.path.abspath(fname)
+    stamp = _file_stamp(fname)
+    cached = _ANDROID_MK_CACHE.get(fname)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    if _METADATA_CACHE is not None:
+        modules = _METADATA_CACHE.lookup('android.mk', fname,
+                                         _android_mk_modules)
+    else:
+        modules = _android_mk_modules(fname)
+    _ANDROID_MK_CACHE[fname] = (stamp, modules)
+    return modules
+
+class NdkModule(object):
+    """
+    A module from an NDK Android.mk file. It is built as a static library
+    once for each ABI, which every NdkBuild that uses the module links.
+    """
+    def __init__(self, values):
+        self.name = values['LOCAL_MODULE']
+        self.path = values.get('LOCAL_PATH', '')
+        self.sources = [os.path.join(self.path, source) for source in
+                        values.get('LOCAL_SRC_FILES', '').split()]
+        self.includes = values.get('LOCAL_C_INCLUDES', '').split()
+        self.cflags = values.get('LOCAL_CFLAGS', '').split()
+        self.export_includes = values.get('LOCAL_EXPORT_C_INCLUDES',
+                                          '').split()
+        self.export_cflags = values.get('LOCAL_EXPORT_CFLAGS', '').split()
+        # -lname, as LIBS wants it
+        self.export_libs = [lib[2:] for lib in
+                            values.get('LOCAL_EXPORT_LDLIBS', '').split()
+                            if lib.startswith('-l')]
+        self.libraries = {}
+
+    def library(self, env, abi):
+        """ The static library of the module for abi, built with env """
+        if abi not in self.libraries:
+            build_dir = env.Dir('$NDK_MODULE_DIR').Dir(abi).Dir(self.name)
+            objects = []
+            for source in self.sources:
+                name = os.path.relpath(source, self.path)
+                objects.extend(env.StaticObject(
+                    build_dir.File(os.path.splitext(name)[0] +
+                                   env.subst('$OBJSUFFIX')),
+                    source,
+                    CPPPATH=['$CPPPATH', self.path] + self.includes +
+                            self.export_includes,
+                    CCFLAGS=['$CCFLAGS'] + self.cflags + self.export_cflags))
+            library = env.subst('${LIBPREFIX}%s${LIBSUFFIX}' % self.name)
+            self.libraries[abi] = env.StaticLibrary(build_dir.File(library),
+                                                    objects)
+        return self.libraries[abi]
+
+# (Android.mk abspath, module name) -> NdkModule, shared by all Environments
+_NDK_MODULES = {}
+
+def NdkImportModule(env, name):
+    """
+    Import the NDK modules in name/Android.mk, searching $NDK_MODULE_PATH and
+    then the NDK's sources directory, as $(call import-module) does. Returns
+    the NdkModules to pass to NdkBuild.
+    """
+    search_path = env.subst('$NDK_MODULE_PATH').split(os.pathsep)
+    search_path.append(env.subst('$ANDROID_NDK/sources'))
+    for directory in search_path:
+        android_mk = os.path.join(env.Dir(directory).abspath, name,
+                                  'Android.mk')
+        if directory and os.path.exists(android_mk):
+            break
+    else:
+        raise UserError('NDK module %s not found in %s' %
+                        (name, os.pathsep.join(search_path)))
+    modules = []
+    for values in get_android_mk_modules(android_mk):
+        if 'LOCAL_MODULE' not in values or values['BUILD'].startswith('PREBUILT'):
+            continue
+        key = (android_mk, values['LOCAL_MODULE'])
+        if key not in _NDK_MODULES:
+            _NDK_MODULES[key] = NdkModule(values)
+        modules.append(_NDK_MODULES[key])
+    return modules
+
+def _read_dependency_file(fname):
+    """ The prerequisites listed in a make dependency file """
+    text = open(fname).read().replace('\\\n', ' ')
+    prerequisites = []
+    for line in text.splitlines():
+        if ':' in line:
+            prerequisites.extend(line.split(':', 1)[1].split())
+    return prerequisites
+
+def ndk_module_files(app_path):
+    """
+    Find the libraries ndk-build installs for the modules of the app in
+    app_path, and the files they are built from: the sources in Android.mk
+    plus the headers in the dependency files of the last build. Returns the
+    outputs and inputs as absolute paths.
+    """
+    jni = os.path.join(app_path, 'jni')
+    abis = ['armeabi']
+    application_mk = os.path.join(jni, 'Application.mk')
+    if os.path.exists(application_mk):
+        variables = read_makefile(application_mk)[0]
+        abis = variables.get('APP_ABI', '').split() or abis
+        if 'all' in abis:
+            abis = ['armeabi', 'armeabi-v7a', 'x86']
+    outputs = []
+    inputs = []
+    for module in read_makefile(os.path.join(jni, 'Android.mk'))[1]:
+        local_path = module.get('LOCAL_PATH', jni)
+        for source in module.get('LOCAL_SRC_FILES', '').split():
+            inputs.append(os.path.join(local_path, source))
+        name = module.get('LOCAL_MODULE')
+        if not name or module['BUILD'] != 'SHARED_LIBRARY':
+            continue
+        filename = module.get('LOCAL_MODULE_FILENAME')
+        if not filename:
+            filename = name.startswith('lib') and name or 'lib' + name
+        for abi in abis:
+            outputs.append(os.path.join(app_path, 'libs', abi,
+                                        filename + '.so'))
+            objs = os.path.join(app_path, 'obj', 'local', abi, 'objs', name)
+            for root, dirs, files in os.walk(objs):
+                for dependency_file in files:
+                    if not dependency_file.endswith('.d'):
+                        continue
+                    for header in _read_dependency_file(
+                            os.path.join(root, dependency_file)):
+                        header = os.path.join(app_path, header)
+                        if (header.startswith(app_path + os.sep) and
+                            os.path.exists(header)):
+                            inputs.append(header)
+    return outputs, sorted(set(inputs))
+
+_JOBSERVER = []
+_JOBSERVER_LOCK = threading.Lock()
+
+def get_jobserver(env):
+    """
+    The read and write descriptors of the make jobserver pipe shared by all
+    Android and NDK actions. It holds a token for each scons job.
+    """
+    _JOBSERVER_LOCK.acquire()
+    try:
+        if not _JOBSERVER:
+            read_fd, write_fd = os.pipe()
+            os.write(write_fd, '+' * env.GetOption('num_jobs'))
+            _JOBSERVER.extend([read_fd, write_fd])
+        return _JOBSERVER
+    finally:
+        _JOBSERVER_LOCK.release()
+
+def acquire_job(env):
+    """ Wait for a token from the jobserver and return it """
+    return os.read(get_jobserver(env)[0], 1)
+
+def release_job(env, token):
+    """ Give a token from acquire_job back to the jobserver """
+    os.write(get_jobserver(env)[1], token)
+
+class JobserverAction(object):
+    """
+    Wraps a builder's action so that it holds a jobserver token while it
+    runs, if NDK_JOBSERVER is set. Everything else is passed on to the
+    wrapped action.
+    """
+    def __init__(self, action):
+        self.action = action
+
+    def __getattr__(self, name):
+        return getattr(self.action, name)
+
+    def __str__(self):
+        return str(self.action)
+
+    def __call__(self, target, source, env, *args, **kw):
+        if not env.get('NDK_JOBSERVER'):
+            return self.action(target, source, env, *args, **kw)
+        token = acquire_job(env)
+        try:
+            return self.action(target, source, env, *args, **kw)
+        finally:
+            release_job(env, token)
+
+def use_jobserver(env):
+    """
+    Have the actions of env's Android and NDK builders take a jobserver
+    token if NDK_JOBSERVER is set, so that they and the jobs of ndk-build
+    share the scons -j budget. Only nodes created after this call are
+    counted.
+    """
+    if not env.get('NDK_JOBSERVER'):
+        return
+    for name in _TRACE_STAGES:
+        if name not in env['BUILDERS']:
+            continue
+        builder = env['BUILDERS'][name]
+        builder = getattr(builder, 'builder', builder)
+        if not isinstance(builder.action, JobserverAction):
+            builder.action = JobserverAction(builder.action)
+
+class NdkBuildAction(CommandAction):
+    """
+    Runs ndk-build. If NDK_JOBSERVER is set, it waits for a token from the
+    jobserver in get_jobserver and starts make as a client of it, so make
+    runs its first job on that token and takes a token for every other job.
+    """
+    def execute(self, target, source, env, *args, **kw):
+        if not env.get('NDK_JOBSERVER'):
+            return CommandAction.execute(self, target, source, env,
+                                         *args, **kw)
+        environ = _tool_environ(env)
+        jobserver = '%d,%d' % tuple(get_jobserver(env))
+        # older makes know --jobserver-fds, newer ones --jobserver-auth and
+        # both ignore options they do not know in MAKEFLAGS
+        environ['MAKEFLAGS'] = (' -j --jobserver-fds=%s --jobserver-auth=%s' %
+                                (jobserver, jobserver))
+        token = acquire_job(env)
+        try:
+            for cmd in env.subst_list(self.cmd_list, 0, target, source):
+                command = ' '.join(str(arg) for arg in cmd)
+                status = subprocess.call(command, shell=True, env=environ,
+                                         close_fds=False)
+                if status != 0:
+                    return status
+        finally:
+            release_job(env, token)
+        return 0
 
 def NdkBuildLegacy(env, library=None, inputs=None, app_root='#.',
-            build_dir='.'):
-    """ Use ndk-build to compile native code. """
+            build_dir='.', track_modules=False):
+    """
+    Use ndk-build to compile native code. If track_modules is set, all the
+    libraries from the Android.mk modules are targets and their real sources
+    and headers are the inputs, instead of only the given library and
+    inputs.
+    """
     # ensure ANDROID_NDK is set
     get_variable(env, 'ANDROID_NDK')
     if env.GetOption('silent'):
         verbose = 0
     else:
         verbose = 1
-    jobs = env.GetOption('num_jobs')
+    jobs = '-j %s ' % env.GetOption('num_jobs')
+    if env.get('NDK_JOBSERVER'):
+        # the jobserver sets the number of jobs
+        jobs = ''
     build_path = env.Dir(build_dir).path
     app_path = env.Dir(app_root).abspath
-    cmd = ('$ANDROID_NDK/ndk-build V=%s -j %s SCONS_BUILD_ROOT=%s '
+    cmd = ('$ANDROID_NDK/ndk-build V=%s %sSCONS_BUILD_ROOT=%s '
            'APP_PLATFORM=android-$ANDROID_MIN_TARGET -C %s') % (
                verbose, jobs, build_path, app_path)
-    lib = env.Command(os.path.join(app_root, library), env.Flatten(inputs), cmd)
+    targets = [env.File(os.path.join(app_root, library))]
+    sources = env.Flatten(inputs)
+    if track_modules:
+        outputs, module_inputs = ndk_module_files(app_path)
+        targets.extend(env.File(output) for output in outputs
+                       if output != targets[0].abspath)
+        sources.extend(env.File(source) for source in module_inputs)
+    lib = env.Command(targets, sources, NdkBuildAction(cmd))
     env.Clean(lib, [os.path.join(app_root, x) for x in ('libs', 'obj')])
     return lib
 
+def cached_parse_java_file(fname, version='1.4'):
+    """
+    parse_java_file with the package directory and class names kept in the
+    metadata cache, so unchanged sources are not tokenized again
+    """
+    if _METADATA_CACHE is None:
+        return parse_java_file(fname, version)
+    return _METADATA_CACHE.lookup('java-' + version, os.path.abspath(fname),
+                                  lambda path: parse_java_file(path, version))
+
+# the SCons Java emitter parses every source on each run too
+SCons.Tool.javac.parse_java_file = cached_parse_java_file
+
+# the javac command line without $SOURCES, incremental_javac adds the
+# sources it compiles
+_INCREMENTAL_JAVACCOM = ('$JAVAC $JAVACFLAGS $_JAVABOOTCLASSPATH '
+                         '$_JAVACLASSPATH -d ${TARGET.attributes.java_classdir} '
+                         '$_JAVASOURCEPATH')
+
+_CLASS_DESCRIPTOR = re.compile(r'L([^;<]+)[;<]')
+
+# access flags of classes and members
+_ACC_PRIVATE = 0x0002
+_ACC_SUPER = 0x0020
+_ACC_SYNTHETIC = 0x1000
+
+def read_class_file(fname):
+    """
+    Read the name, source file name and referenced classes of a .class file,
+    along with digests of its API and of its compile-time constants and its
+    super class and interfaces. The API is everything other classes can
+    see: the class's flags, super class and interfaces and the non-private
+    fields and methods. The constants digest is None for classes without
+    constant fields.
+    """
+    data = open(fname, 'rb').read()
+    if data[:4] != '\xca\xfe\xba\xbe':
+        raise ValueError('%s is not a class file' % fname)
+    pos = [8]
+    def read(fmt):
+        values = struct.unpack_from(fmt, data, pos[0])
+        pos[0] += struct.calcsize(fmt)
+        return values
+    def skip(size):
+        pos[0] += size
+        return data[pos[0] - size:pos[0]]
+
+    count, = read('>H')
+    pool = [None] * count
+    index = 1
+    while index < count:
+        tag, = read('>B')
+        if tag == 1:
+            length, = read('>H')
+            pool[index] = (tag, skip(length))
+        elif tag in (3, 4):
+            pool[index] = (tag, skip(4))
+        elif tag in (5, 6):
+            # 8 byte constants take two entries
+            pool[index] = (tag, skip(8))
+            index += 1
+        elif tag in (7, 8, 16, 19, 20):
+            pool[index] = (tag,) + read('>H')
+        elif tag in (9, 10, 11, 12, 17, 18):
+            pool[index] = (tag,) + read('>HH')
+        elif tag == 15:
+            pool[index] = (tag,) + read('>BH')
+        else:
+            raise ValueError('%s: unknown constant pool tag %d' % (fname, tag))
+        index += 1
+
+    def utf8(i):
+        return pool[i][1]
+    def class_name(i):
+        return i and utf8(pool[i][1]) or None
+    def constant(i):
+        tag, value = pool[i][:2]
+        if tag == 8:
+            value = utf8(value)
+        return tag, value
+
+    refs = set()
+    for entry in pool:
+        if entry is None:
+            continue
+        if entry[0] == 7:
+            name = utf8(entry[1])
+            if name.startswith('['):
+                refs.update(_CLASS_DESCRIPTOR.findall(name))
+            else:
+                refs.add(name)
+        elif entry[0] == 12:
+            refs.update(_CLASS_DESCRIPTOR.findall(utf8(entry[2])))
+
+    def read_attributes():
+        attributes = {}
+        for i in range(read('>H')[0]):
+            name, length = read('>HI')
+            attributes[utf8(name)] = skip(length)
+        return attributes
+
+    access, this_class, super_class = read('>HHH')
+    interfaces = [class_name(i) for i in read('>%dH' % read('>H')[0])]
+    name = class_name(this_class)
+    api = hashlib.md5(repr((access & ~(_ACC_SUPER | _ACC_SYNTHETIC),
+                            class_name(super_class), interfaces)))
+    constants = []
+    for kind in ('field', 'method'):
+        for i in range(read('>H')[0]):
+            flags, member, descriptor = read('>HHH')
+            attributes = read_attributes()
+            descriptor = utf8(descriptor)
+            refs.update(_CLASS_DESCRIPTOR.findall(descriptor))
+            if flags & (_ACC_PRIVATE | _ACC_SYNTHETIC):
+                continue
+            signature = [kind, flags, utf8(member), descriptor]
+            if 'Exceptions' in attributes:
+                exceptions = attributes['Exceptions']
+                signature.append([class_name(i) for i in struct.unpack(
+                        '>%dH' % (len(exceptions) / 2 - 1), exceptions[2:])])
+            if 'ConstantValue' in attributes:
+                value, = struct.unpack('>H', attributes['ConstantValue'])
+                constants.append((utf8(member), constant(value)))
+            api.update(repr(signature))
+    attributes = read_attributes()
+    source_file = None
+    if 'SourceFile' in attributes:
+        source_file = utf8(struct.unpack('>H', attributes['SourceFile'])[0])
+    refs.discard(name)
+    if constants:
+        constants = hashlib.md5(repr(constants)).hexdigest()
+    else:
+        constants = None
+    supers = [class_name(super_class)] + interfaces
+    return name, source_file, refs, api.hexdigest(), constants, supers
+
+# changed whenever the layout of the incremental javac state changes
+_JAVAC_STATE_VERSION = 2
+
+def _new_javac_state(command):
+    return {'version': _JAVAC_STATE_VERSION, 'command': command,
+            'sources': {}, 'classes': {}}
+
+def _load_javac_state(fname):
+    """ The dependency state of an incremental javac, or an empty one """
+    try:
+        state_file = open(fname, 'rb')
+        try:
+            state = cPickle.load(state_file)
+        finally:
+            state_file.close()
+    except (IOError, OSError, EOFError, ValueError, cPickle.UnpicklingError):
+        return _new_javac_state(None)
+    if state.get('version') != _JAVAC_STATE_VERSION:
+        return _new_javac_state(None)
+    return state
+
+def _save_javac_state(fname, state):
+    tmpname = fname + '.tmp'
+    state_file = open(tmpname, 'wb')
+    try:
+        cPickle.dump(state, state_file, cPickle.HIGHEST_PROTOCOL)
+    finally:
+        state_file.close()
+    os.rename(tmpname, fname)
+
+def _remove_classes(classdir, names):
+    for name in names:
+        class_file = os.path.join(classdir, name + '.class')
+        if os.path.exists(class_file):
+            os.remove(class_file)
+
+def _with_subclasses(state, changed):
+    """
+    The changed classes and the classes that extend or implement one of
+    them, directly or through other classes. Users of a subclass only refer
+    to the subclass, even when they use members it inherits.
+    """
+    result = set(changed)
+    classes = state['classes']
+    added = True
+    while added:
+        added = False
+        for name, entry in classes.items():
+            if name not in result and result.intersection(entry[3]):
+                result.add(name)
+                added = True
+    return result
+
+def _dependent_sources(state, changed):
+    """
+    The sources with a class that refers to one of the changed classes or
+    to one of their subclasses
+    """
+    result = set()
+    if not changed:
+        return result
+    changed = _with_subclasses(state, changed)
+    classes = state['classes']
+    for fname, (digest, names) in state['sources'].items():
+        for name in names:
+            if name in classes and classes[name][2] & changed:
+                result.add(fname)
+                break
+    return result
+
+def _compile_java(env, command, classdir, fnames, state, version, show):
+    """
+    Compile fnames, replacing their classes in state, showing the javac
+    command line if show is set. Returns the javac exit status, the classes
+    whose API changed or that went away and whether any compile-time
+    constant changed.
+    """
+    sources = state['sources']
+    classes = state['classes']
+    old_classes = {}
+    keys = {}
+    digests = {}
+    for fname in fnames:
+        digests[fname] = _cached_file_digest(fname)
+        entry = sources.pop(fname, None)
+        if entry:
+            # removed first, so that classes deleted from the source go away
+            _remove_classes(classdir, entry[1])
+            for name in entry[1]:
+                if name in classes:
+                    old_classes[name] = classes.pop(name)
+        pkg_dir = cached_parse_java_file(fname, version)[0] or ''
+        keys[os.path.join(pkg_dir, os.path.basename(fname))] = fname
+
+    fnames = sorted(fnames)
+    if show:
+        print ' '.join(command + [os.path.relpath(f) for f in fnames])
+    fd, argfile = tempfile.mkstemp(suffix='.sources')
+    try:
+        os.write(fd, '\n'.join('"%s"' % f if ' ' in f else f for f in fnames))
+        os.close(fd)
+        status = subprocess.call(command + ['@' + argfile],
+                                 env=_tool_environ(env))
+    finally:
+        os.remove(argfile)
+    if status:
+        # the failed sources stay out of the state and are compiled again
+        return status, None, False
+
+    owned = set()
+    for digest, names in sources.values():
+        owned.update(names)
+    produced = {}
+    for pkg_dir in set(os.path.dirname(key) for key in keys):
+        dirname = os.path.join(classdir, pkg_dir)
+        if not os.path.isdir(dirname):
+            continue
+        for entry in os.listdir(dirname):
+            name = os.path.join(pkg_dir, entry[:-6]).replace(os.sep, '/')
+            if not entry.endswith('.class') or name in owned:
+                continue
+            name, source_file, refs, api, constants, supers = (
+                    read_class_file(os.path.join(dirname, entry)))
+            if not source_file:
+                source_file = name.split('/')[-1].split('$')[0] + '.java'
+            fname = keys.get(os.path.join(pkg_dir, source_file))
+            if fname:
+                produced.setdefault(fname, []).append(name)
+                classes[name] = (api, constants, refs, supers)
+    for fname in fnames:
+        sources[fname] = (digests[fname], sorted(produced.get(fname, [])))
+
+    changed = set()
+    constants_changed = False
+    for name, (api, constants, refs, supers) in old_classes.items():
+        if name not in classes or classes[name][0] != api:
+            changed.add(name)
+        if constants and classes.get(name, (None, None))[1] != constants:
+            constants_changed = True
+    return 0, changed, constants_changed
+
+def incremental_javac(target, source, env):
+    """
+    Compile only the Java sources that changed since the last build, and
+    the sources with classes using the API of a class that changed, until
+    no more APIs change. The classes each source produced, their API
+    digests and the classes they refer to, read from the constant pools,
+    are kept next to the classes directory. javac copies compile-time
+    constants into the classes that use them, leaving no reference behind,
+    so changing a constant, such as a resource ID in R.java, recompiles
+    every source but the generated ones, which only come from the
+    resources. The API of a class includes what it inherits, so the users
+    of its subclasses are recompiled too.
+    """
+    classdir = target[0].attributes.java_classdir.abspath
+    state_file = classdir + '.deps'
+    command = [str(arg) for arg in env.subst_list(_INCREMENTAL_JAVACCOM, 0,
+                                                  target, source)[0]]
+    version = env.get('JAVAVERSION', '1.4')
+    # R.java and the other generated sources are only on the source path
+    generated = set()
+    for root, dirs, files in os.walk(env.Dir(env['GEN']).abspath):
+        generated.update(os.path.join(root, f) for f in files
+                         if f.endswith('.java'))
+    fnames = set(s.rfile().abspath for s in source) | generated
+
+    state = _load_javac_state(state_file)
+    if state['command'] != command:
+        state = _new_javac_state(command)
+    changed = set()
+    for fname in set(state['sources']) - fnames:
+        names = state['sources'].pop(fname)[1]
+        _remove_classes(classdir, names)
+        for name in names:
+            state['classes'].pop(name, None)
+        changed.update(names)
+    dirty = set()
+    for fname in fnames:
+        entry = state['sources'].get(fname)
+        if (not entry or entry[0] != _cached_file_digest(fname) or
+            [name for name in entry[1] if not os.path.exists(
+                    os.path.join(classdir, name + '.class'))]):
+            dirty.add(fname)
+    dirty.update(_dependent_sources(state, changed))
+
+    # with $JAVACCOMSTR set that is shown instead, by incremental_javac_string
+    show = not env.GetOption('silent') and not env.subst('$JAVACCOMSTR')
+    status = 0
+    while dirty:
+        status, changed, constants_changed = _compile_java(
+                env, command, classdir, dirty, state, version, show)
+        if status:
+            break
+        next_dirty = _dependent_sources(state, changed)
+        if constants_changed:
+            next_dirty.update(fnames - generated)
+        # sources compiled together already saw each other's new API
+        dirty = next_dirty - dirty
+    _save_javac_state(state_file, state)
+    return status
+
+def incremental_javac_string(target, source, env):
+    """
+    Show $JAVACCOMSTR for incremental_javac, if set. Otherwise
+    incremental_javac shows each javac command line it runs, as only it
+    knows which sources they compile.
+    """
+    return env.subst('$JAVACCOMSTR', 0, target, source) or None
+
 # monkey patch emit_java_classes to do the Right Thing
 # otherwise generated classes have no package name and get rebuilt always
 
@@ -268,7 +2428,7 @@ def emit_java_classes(target, source, env):
                     env['APP_PACKAGE'].replace('.', '/'), entry.name))
             if os.path.exists(java_file.abspath):
                 version = env.get('JAVAVERSION', '1.4')
-                pkg_dir, classes = parse_java_file(
+                pkg_dir, classes = cached_parse_java_file(
                                 java_file.rfile().get_abspath(), version)
                 for output in classes:
                     class_file = classdir.File(
@@ -299,6 +2459,9 @@ def AndroidApp(env, name,
                resources='#/res',
                native_folder=None):
     """ Create an Android application from the given inputs. """
+    use_metadata_cache(env)
+    use_trace(env)
+    use_jobserver(env)
     android_manifest = env.File(manifest)
 
     if 'ANDROID_TARGET' not in env:
@@ -315,20 +2478,27 @@ def AndroidApp(env, name,
     gen_name = safe_name + '_gen'
     rfile = os.path.join(gen_name, get_rfile(package))
     gen = env.Dir(gen_name)
+    gen_staging = env.Dir(gen_name + '.staging')
 
-    # generate R.java
+    # generate R.java and the resource package in a single aapt run
     resource_dirs = [env.Dir(r) for r in env.Flatten([resources])]
     abs_resources = [r.abspath for r in resource_dirs]
     res_string = ''
-    aapt_args = 'package -f -m -M $MANIFEST -I $ANDROID_JAR -J $GEN'
+    aapt_args = ('package -f -m -M $MANIFEST -I $ANDROID_JAR -J $GEN_STAGING '
+                 '-F ${TARGETS[1]}')
     for tmp in range(0, len(abs_resources)):
         res_string += ' -S ${RES[%d]}' % tmp
     aapt_args += res_string
-    generated_rfile = env.Aapt(rfile, resource_dirs,
+    generated_rfile, tmp_package = env.Aapt([rfile, name + '.ap_'],
+             resource_dirs,
              MANIFEST=android_manifest.path,
-             GEN=gen, RES=abs_resources,
+             GEN=gen, GEN_STAGING=gen_staging, RES=abs_resources,
              AAPT_ARGS=aapt_args.split())
-    env.Depends(generated_rfile, android_manifest)
+    env.Depends([generated_rfile, tmp_package], android_manifest)
+    # R.java is only rewritten when its contents change, keep the old copy
+    # around so that its timestamp survives a rebuild
+    env.Precious(generated_rfile)
+    env.Clean(generated_rfile, gen_staging)
 
     release_build = env['ANDROID_KEY_STORE'] and env['ANDROID_KEY_NAME']
     dex = []
@@ -342,12 +2512,27 @@ def AndroidApp(env, name,
         default_cp += os.pathsep + '$ANDROID_SDK/tools/support/annotations.jar'
         if type(source) == str:
             source = [source]
+        java_args = {}
+        if env['ANDROID_INCREMENTAL_JAVAC']:
+            java_args['JAVACCOM'] = Action(incremental_javac,
+                    strfunction=incremental_javac_string,
+                    varlist=['JAVAC', 'JAVACFLAGS', 'JAVABOOTCLASSPATH',
+                             'JAVACLASSPATH', 'JAVASOURCEPATH'])
+            java_args['GEN'] = gen
         classes = env.Java(target=bin_classes, source=source,
                            JAVABOOTCLASSPATH='$ANDROID_JAR',
                            JAVASOURCEPATH=gen.path,
                            JAVACFLAGS='-target 1.5 -source 1.5 -g -Xlint -encoding ascii'.split(),
-                           JAVACLASSPATH=default_cp)
-        env.Depends(classes, rfile)
+                           JAVACLASSPATH=default_cp, **java_args)
+        env.Depends(classes, generated_rfile)
+        if env['ANDROID_INCREMENTAL_JAVAC']:
+            # only the recompiled classes are written, keep the others
+            env.Precious(classes)
+            # and run again when a source goes away, to remove its classes
+            if classes:
+                env.Depends(classes, env.Value(
+                        sorted(str(s) for s in classes[0].sources)))
+            env.Clean(classes, env.Dir(bin_classes).abspath + '.deps')
 
         # dex file from classes
         dex_input = classes
@@ -356,11 +2541,19 @@ def AndroidApp(env, name,
         has_pg = 'PROGUARD_CONFIG' in env and env['PROGUARD_CONFIG']
         if release_build and has_pg:
             dex_input = do_proguard(env, safe_name, classes, bin_classes, gen)
-            dx_dir = dex_input
+            # a copy, the classpath jars are added to dex_input below
+            dx_dir = list(dex_input)
+        elif env['ANDROID_INCREMENTAL_DEX']:
+            dex_input = dex_packages(env, safe_name, package, bin_classes,
+                                     classes, generated_rfile)
+            dx_dir = list(dex_input)
 
         if has_cp:
-            env['DX_CLASSPATH'] = env['JAVACLASSPATH'].split(os.pathsep)
-            dex_input.extend(env['DX_CLASSPATH'])
+            dx_classpath = env['JAVACLASSPATH'].split(os.pathsep)
+            if env['ANDROID_PREDEX']:
+                dx_classpath = [predex_jar(env, jar) for jar in dx_classpath]
+            env['DX_CLASSPATH'] = dx_classpath
+            dex_input.extend(dx_classpath)
 
         dex = env.Dex(name+'classes.dex', dex_input, DX_DIR=dx_dir)
         env.Depends(dex, dex_input)
@@ -369,15 +2562,6 @@ def AndroidApp(env, name,
         # assume this is a native-only project..
         native_folder = 'libs'
 
-    # resources
-    aapt_args = 'package -f -m -M $MANIFEST -I $ANDROID_JAR -F $TARGET '
-    aapt_args += res_string
-    tmp_package = env.Aapt(name + '.ap_', resource_dirs,
-                  MANIFEST=android_manifest.path,
-                  RES=abs_resources,
-                  AAPT_ARGS=aapt_args.split())
-    env.Depends(tmp_package, android_manifest)
-
     # package java -classpath jarutils.jar:androidprefs.jar:apkbuilder.jar \
     #           com.android.apkbuilder.ApkBuilder
     # >> name-debug-unaligned.apk
@@ -394,11 +2578,33 @@ def AndroidApp(env, name,
     if native_folder:
         apk_args += ' -nf $NATIVE_FOLDER'
         native_path = env.Dir(native_folder).path
-    unaligned = env.ApkBuilder(outname, [dex, tmp_package],
-                   NATIVE_FOLDER=native_path,
-                   UNSIGNED=unsigned_flag,
-                   AP=tmp_package,
-                   APK_ARGS=apk_args.split())
+    incremental_apk = env['ANDROID_INCREMENTAL_APK']
+    python_packaging = env['ANDROID_PYTHON_PACKAGING'] or incremental_apk
+    debug_signing = False
+    # ApkBuilder creates the debug key the first time, jarsigner can not
+    if (incremental_apk and not env['ANDROID_KEY_STORE'] and
+        not os.path.exists(env.subst('$ANDROID_DEBUG_KEY_STORE'))):
+        incremental_apk = False
+    if python_packaging and (env['ANDROID_KEY_STORE'] or incremental_apk):
+        # no need for the Java ApkBuilder. Debug builds are signed with the
+        # debug key by jarsigner instead, and without a signature to add the
+        # result is already aligned and final.
+        if not env['ANDROID_KEY_STORE']:
+            outname = name + '-debug-unsigned.apk'
+            debug_signing = True
+        elif not release_build:
+            outname = finalname
+        unaligned = env.AssembleApk(outname, [tmp_package, dex],
+                                    NATIVE_FOLDER=native_path)
+        if incremental_apk:
+            # the previous APK is the starting point for the next one
+            env.Precious(unaligned)
+    else:
+        unaligned = env.ApkBuilder(outname, [dex, tmp_package],
+                       NATIVE_FOLDER=native_path,
+                       UNSIGNED=unsigned_flag,
+                       AP=tmp_package,
+                       APK_ARGS=apk_args.split())
     if native_folder:
         sofiles = env.Glob(native_folder + '/armeabi/*.so')
         sofiles.extend(env.Glob(native_folder + '/armeabi-v7a/*.so'))
@@ -406,30 +2612,67 @@ def AndroidApp(env, name,
         env.Depends(unaligned, env.Flatten([dex, tmp_package, sofiles]))
     else:
         env.Depends(unaligned, [dex, tmp_package])
-    env.Depends(unaligned, env.subst('$APK_BUILDER_JAR').split())
     if release_build:
         unaligned = env.JarSigner(name + '-unaligned.apk', unaligned)
+    elif debug_signing:
+        unaligned = env.JarSigner(name + '-debug-unaligned.apk', unaligned,
+                                  ANDROID_KEY_STORE='$ANDROID_DEBUG_KEY_STORE',
+                                  ANDROID_KEY_NAME='androiddebugkey',
+                                  JARSIGNER_FLAGS=['-sigalg', 'SHA1withRSA',
+                                                   '-digestalg', 'SHA1',
+                                                   '-storepass', 'android',
+                                                   '-keypass', 'android'])
 
-    # zipalign -f 4 unaligned aligned
-    app = env.ZipAlign(finalname, unaligned)
-    # installation marker
-    adb = env['ANDROID_ADB']
-    adb_install = env.Command(name + '-installed', app,
-        [adb + ' install -r $SOURCE && date > $TARGET'])
-    # do not run by default
-    env.Ignore(adb_install[0].dir, adb_install)
-    env.Alias('install', adb_install)
-
+    if outname == finalname:
+        app = unaligned
+    elif python_packaging:
+        app = env.PyZipAlign(finalname, unaligned)
+    else:
+        # zipalign -f 4 unaligned aligned
+        app = env.ZipAlign(finalname, unaligned)
+    if env.get('ANDROID_TRACE'):
+        label_trace(name, app)
     if 'APP_ACTIVITY' not in env:
         activity = get_android_name(android_manifest.abspath)
     else:
         activity = env['APP_ACTIVITY']
-    run = env.Command(name + '-run', app,
-      [adb + ' shell am start -a android.intent.action.MAIN -n %s/%s%s'%(
-          package, package, activity)])
-    env.Depends(run, adb_install)
-    env.Ignore(run[0].dir, run)
-    env.Alias('run', run)
+    component = '%s/%s%s' % (package, package, activity)
+
+    devices = android_devices(env)
+    if not devices:
+        # installation marker
+        adb = env['ANDROID_ADB']
+        adb_install = env.Command(name + '-installed', app,
+            [adb + ' install -r $SOURCE && date > $TARGET'])
+        # do not run by default
+        env.Ignore(adb_install[0].dir, adb_install)
+        env.Alias('install', adb_install)
+
+        run = env.Command(name + '-run', app,
+          [adb + ' shell am start -a android.intent.action.MAIN -n ' +
+           component])
+        env.Depends(run, adb_install)
+        env.Ignore(run[0].dir, run)
+        env.Alias('run', run)
+
+    # one installation marker per device, install and run fan out over all
+    # of them with scons -j
+    for serial in devices:
+        safe_serial = serial.replace(':', '_').replace(os.sep, '_')
+        adb_install = env.AdbInstall('%s-installed-%s' % (name, safe_serial),
+                                     app, DEVICE_SERIAL=serial,
+                                     APP_PACKAGE_NAME=package)
+        env.Ignore(adb_install[0].dir, adb_install)
+        env.Clean(adb_install, adb_install[0].abspath + '.apk')
+        env.Alias('install', adb_install)
+        env.Alias('install-' + serial, adb_install)
+
+        run = env.AdbRun('%s-run-%s' % (name, safe_serial), app,
+                         DEVICE_SERIAL=serial, APP_COMPONENT=component)
+        env.Depends(run, adb_install)
+        env.Ignore(run[0].dir, run)
+        env.Alias('run', run)
+        env.Alias('run-' + serial, run)
 
     return app
 
@@ -459,6 +2702,12 @@ def generate(env, **kw):
     if 'ANDROID_KEY_NAME' not in env:
         env['ANDROID_KEY_NAME'] = ''
 
+    if 'ANDROID_METADATA_CACHE' not in env:
+        env['ANDROID_METADATA_CACHE'] = ''
+
+    if 'ANDROID_TRACE' not in env:
+        env['ANDROID_TRACE'] = ''
+
     env.Tool('javac')
     env.Tool('jar')
     env['AAPT'] = '$ANDROID_SDK/platform-tools/aapt'
@@ -468,49 +2717,158 @@ def generate(env, **kw):
     env['ANDROID_JAR'] = os.path.join('$ANDROID_SDK',
                               'platforms/android-$ANDROID_TARGET/android.jar')
     env['ANDROID_ADB'] = os.path.join('$ANDROID_SDK','platform-tools/adb')
+    if 'ANDROID_ADB_PORT' not in env:
+        env['ANDROID_ADB_PORT'] = os.environ.get('ANDROID_ADB_SERVER_PORT',
+                                                 '5037')
+    if 'ANDROID_DEVICES' not in env:
+        env['ANDROID_DEVICES'] = ''
+    if 'ANDROID_DELTA_INSTALL' not in env:
+        env['ANDROID_DELTA_INSTALL'] = False
+    bld = Builder(action=Action(adb_install,
+                                'adb -s $DEVICE_SERIAL install -r $SOURCE'))
+    env.Append(BUILDERS = { 'AdbInstall': bld })
+    bld = Builder(action=Action(adb_run,
+                                'adb -s $DEVICE_SERIAL shell am start '
+                                '-a android.intent.action.MAIN -n '
+                                '$APP_COMPONENT'))
+    env.Append(BUILDERS = { 'AdbRun': bld })
 
-    bld = Builder(action='$AAPT $AAPT_ARGS', suffix='.java',
-                  source_scanner=DirScanner)
+    bld = Builder(action=[Action(make_staging_dir, None),
+                          '$AAPT $AAPT_ARGS',
+                          Action(sync_generated, None)],
+                  suffix='.java',
+                  source_scanner=ResourceScanner)
     env.Append(BUILDERS = { 'Aapt': bld })
 
-    bld = Builder(action='$DX --dex --output=$TARGET $DX_DIR $DX_CLASSPATH', suffix='.dex')
+    if 'ANDROID_TOOL_SERVER' not in env:
+        env['ANDROID_TOOL_SERVER'] = False
+    env['ANDROID_TOOL_SERVER_FLAGS'] = '-Xmx1024M'
+    env['DX_JAR'] = '$ANDROID_SDK/platform-tools/lib/dx.jar'
+    dx_main = 'com.android.dx.command.Main'
+
+    dx_args = '--dex --output=$TARGET $DX_DIR $DX_CLASSPATH'
+    bld = Builder(action=JavaToolAction('$DX ' + dx_args,
+                                        dx_main, '$DX_JAR', dx_args),
+                  suffix='.dex')
     env.Append(BUILDERS = { 'Dex': bld })
+
+    if 'ANDROID_PREDEX' not in env:
+        env['ANDROID_PREDEX'] = False
+    env['ANDROID_PREDEX_DIR'] = '#predex'
+    dx_args = '--dex --output=$TARGET $SOURCE'
+    bld = Builder(action=JavaToolAction('$DX ' + dx_args,
+                                        dx_main, '$DX_JAR', dx_args),
+                  suffix='.jar')
+    env.Append(BUILDERS = { 'PreDex': bld })
+
+    if 'ANDROID_INCREMENTAL_DEX' not in env:
+        env['ANDROID_INCREMENTAL_DEX'] = False
+
+    if 'ANDROID_INCREMENTAL_JAVAC' not in env:
+        env['ANDROID_INCREMENTAL_JAVAC'] = False
+
+    dx_args = '--dex --no-strict --output=$TARGET $PACKAGE_DIR/*.class'
+    bld = Builder(action=JavaToolAction('$DX ' + dx_args,
+                                        dx_main, '$DX_JAR', dx_args),
+                  suffix='.jar')
+    env.Append(BUILDERS = { 'DexClasses': bld })
     env['JAVA'] = 'java'
 
     cpfiles = os.pathsep.join(os.path.join('$ANDROID_SDK', 'tools/lib', jar)
                               for jar in 'androidprefs.jar sdklib.jar'.split())
 
     env['APK_BUILDER_CP'] = cpfiles
-    base = os.path.join(os.path.dirname(__file__))
-    j = env.Java(target='toolclasses',
-             source=[base + '/sdklib/ApkBuilderMain.java'],
-             JAVACLASSPATH='$APK_BUILDER_CP',
-             JAVASOURCEPATH=env.Dir('#site_scons/site_tools').path)
-    env['APK_BUILDER_JAR'] = j
-
-    apk_builder = ('$JAVA -classpath $TOOL_CLASSES_DIR:$APK_BUILDER_CP '
-                   'android.sdklib.ApkBuilderMain $TARGET $APK_ARGS')
-    bld = Builder(action=apk_builder,
+    if 'ANDROID_TOOL_CACHE' not in env:
+        env['ANDROID_TOOL_CACHE'] = os.path.join(os.path.expanduser('~'),
+                                                 '.android', 'scons-tools')
+    # worked out when used, so ANDROID_TOOL_CACHE can be set after the tool
+    env['_tool_classes_dir'] = tool_classes_dir
+    env['ANDROID_TOOL_CLASSES'] = '${_tool_classes_dir(__env__)}'
+
+    apk_builder_cp = '$ANDROID_TOOL_CLASSES:$APK_BUILDER_CP'
+    apk_builder_args = '$TARGET $APK_ARGS'
+    apk_builder = ('$JAVA -classpath %s android.sdklib.ApkBuilderMain %s' %
+                   (apk_builder_cp, apk_builder_args))
+    bld = Builder(action=JavaToolAction(apk_builder,
+                                        'android.sdklib.ApkBuilderMain',
+                                        apk_builder_cp, apk_builder_args,
+                                        uses_tool_classes=True),
                   source_scanner=DirScanner,
-                  TOOL_CLASSES_DIR=env.Dir('toolclasses'),
                   suffix='.apk')
     env.Append(BUILDERS = { 'ApkBuilder': bld })
 
     bld = Builder(action='$ZIPALIGN -f 4 $SOURCE $TARGET')
     env.Append(BUILDERS = { 'ZipAlign': bld })
 
+    if 'ANDROID_PYTHON_PACKAGING' not in env:
+        env['ANDROID_PYTHON_PACKAGING'] = False
+    if 'ANDROID_INCREMENTAL_APK' not in env:
+        env['ANDROID_INCREMENTAL_APK'] = False
+    env['ANDROID_DEBUG_KEY_STORE'] = os.path.join(os.path.expanduser('~'),
+                                                  '.android', 'debug.keystore')
+    bld = Builder(action=Action(zipalign, 'zipalign $SOURCE $TARGET'))
+    env.Append(BUILDERS = { 'PyZipAlign': bld })
+    bld = Builder(action=Action(assemble_apk, 'Assembling $TARGET',
+                                varlist=['NATIVE_FOLDER',
+                                         'ANDROID_INCREMENTAL_APK']),
+                  suffix='.apk')
+    env.Append(BUILDERS = { 'AssembleApk': bld })
+
     jarsigner_cmd = ('$JARSIGNER $JARSIGNER_FLAGS -keystore $ANDROID_KEY_STORE'
                      ' -signedjar $TARGET $SOURCE $ANDROID_KEY_NAME')
     env.Append(BUILDERS = { 'JarSigner': Builder(action=jarsigner_cmd) })
 
-    proguard_cmd = ('$JAVA -jar $ANDROID_SDK/tools/proguard/lib/proguard.jar'
-                    ' -injars ${PS.join([s.path for s in SOURCES])}'
-                    ' -outjars $TARGET '
-                    ' $PROGUARD_ARGS')
-    env.Append(BUILDERS = {'Proguard': Builder(action=proguard_cmd)})
+    proguard_jar = '$ANDROID_SDK/tools/proguard/lib/proguard.jar'
+    proguard_args = ('-injars ${PS.join([s.path for s in SOURCES])}'
+                     ' -outjars $TARGET '
+                     ' $PROGUARD_ARGS')
+    proguard_cmd = '$JAVA -jar %s %s' % (proguard_jar, proguard_args)
+    bld = Builder(action=JavaToolAction(proguard_cmd, 'proguard.ProGuard',
+                                        proguard_jar, proguard_args))
+    env.Append(BUILDERS = {'Proguard': bld})
+
+    if 'NDK_MODULE_PATH' not in env:
+        env['NDK_MODULE_PATH'] = os.environ.get('NDK_MODULE_PATH', '')
+    env['NDK_MODULE_DIR'] = '#ndk-modules'
+    if 'NDK_JOBSERVER' not in env:
+        env['NDK_JOBSERVER'] = False
+    if 'NDK_COMPILE_CACHE' not in env:
+        env['NDK_COMPILE_CACHE'] = ''
+    if 'NDK_COMPILE_CACHE_SIZE' not in env:
+        env['NDK_COMPILE_CACHE_SIZE'] = 1024
+    # keeps the line markers, as __LINE__ and debug info depend on them
+    env['NDK_SHCCPPCOM'] = '$SHCC -E $SHCFLAGS $SHCCFLAGS $_CCCOMCOM $SOURCES'
+    env['NDK_SHCXXPPCOM'] = ('$SHCXX -E $SHCXXFLAGS $SHCCFLAGS $_CCCOMCOM '
+                             '$SOURCES')
+    cc_action = CachedCompileAction('$SHCCCOM', '$NDK_SHCCPPCOM',
+                                    cmdstr='$SHCCCOMSTR')
+    cxx_action = CachedCompileAction('$SHCXXCOM', '$NDK_SHCXXPPCOM',
+                                     cmdstr='$SHCXXCOMSTR')
+    bld = Builder(action={'.c': cc_action,
+                          '.cpp': cxx_action,
+                          '.cc': cxx_action,
+                          '.cxx': cxx_action,
+                          '.s': Action('$ASCOM', '$ASCOMSTR'),
+                          '.S': Action('$ASPPCOM', '$ASPPCOMSTR')},
+                  emitter=SharedObjectEmitter,
+                  suffix='$SHOBJSUFFIX',
+                  single_source=1,
+                  source_scanner=SourceFileScanner)
+    env.Append(BUILDERS = {'NdkObject': bld})
+
+    bld = Builder(action=[Copy('$TARGET', '$SOURCE'),
+                          '$STRIP --strip-unneeded $TARGET'])
+    env.Append(BUILDERS = {'NdkStrip': bld})
+
+    # must use the same flags as $SHCXXCOM for gcc to accept the header
+    env['NDK_PCHCOM'] = ('$SHCXX -x c++-header -o $TARGET -c $SHCXXFLAGS '
+                         '$SHCCFLAGS $_CCCOMCOM $SOURCE')
+    bld = Builder(action='$NDK_PCHCOM', suffix='.gch')
+    env.Append(BUILDERS = {'NdkPch': bld})
 
     env.AddMethod(AndroidApp)
     env.AddMethod(NdkBuild)
+    env.AddMethod(NdkImportModule)
     env.AddMethod(NdkBuildLegacy)
 
 def exists(env):
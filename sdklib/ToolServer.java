@@ -0,0 +1,284 @@
+/*
+ * Licensed under the MIT license:
+ * http://www.opensource.org/licenses/mit-license.php
+ */
+
+package android.sdklib;
+
+import java.io.BufferedReader;
+import java.io.ByteArrayOutputStream;
+import java.io.File;
+import java.io.IOException;
+import java.io.InputStream;
+import java.io.InputStreamReader;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.net.InetAddress;
+import java.net.ServerSocket;
+import java.net.Socket;
+import java.net.URL;
+import java.net.URLClassLoader;
+import java.security.MessageDigest;
+import java.security.Permission;
+import java.util.ArrayList;
+import java.util.HashMap;
+import java.util.List;
+import java.util.Map;
+
+/**
+ * Long-lived JVM that runs the main method of Java build tools (dx,
+ * ApkBuilderMain, ProGuard) on behalf of SCons, saving the JVM start up and
+ * JIT warm up of a new process per tool invocation.
+ * <p/>
+ * The client first writes a secret token line to the server's stdin. The
+ * server then listens on a loopback port, which it prints on stdout once it
+ * is ready. Each connection sends one request as lines of text, and requests
+ * without the token are dropped, so other users of the machine cannot run
+ * code in the server:
+ * <pre>
+ * token
+ * working directory
+ * classpath
+ * main class
+ * number of arguments
+ * argument...
+ * </pre>
+ * The reply is the exit status on the first line, followed by everything the
+ * tool printed. The server exits when its stdin is closed.
+ */
+public final class ToolServer {
+
+    /** Set for the threads that run tool requests. */
+    private static final ThreadLocal<OutputStream> sOutput =
+            new ThreadLocal<OutputStream>();
+
+    /** One class loader per tool classpath. */
+    private static final Map<String, ClassLoader> sLoaders =
+            new HashMap<String, ClassLoader>();
+
+    /** Tools keep state in statics, so only one request per main class runs. */
+    private static final Map<String, Object> sLocks = new HashMap<String, Object>();
+
+    private static final String sWorkingDir = new File("").getAbsolutePath();
+
+    /** The token every request has to start with. */
+    private static byte[] sToken;
+
+    /** Thrown instead of exiting the JVM when a tool calls System.exit. */
+    private static final class ExitException extends SecurityException {
+        private static final long serialVersionUID = 1L;
+        final int status;
+
+        ExitException(int status) {
+            super("exit " + status);
+            this.status = status;
+        }
+    }
+
+    /** Sends output to the stream of the current request, if any. */
+    private static final class ThreadOutputStream extends OutputStream {
+        private final OutputStream mDefault;
+
+        ThreadOutputStream(OutputStream defaultStream) {
+            mDefault = defaultStream;
+        }
+
+        private OutputStream current() {
+            OutputStream out = sOutput.get();
+            return out == null ? mDefault : out;
+        }
+
+        @Override
+        public void write(int b) throws IOException {
+            current().write(b);
+        }
+
+        @Override
+        public void write(byte[] b, int off, int len) throws IOException {
+            current().write(b, off, len);
+        }
+
+        @Override
+        public void flush() throws IOException {
+            current().flush();
+        }
+    }
+
+    /** Turns System.exit calls made by tools into ExitExceptions. */
+    private static final class ExitSecurityManager extends SecurityManager {
+        @Override
+        public void checkPermission(Permission perm) {
+        }
+
+        @Override
+        public void checkExit(int status) {
+            if (sOutput.get() != null) {
+                throw new ExitException(status);
+            }
+        }
+    }
+
+    /** Exits the server when the client closes its stdin. */
+    private static final class StdinWatcher extends Thread {
+        @Override
+        public void run() {
+            try {
+                while (System.in.read() != -1) {
+                }
+            } catch (IOException e) {
+            }
+            System.exit(0);
+        }
+    }
+
+    /** Handles a single request. */
+    private static final class RequestThread extends Thread {
+        private final Socket mClient;
+
+        RequestThread(Socket client) {
+            mClient = client;
+        }
+
+        @Override
+        public void run() {
+            handle(mClient);
+        }
+    }
+
+    public static void main(String[] args) throws IOException {
+        String token = readLine(System.in);
+        if (token == null || token.length() == 0) {
+            System.err.println("ToolServer: no token on stdin");
+            System.exit(1);
+        }
+        sToken = token.getBytes("UTF-8");
+
+        ServerSocket server = new ServerSocket(0, 50,
+                InetAddress.getByName("127.0.0.1"));
+
+        System.setSecurityManager(new ExitSecurityManager());
+        PrintStream stdout = System.out;
+        System.setOut(new PrintStream(new ThreadOutputStream(stdout), true));
+        System.setErr(new PrintStream(new ThreadOutputStream(System.err), true));
+
+        Thread watcher = new StdinWatcher();
+        watcher.setDaemon(true);
+        watcher.start();
+
+        stdout.println(server.getLocalPort());
+        stdout.flush();
+
+        while (true) {
+            Thread thread = new RequestThread(server.accept());
+            thread.setDaemon(true);
+            thread.start();
+        }
+    }
+
+    private static void handle(Socket client) {
+        try {
+            BufferedReader in = new BufferedReader(
+                    new InputStreamReader(client.getInputStream(), "UTF-8"));
+            String token = in.readLine();
+            if (token == null
+                    || !MessageDigest.isEqual(sToken, token.getBytes("UTF-8"))) {
+                return;
+            }
+            String workingDir = in.readLine();
+            String classpath = in.readLine();
+            String mainClass = in.readLine();
+            int count = Integer.parseInt(in.readLine());
+            String[] args = new String[count];
+            for (int i = 0; i < count; i++) {
+                args[i] = in.readLine();
+            }
+
+            ByteArrayOutputStream output = new ByteArrayOutputStream();
+            int status;
+            if (!sWorkingDir.equals(workingDir)) {
+                // relative paths would resolve against the wrong directory
+                status = -1;
+            } else {
+                status = run(classpath, mainClass, args, output);
+            }
+
+            OutputStream out = client.getOutputStream();
+            out.write((status + "\n").getBytes("UTF-8"));
+            output.writeTo(out);
+            out.flush();
+        } catch (Exception e) {
+            e.printStackTrace();
+        } finally {
+            try {
+                client.close();
+            } catch (IOException e) {
+            }
+        }
+    }
+
+    /** Reads a line without buffering, so the rest stays in the stream. */
+    private static String readLine(InputStream stream) throws IOException {
+        StringBuilder line = new StringBuilder();
+        int c;
+        while ((c = stream.read()) != -1 && c != '\n') {
+            line.append((char) c);
+        }
+        if (c == -1 && line.length() == 0) {
+            return null;
+        }
+        return line.toString();
+    }
+
+    private static int run(String classpath, String mainClass, String[] args,
+            ByteArrayOutputStream output) throws Exception {
+        Method main = getLoader(classpath).loadClass(mainClass).getMethod(
+                "main", String[].class);
+        synchronized (getLock(mainClass)) {
+            sOutput.set(output);
+            try {
+                main.invoke(null, (Object) args);
+                return 0;
+            } catch (InvocationTargetException e) {
+                Throwable cause = e.getCause();
+                if (cause instanceof ExitException) {
+                    return ((ExitException) cause).status;
+                }
+                cause.printStackTrace();
+                return 1;
+            } finally {
+                System.out.flush();
+                System.err.flush();
+                sOutput.remove();
+            }
+        }
+    }
+
+    private static synchronized ClassLoader getLoader(String classpath)
+            throws IOException {
+        ClassLoader loader = sLoaders.get(classpath);
+        if (loader == null) {
+            List<URL> urls = new ArrayList<URL>();
+            for (String entry : classpath.split(File.pathSeparator)) {
+                if (entry.length() > 0) {
+                    urls.add(new File(entry).toURI().toURL());
+                }
+            }
+            // skip the server's own classpath, so each tool only sees its own
+            loader = new URLClassLoader(urls.toArray(new URL[urls.size()]),
+                    ClassLoader.getSystemClassLoader().getParent());
+            sLoaders.put(classpath, loader);
+        }
+        return loader;
+    }
+
+    private static synchronized Object getLock(String mainClass) {
+        Object lock = sLocks.get(mainClass);
+        if (lock == null) {
+            lock = new Object();
+            sLocks.put(mainClass, lock);
+        }
+        return lock;
+    }
+}
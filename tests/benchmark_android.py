@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license.php
+"""
+Benchmarks for the SCons Android tool. Builds generated projects with the
+fake tools from fakesdk.py, so no SDK or NDK is needed, and reports the
+clean, null and single-file incremental build times.
+
+The project size comes from the environment:
+BENCH_JAVA_CLASSES, BENCH_RESOURCES, BENCH_NATIVE_SOURCES and BENCH_ABIS.
+FAKE_TOOL_SCALE scales the cost of the fake tools, with 0 the times are the
+overhead of SCons and the tool alone.
+"""
+
+import sconstester
+import fakeadb
+import fakesdk
+import os
+import sys
+import time
+from test_android import create_resources, create_standard_manifest
+
+def bench_size(name, default):
+    """ Get a project size from the environment """
+    return int(os.environ.get(name, default))
+
+def java_class(package, number, extra=''):
+    return '''package %s;
+public class Class%d {
+    static class Holder {
+        static final int VALUE = %d;
+    }
+    public int value() { return Holder.VALUE; }%s
+}
+''' % (package, number, number, extra)
+
+def change_java_class(tester):
+    """ Edit the first generated Java class """
+    tester.write_file('src/com/example/android/p0/Class0.java',
+                      java_class('com.example.android.p0', 0,
+                                 '\n    public int more() { return 1; }'))
+
+def native_source(number, extra=''):
+    return '''#include "common.h"
+int function_%d(int x) { return COMMON(x) + %d; }%s
+''' % (number, number, extra)
+
+def layout(number, extra=''):
+    return '''<?xml version="1.0" encoding="utf-8"?>
+<LinearLayout xmlns:android="http://schemas.android.com/apk/res/android"
+    android:layout_width="fill_parent"
+    android:layout_height="fill_parent">
+    <TextView android:id="@+id/text_%d"
+        android:layout_width="wrap_content"
+        android:layout_height="wrap_content"
+        android:text="%d%s" />
+</LinearLayout>
+''' % (number, number, extra)
+
+def create_benchmark_project(tester, java_classes, resources, native_sources,
+                             abis, settings=''):
+    """
+    Generate an Android project with the given number of Java classes,
+    layout resources and native sources for each of the ABIs. settings are
+    extra lines for main.scons.
+    """
+    cwd = os.path.normpath(os.getcwd())
+    rootdir = os.path.normpath(os.path.join(cwd, '..'))
+    tester.write_file('SConstruct', '''
+from SCons import Tool
+Tool.DefaultToolpath.append('%s')
+SConscript('main.scons', variant_dir='build', duplicate=0)\n''' % rootdir)
+    create_resources(tester)
+    create_standard_manifest(tester)
+
+    tester.subdir('src/com/example/android')
+    tester.write_file('src/com/example/android/MyActivity.java', '''
+package com.example.android;
+public class MyActivity {}
+''')
+    # a few classes per package, like a real code base
+    for i in range(java_classes):
+        package = 'com.example.android.p%d' % (i / 20)
+        tester.subdir('src/' + package.replace('.', '/'))
+        tester.write_file('src/%s/Class%d.java' %
+                          (package.replace('.', '/'), i),
+                          java_class(package, i))
+    for i in range(resources):
+        tester.write_file('res/layout/layout_%d.xml' % i, layout(i))
+
+    tester.subdir('jni')
+    tester.write_file('jni/common.h', '#define COMMON(x) ((x) * 2)\n')
+    for i in range(native_sources):
+        tester.write_file('jni/source_%d.c' % i, native_source(i))
+
+    sdk, ndk, bindir = fakesdk.create_fake_sdk(
+            os.path.join(tester.basedir, 'fake'))
+    tester.write_file('main.scons', '''
+import os
+env = Environment(tools=['android'], ANDROID_SDK=%r, ANDROID_NDK=%r,
+                  ANDROID_TOOL_CACHE='#toolcache')
+env['JAVAC'] = %r
+env['JAVA'] = %r
+env['JARSIGNER'] = %r
+env['ENV']['FAKE_TOOL_SCALE'] = os.environ.get('FAKE_TOOL_SCALE', '1')
+%s
+if %d:
+    env.NdkBuild('libbench.so', Glob('jni/*.c'), app_abi=%r)
+env.AndroidApp('Bench', native_folder='libs')
+''' % (sdk, ndk, os.path.join(bindir, 'javac'), os.path.join(bindir, 'java'),
+       os.path.join(bindir, 'jarsigner'), settings, native_sources, abis))
+
+class AndroidBenchmark(sconstester.SConsTestCase):
+    """
+    Times builds of generated projects
+    """
+    def setUp(self):
+        sconstester.SConsTestCase.setUp(self)
+        self.timings = []
+
+    def tearDown(self):
+        self.report()
+        sconstester.SConsTestCase.tearDown(self)
+
+    def report(self):
+        """ Print the build times of the test """
+        if not self.timings:
+            return
+        lines = ['', self.id().split('.')[-1] + ' (seconds)']
+        for label, elapsed in self.timings:
+            lines.append('  %-24s %8.2f' % (label, elapsed))
+        sys.stderr.write('\n'.join(lines) + '\n')
+
+    def timed_scons(self, label, args=None):
+        """ Run scons, recording how long it took """
+        start = time.time()
+        result = self.run_scons(args)
+        self.timings.append((label, time.time() - start))
+        self.assertEquals(0, result.return_code)
+        return result
+
+    def assertUpToDate(self, result):
+        self.assertTrue("scons: `.' is up to date.\n" in result.out)
+
+    def benchmark(self, java_classes, resources, native_sources, abis):
+        """ Time the clean, null and incremental builds of a project """
+        create_benchmark_project(self, java_classes, resources, native_sources,
+                                 abis)
+        self.timed_scons('clean build', ['-j4'])
+        self.assertTrue(self.exists('Bench-debug.apk'))
+        for abi in abis.split():
+            self.assertTrue(self.apk_contains('Bench-debug.apk',
+                                              'lib/%s/libbench.so' % abi))
+        self.assertUpToDate(self.timed_scons('null build'))
+
+        if java_classes:
+            change_java_class(self)
+            self.timed_scons('one Java class', ['-j4'])
+        if resources:
+            self.write_file('res/layout/layout_0.xml', layout(0, ' changed'))
+            self.timed_scons('one resource', ['-j4'])
+        if native_sources:
+            self.write_file('jni/source_0.c', native_source(0, '\nint more;'))
+            self.timed_scons('one native source', ['-j4'])
+        self.assertUpToDate(self.timed_scons('null build again'))
+
+    def testJavaProject(self):
+        """
+        Time builds of a project with Java code and resources only
+        """
+        self.benchmark(bench_size('BENCH_JAVA_CLASSES', 200),
+                       bench_size('BENCH_RESOURCES', 50), 0, '')
+
+    def testNativeProject(self):
+        """
+        Time builds of a project with Java code and native code for several
+        ABIs
+        """
+        self.benchmark(bench_size('BENCH_JAVA_CLASSES', 200),
+                       bench_size('BENCH_RESOURCES', 50),
+                       bench_size('BENCH_NATIVE_SOURCES', 20),
+                       os.environ.get('BENCH_ABIS', 'armeabi armeabi-v7a x86'))
+
+    def testNullBuildScaling(self):
+        """
+        Time null builds of a project and of one four times its size, the
+        ratio shows how graph construction and scanning scale
+        """
+        java_classes = bench_size('BENCH_JAVA_CLASSES', 200)
+        resources = bench_size('BENCH_RESOURCES', 50)
+        native_sources = bench_size('BENCH_NATIVE_SOURCES', 20)
+        abis = os.environ.get('BENCH_ABIS', 'armeabi armeabi-v7a x86')
+        null_builds = []
+        for scale in (1, 4):
+            create_benchmark_project(self, java_classes * scale,
+                                     resources * scale, native_sources * scale,
+                                     abis)
+            self.run_scons(['-j4'])
+            self.assertUpToDate(self.timed_scons('null build x%d' % scale))
+            null_builds.append(self.timings[-1][1])
+        self.timings.append(('null build ratio',
+                             null_builds[1] / null_builds[0]))
+
+    def testInstall(self):
+        """
+        Time installing to a fake device after a clean build and after a
+        single Java change
+        """
+        adb = fakeadb.FakeAdb(['emulator-5554'])
+        try:
+            create_benchmark_project(self,
+                                     bench_size('BENCH_JAVA_CLASSES', 200),
+                                     bench_size('BENCH_RESOURCES', 50), 0, '',
+                                     "env['ANDROID_ADB_PORT'] = %d\n"
+                                     "env['ANDROID_DELTA_INSTALL'] = True" %
+                                     adb.port)
+            self.timed_scons('clean install', ['-j4', 'install'])
+            change_java_class(self)
+            self.timed_scons('install one change', ['-j4', 'install'])
+            apk = self.get_file('Bench-debug.apk').read()
+            self.assertEquals(apk, adb.installed['emulator-5554'])
+        finally:
+            adb.stop()
+
+if __name__ == '__main__':
+    sconstester.main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license.php
+"""
+A stand-in for the adb server, for testing installs without real devices
+"""
+
+import SocketServer
+import struct
+import threading
+
+class FakeAdbHandler(SocketServer.BaseRequestHandler):
+    """
+    Handles one client connection using the adb server protocol
+    """
+    def recv(self, size):
+        """ Read exactly size bytes, or return None if the client went away """
+        data = []
+        while size:
+            chunk = self.request.recv(size)
+            if not chunk:
+                return None
+            data.append(chunk)
+            size -= len(chunk)
+        return ''.join(data)
+
+    def okay(self, payload=None):
+        self.request.sendall('OKAY')
+        if payload is not None:
+            self.request.sendall('%04x%s' % (len(payload), payload))
+
+    def fail(self, message):
+        self.request.sendall('FAIL%04x%s' % (len(message), message))
+
+    def handle(self):
+        adb = self.server.adb
+        serial = None
+        while True:
+            length = self.recv(4)
+            if length is None:
+                return
+            request = self.recv(int(length, 16))
+            if request == 'host:devices':
+                listing = ''.join('%s\tdevice\n' % s for s in adb.serials)
+                self.okay(listing)
+                return
+            elif request.startswith('host:transport:'):
+                serial = request[len('host:transport:'):]
+                if serial not in adb.serials:
+                    self.fail('device not found')
+                    return
+                self.okay()
+            elif request.startswith('shell:'):
+                self.okay()
+                self.request.sendall(adb.shell(serial, request[len('shell:'):]))
+                return
+            elif request == 'sync:':
+                self.okay()
+                self.sync(serial)
+                return
+            else:
+                self.fail('unknown request ' + request)
+                return
+
+    def sync(self, serial):
+        """ Handle the file transfer sub-protocol """
+        adb = self.server.adb
+        path = None
+        data = []
+        while True:
+            header = self.recv(8)
+            if header is None:
+                return
+            command = header[:4]
+            length = struct.unpack('<L', header[4:])[0]
+            if command == 'SEND':
+                path = self.recv(length).split(',')[0]
+                data = []
+            elif command == 'DATA':
+                data.append(self.recv(length))
+            elif command == 'DONE':
+                adb.received(serial, path, ''.join(data))
+                self.request.sendall('OKAY' + struct.pack('<L', 0))
+            elif command == 'QUIT':
+                return
+
+class FakeAdb(object):
+    """
+    Pretends to be an adb server with the given devices attached. Records
+    the files pushed to each device, the shell commands run on it and the
+    packages installed.
+    """
+    def __init__(self, serials):
+        self.serials = serials
+        self.lock = threading.Lock()
+        self.files = {}
+        self.bytes_received = dict((s, 0) for s in serials)
+        self.commands = dict((s, []) for s in serials)
+        self.installed = {}
+        self.installs = dict((s, 0) for s in serials)
+        self.server = SocketServer.ThreadingTCPServer(('127.0.0.1', 0),
+                                                      FakeAdbHandler)
+        self.server.daemon_threads = True
+        self.server.adb = self
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def received(self, serial, path, data):
+        self.lock.acquire()
+        try:
+            self.files[(serial, path)] = data
+            self.bytes_received[serial] += len(data)
+        finally:
+            self.lock.release()
+
+    def read_file(self, serial, path):
+        """ Contents of a file on the device, installed APKs included """
+        if path.startswith('/data/app/'):
+            return self.installed.get(serial)
+        return self.files.get((serial, path))
+
+    def pipeline(self, serial, command):
+        """ Run the echo, cat, tail -c +N and head -c N commands of a pipe """
+        data = ''
+        for stage in command.split('|'):
+            args = stage.split()
+            if args[0] == 'echo':
+                data = ' '.join(args[1:]) + '\n'
+                continue
+            if args[0] in ('tail', 'head') and len(args) > 3 or args[0] == 'cat':
+                data = self.read_file(serial, args[-1])
+                if data is None:
+                    return '%s: No such file or directory\n' % args[-1]
+            if args[:2] == ['tail', '-c']:
+                data = data[int(args[2].lstrip('+')) - 1:]
+            elif args[:2] == ['head', '-c']:
+                data = data[:int(args[2])]
+        return data
+
+    def shell(self, serial, command):
+        """ Run a shell command on a pretend device, returning the output """
+        self.lock.acquire()
+        try:
+            return self.run(serial, command)
+        finally:
+            self.lock.release()
+
+    def run(self, serial, command):
+        self.commands[serial].append(command)
+        args = command.split()
+        if args[:2] == ['pm', 'install']:
+            path = args[-1]
+            if (serial, path) not in self.files:
+                return 'Failure [INSTALL_FAILED_INVALID_URI]\n'
+            self.installed[serial] = self.files[(serial, path)]
+            self.installs[serial] += 1
+            return 'Success\n'
+        elif args[:2] == ['pm', 'path']:
+            if serial in self.installed:
+                return 'package:/data/app/%s-1.apk\n' % args[2]
+            return ''
+        elif args[:2] == ['ls', '-l']:
+            data = self.read_file(serial, args[2])
+            if data is None:
+                return '%s: No such file or directory\n' % args[2]
+            # the install count stands in for the modification time
+            return '-rw-r--r-- 1 system system %d 2013-01-01 00:%02d %s\n' % (
+                len(data), self.installs[serial] % 60, args[2])
+        elif args[0] == 'rm':
+            for path in args[1:]:
+                self.files.pop((serial, path), None)
+            return ''
+        elif args[0] == 'sh':
+            script = self.files.get((serial, args[1]), '')
+            return ''.join(self.run(serial, line)
+                           for line in script.splitlines() if line)
+        elif args[0] == 'echo' and args[-2] == '>':
+            self.files[(serial, args[-1])] = ' '.join(args[1:-2]) + '\n'
+            return ''
+        elif args[:2] == ['am', 'start']:
+            return 'Starting: Intent { cmp=%s }\n' % args[-1]
+        elif args[-2] == '>>':
+            output = self.pipeline(serial, ' '.join(args[:-2]))
+            path = (serial, args[-1])
+            self.files[path] = self.files.get(path, '') + output
+            return ''
+        return self.pipeline(serial, command)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
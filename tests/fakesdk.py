@@ -0,0 +1,470 @@
+#!/usr/bin/env python
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license.php
+"""
+Stand-ins for the Android SDK, NDK and JDK tools, for benchmarking the tool
+without the real ones. Each fake tool writes outputs derived from its inputs,
+so results are deterministic, and sleeps for roughly what the real tool would
+cost. FAKE_TOOL_SCALE in the environment scales the costs, 0 leaves only the
+overhead of SCons and the tool itself.
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import socket
+import struct
+import sys
+import threading
+import time
+import zipfile
+
+# seconds per run and per input file for each kind of tool
+TOOL_COSTS = {
+    'aapt': (0.15, 0.001),
+    'javac': (0.6, 0.003),
+    'dx': (0.5, 0.002),
+    'apkbuilder': (0.4, 0.0),
+    'zipalign': (0.02, 0.0),
+    'jarsigner': (0.4, 0.0),
+    'cc': (0.08, 0.0),
+    'link': (0.05, 0.001),
+    'ar': (0.01, 0.001),
+    'strip': (0.01, 0.0),
+}
+
+# the NDK toolchains, as android.py expects them, and their tool prefixes
+_TOOLCHAINS = {
+    'arm-linux-androideabi-4.4.3': 'arm-linux-androideabi-',
+    'x86-4.4.3': 'i686-android-linux-',
+}
+
+_JAVA_COMMENT = re.compile(r'/\*.*?\*/|//[^\n]*', re.S)
+_JAVA_PACKAGE = re.compile(r'^\s*package\s+([\w.]+)\s*;', re.M)
+_JAVA_CLASS = re.compile(
+    r'\b(?:class|interface|enum)\s+(\w+)(?:\s+extends\s+(\w+))?')
+_RESOURCE_NAME = re.compile(r'<(\w+)\s+name="(\w+)"')
+_JAVA_IMPORT = re.compile(r'^\s*import\s+([\w.]+)\s*;', re.M)
+_JAVA_CONSTANT = re.compile(
+        r'\b(public\s+)?static\s+final\s+int\s+(\w+)\s*=\s*(\w+)\s*;')
+_JAVA_METHOD = re.compile(
+        r'\b(public|protected)\s+(?:static\s+)?[\w.\[\]]+\s+(\w+)\s*\(([^)]*)\)')
+_JAVA_TYPE = re.compile(r'\b([A-Z]\w*)\b')
+
+def spend(tool, inputs=0):
+    """ Take as long as the real tool would for this many inputs """
+    base, per_input = TOOL_COSTS[tool]
+    scale = float(os.environ.get('FAKE_TOOL_SCALE', '1'))
+    time.sleep((base + per_input * inputs) * scale)
+
+def digest(*fnames):
+    """ A signature of the contents of the files """
+    md5 = hashlib.md5()
+    for fname in fnames:
+        md5.update(open(fname, 'rb').read())
+    return md5.hexdigest()
+
+def write(fname, data):
+    """ Write data to fname, creating the directory if needed """
+    dirname = os.path.dirname(fname)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    output = open(fname, 'wb')
+    output.write(data)
+    output.close()
+
+def expand_args(args):
+    """ Replace @file arguments with the arguments in the file """
+    result = []
+    for arg in args:
+        if arg.startswith('@'):
+            result.extend(open(arg[1:]).read().split())
+        else:
+            result.append(arg)
+    return result
+
+def option(args, name, default=None):
+    """ The value after the option name in args """
+    if name in args:
+        return args[args.index(name) + 1]
+    return default
+
+def files_under(path, suffix=''):
+    """ The files in and below the directory path, or path if it is a file """
+    if os.path.isfile(path):
+        return [path]
+    result = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(suffix):
+                result.append(os.path.join(root, name))
+    return result
+
+def class_file(name, refs, constants, methods, source_file, body,
+               super_name='java/lang/Object'):
+    """
+    A minimal class file for the class name extending super_name, with the
+    referenced classes in its constant pool, the (public, name, value) int
+    constants, the (access, name, parameter count) methods and the body
+    digest as an attribute
+    """
+    pool = []
+    indexes = {}
+    def add(key, data):
+        if key not in indexes:
+            pool.append(data)
+            indexes[key] = len(pool)
+        return indexes[key]
+    def utf8(text):
+        return add(('utf8', text), struct.pack('>BH', 1, len(text)) + text)
+    def class_ref(ref):
+        return add(('class', ref), struct.pack('>BH', 7, utf8(ref)))
+
+    this_class = class_ref(name)
+    super_class = class_ref(super_name)
+    for ref in sorted(refs):
+        class_ref(ref)
+    fields = []
+    for public, field, value in constants:
+        value = add(('int', value), struct.pack('>Bi', 3, value))
+        fields.append(struct.pack('>HHHHHIH', public and 0x19 or 0x18,
+                                  utf8(field), utf8('I'), 1,
+                                  utf8('ConstantValue'), 2, value))
+    members = []
+    for access, method, params in methods:
+        members.append(struct.pack('>HHHH', access, utf8(method),
+                                   utf8('(%s)V' % ('I' * params)), 0))
+    attributes = (struct.pack('>HIH', utf8('SourceFile'), 2,
+                              utf8(source_file)) +
+                  struct.pack('>HI', utf8('SourceDebugExtension'), len(body)) +
+                  body)
+    return (struct.pack('>IHHH', 0xcafebabe, 0, 49, len(pool) + 1) +
+            ''.join(pool) +
+            struct.pack('>HHHH', 0x21, this_class, super_class, 0) +
+            struct.pack('>H', len(fields)) + ''.join(fields) +
+            struct.pack('>H', len(members)) + ''.join(members) +
+            struct.pack('>H', 2) + attributes)
+
+def javac(args):
+    """
+    Write a .class file for each class in each source. The capitalized
+    words in a source are taken as the classes it refers to.
+    """
+    classdir = option(args, '-d', '.')
+    sources = [arg for arg in args if arg.endswith('.java')]
+    spend('javac', len(sources))
+    for source in sources:
+        text = _JAVA_COMMENT.sub('', open(source).read())
+        package = _JAVA_PACKAGE.search(text)
+        package_dir = package and package.group(1).replace('.', '/') or ''
+        imports = dict((name.split('.')[-1], name.replace('.', '/'))
+                       for name in _JAVA_IMPORT.findall(text))
+        matches = list(_JAVA_CLASS.finditer(text))
+        names = [match.group(1) for match in matches]
+        # the first class is the top level one, the others are nested in it
+        # and own the text up to the next class
+        qualified = {}
+        for i, name in enumerate(names):
+            if i:
+                name = names[0] + '$' + name
+            qualified[names[i]] = '/'.join(filter(None, [package_dir, name]))
+        def resolve(word):
+            return (qualified.get(word) or imports.get(word) or
+                    '/'.join(filter(None, [package_dir, word])))
+        refs = set(resolve(word) for word in set(_JAVA_TYPE.findall(text)))
+        for i, match in enumerate(matches):
+            end = i + 1 < len(matches) and matches[i + 1].start() or len(text)
+            body = text[match.start():end]
+            constants = [(public, field, int(value, 0)) for public, field, value
+                         in _JAVA_CONSTANT.findall(body)]
+            methods = [(access == 'public' and 1 or 4, method,
+                        len(filter(None, params.split(','))))
+                       for access, method, params in _JAVA_METHOD.findall(body)]
+            name = qualified[names[i]]
+            super_name = match.group(2) and resolve(match.group(2))
+            write(os.path.join(classdir, name.replace('/', os.sep) + '.class'),
+                  class_file(name, refs - set([name]), constants, methods,
+                             os.path.basename(source),
+                             digest(source) + names[i],
+                             super_name or 'java/lang/Object'))
+    return 0
+
+def aapt(args):
+    """ Generate R.java and the resource package """
+    manifest = option(args, '-M')
+    gen = option(args, '-J')
+    package_file = option(args, '-F')
+    res_dirs = [args[i + 1] for i, arg in enumerate(args) if arg == '-S']
+    resources = []
+    for res_dir in res_dirs:
+        resources.extend(files_under(res_dir))
+    spend('aapt', len(resources))
+
+    package = re.search(r'package="([\w.]+)"', open(manifest).read()).group(1)
+    fields = {}
+    for resource in resources:
+        kind = os.path.basename(os.path.dirname(resource)).split('-')[0]
+        if kind == 'values':
+            for tag, name in _RESOURCE_NAME.findall(open(resource).read()):
+                fields.setdefault(tag, set()).add(name)
+        else:
+            name = os.path.splitext(os.path.basename(resource))[0]
+            fields.setdefault(kind, set()).add(name)
+    if gen:
+        lines = ['package %s;' % package, 'public final class R {']
+        number = 0x7f010000
+        for kind in sorted(fields):
+            lines.append('    public static final class %s {' % kind)
+            for name in sorted(fields[kind]):
+                lines.append('        public static final int %s=0x%x;' %
+                             (name, number))
+                number += 1
+            lines.append('    }')
+        lines.append('}')
+        write(os.path.join(gen, package.replace('.', os.sep), 'R.java'),
+              '\n'.join(lines) + '\n')
+    if package_file:
+        zip_file = zipfile.ZipFile(package_file, 'w', zipfile.ZIP_DEFLATED)
+        zip_file.write(manifest, 'AndroidManifest.xml')
+        for res_dir in res_dirs:
+            for resource in files_under(res_dir):
+                zip_file.write(resource, os.path.join(
+                    'res', os.path.relpath(resource, res_dir)))
+        zip_file.close()
+    return 0
+
+def dx(args):
+    """ Convert classes, directories and jars into a dex file or jar """
+    output = [arg for arg in args if arg.startswith('--output=')][0]
+    output = output[len('--output='):]
+    inputs = []
+    for arg in args:
+        if not arg.startswith('--'):
+            inputs.extend(files_under(arg))
+    for path in set(inputs):
+        if inputs.count(path) > 1:
+            sys.stderr.write('%s: already added\n' % path)
+            return 1
+    spend('dx', len(inputs))
+    data = digest(*inputs)
+    if output.endswith('.dex'):
+        write(output, data)
+    else:
+        zip_file = zipfile.ZipFile(output, 'w')
+        zip_file.writestr('classes.dex', data)
+        zip_file.close()
+    return 0
+
+def apk_builder(args):
+    """ Put the dex file, resource package and native libraries in an APK """
+    spend('apkbuilder')
+    output = args[0]
+    dex = option(args, '-f')
+    resources = option(args, '-z')
+    native = option(args, '-nf')
+    apk = zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED)
+    package = zipfile.ZipFile(resources)
+    for info in package.infolist():
+        apk.writestr(info, package.read(info.filename))
+    package.close()
+    if dex and dex.endswith('.dex'):
+        apk.write(dex, 'classes.dex')
+    if native:
+        for library in files_under(native, '.so'):
+            apk.write(library, os.path.join(
+                'lib', os.path.relpath(library, native)))
+    apk.close()
+    return 0
+
+# the main classes the fake tool server runs
+_SERVER_TOOLS = {
+    'com.android.dx.command.Main': dx,
+    'android.sdklib.ApkBuilderMain': apk_builder,
+}
+
+_SERVER_LOG_LOCK = threading.Lock()
+
+def server_log(message):
+    """ Append message to the file in FAKE_TOOL_SERVER_LOG, if set """
+    fname = os.environ.get('FAKE_TOOL_SERVER_LOG')
+    if not fname:
+        return
+    _SERVER_LOG_LOCK.acquire()
+    try:
+        log = open(fname, 'a')
+        log.write(message + '\n')
+        log.close()
+    finally:
+        _SERVER_LOG_LOCK.release()
+
+def serve_request(client, token):
+    """ Handle one connection to the fake tool server """
+    stream = client.makefile('rb')
+    def readline():
+        return stream.readline().rstrip('\n')
+    try:
+        if readline() != token:
+            server_log('rejected')
+            return
+        working_dir = readline()
+        classpath = readline()
+        main = readline()
+        args = [readline() for i in range(int(readline()))]
+        if working_dir != os.getcwd():
+            status = -1
+        elif main in _SERVER_TOOLS:
+            status = _SERVER_TOOLS[main](expand_args(args))
+        else:
+            # like an exception in the real server, no reply at all
+            server_log('failed ' + main)
+            return
+        server_log('ran ' + main)
+        client.sendall('%d\n' % status)
+    finally:
+        stream.close()
+        client.close()
+
+def tool_server():
+    """
+    Serve requests with the protocol of sdklib/ToolServer.java: a token on
+    stdin, the port on stdout and one request per connection
+    """
+    token = sys.stdin.readline().rstrip('\n')
+    if not token:
+        return 1
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(50)
+    sys.stdout.write('%d\n' % server.getsockname()[1])
+    sys.stdout.flush()
+    def watch_stdin():
+        while sys.stdin.read(1):
+            pass
+        os._exit(0)
+    watcher = threading.Thread(target=watch_stdin)
+    watcher.setDaemon(True)
+    watcher.start()
+    server_log('started')
+    while True:
+        client, address = server.accept()
+        thread = threading.Thread(target=serve_request, args=(client, token))
+        thread.setDaemon(True)
+        thread.start()
+
+def java(args):
+    """ Run the main class of a Java tool """
+    if '-classpath' in args:
+        options = args[:args.index('-classpath')]
+        for option_arg in options:
+            if not option_arg.startswith(('-Xm', '-D')):
+                sys.stderr.write('Unrecognized option: %s\n' % option_arg)
+                return 1
+        main = args[args.index('-classpath') + 2]
+        if main == 'android.sdklib.ToolServer':
+            return tool_server()
+        if main == 'android.sdklib.ApkBuilderMain':
+            return apk_builder(args[args.index(main) + 1:])
+    sys.stderr.write('fake java can not run %s\n' % ' '.join(args))
+    return 1
+
+def copy_tool(tool, source, target):
+    """ A tool whose output is a copy of its input """
+    spend(tool)
+    shutil.copyfile(source, target)
+    return 0
+
+def compiler(args):
+    """ Preprocess, compile or link like gcc """
+    output = option(args, '-o')
+    if '-E' in args:
+        source = args[-1]
+        sys.stdout.write(open(source).read())
+        return 0
+    if '-c' in args:
+        spend('cc')
+        source = args[-1]
+        flags = ' '.join(arg for arg in args if arg.startswith('-'))
+        write(output, digest(source) + hashlib.md5(flags).hexdigest())
+        return 0
+    inputs = [arg for arg in args if os.path.isfile(arg) and arg != output]
+    spend('link', len(inputs))
+    write(output, digest(*inputs))
+    return 0
+
+def archiver(args):
+    """ Create a static library like ar """
+    inputs = args[2:]
+    spend('ar', len(inputs))
+    write(args[1], digest(*inputs))
+    return 0
+
+def run_tool(tool, args):
+    """ Run the fake tool with the command line arguments args """
+    args = expand_args(args)
+    if tool == 'javac':
+        return javac(args)
+    elif tool == 'java':
+        return java(args)
+    elif tool == 'aapt':
+        return aapt(args)
+    elif tool == 'dx':
+        return dx(args)
+    elif tool == 'zipalign':
+        return copy_tool('zipalign', args[-2], args[-1])
+    elif tool == 'jarsigner':
+        return copy_tool('jarsigner', args[-2], option(args, '-signedjar'))
+    elif tool in ('gcc', 'g++', 'as'):
+        return compiler(args)
+    elif tool == 'ar':
+        return archiver(args)
+    elif tool == 'strip':
+        spend('strip')
+        return 0
+    elif tool in ('ranlib', 'objcopy'):
+        return 0
+    sys.stderr.write('unknown fake tool %s\n' % tool)
+    return 1
+
+def write_tool(fname, tool):
+    """ Write a script at fname that runs the fake tool """
+    write(fname, '#!/bin/sh\nexec "%s" "%s" %s "$@"\n' %
+          (sys.executable, os.path.abspath(__file__.replace('.pyc', '.py')),
+           tool))
+    os.chmod(fname, 0755)
+
+def create_fake_sdk(root, api_levels=(4, 9, 10)):
+    """
+    Create a fake SDK, NDK and JDK below root. Returns the SDK and NDK
+    directories and the directory holding javac, java and jarsigner.
+    """
+    sdk = os.path.join(root, 'sdk')
+    ndk = os.path.join(root, 'ndk')
+    bindir = os.path.join(root, 'bin')
+    write_tool(os.path.join(sdk, 'platform-tools', 'aapt'), 'aapt')
+    write_tool(os.path.join(sdk, 'platform-tools', 'dx'), 'dx')
+    write_tool(os.path.join(sdk, 'tools', 'zipalign'), 'zipalign')
+    for jar in ('sdklib.jar', 'androidprefs.jar'):
+        write(os.path.join(sdk, 'tools', 'lib', jar), jar)
+    for tool in ('javac', 'java', 'jarsigner'):
+        write_tool(os.path.join(bindir, tool), tool)
+
+    for level in api_levels:
+        platform = os.path.join(sdk, 'platforms', 'android-%d' % level)
+        write(os.path.join(platform, 'android.jar'), 'android-%d' % level)
+        for arch in ('arch-arm', 'arch-x86'):
+            for subdir in ('include', 'lib'):
+                path = os.path.join(ndk, 'platforms', 'android-%d' % level,
+                                    arch, 'usr', subdir)
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+    for toolchain, prefix in _TOOLCHAINS.items():
+        bin_path = os.path.join(ndk, 'toolchains', toolchain, 'prebuilt',
+                                'linux-x86', 'bin')
+        for tool in ('gcc', 'g++', 'as', 'ar', 'ranlib', 'strip', 'objcopy'):
+            write_tool(os.path.join(bin_path, prefix + tool), tool)
+    return sdk, ndk, bindir
+
+if __name__ == '__main__':
+    sys.exit(run_tool(sys.argv[1], sys.argv[2:]))
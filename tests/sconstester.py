@@ -6,13 +6,141 @@ Contains helper classes for tests
 """
 
 from subprocess import Popen, PIPE
+import atexit
 import errno
 import os
+import select
+import sys
+import time
+import traceback
 import zipfile
 import shutil
 import tempfile
 import unittest
 
+def _find_program(name):
+    """ The full path of the program name on $PATH, or None """
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        fname = os.path.join(path, name)
+        if os.path.isfile(fname) and os.access(fname, os.X_OK):
+            return fname
+    return None
+
+def _scons_main():
+    """
+    Import the SCons engine into this process and return SCons.Script.main.
+    The engine is found in $SCONS_LIB_DIR, on sys.path, or the way the scons
+    script on $PATH looks for it.
+    """
+    if 'SCONS_LIB_DIR' in os.environ:
+        if os.environ['SCONS_LIB_DIR'] not in sys.path:
+            sys.path.insert(0, os.environ['SCONS_LIB_DIR'])
+    try:
+        import SCons.Script
+    except ImportError:
+        script = _find_program('scons')
+        if not script or 'python' not in open(script).readline():
+            raise ImportError('Unable to find the SCons engine, '
+                              'set SCONS_LIB_DIR')
+        # the script takes its own directory from the front of sys.path,
+        # and puts the engine directories it finds there instead
+        sys.path.insert(0, os.path.dirname(script))
+        execfile(script, {'__name__': 'scons', '__file__': script})
+        import SCons.Script
+    return SCons.Script.main
+
+def _exit_status(code):
+    """ The exit status for the code of a SystemExit """
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    sys.stderr.write('%s\n' % code)
+    return 1
+
+def _fork_scons(args):
+    """
+    Run scons with the command line args in a fork of this process, which
+    saves starting Python and importing SCons every time. Returns the output,
+    the errors and the exit status.
+    """
+    main = _scons_main()
+    out_read, out_write = os.pipe()
+    err_read, err_write = os.pipe()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        status = 2
+        try:
+            os.dup2(out_write, 1)
+            os.dup2(err_write, 2)
+            for fd in (out_read, out_write, err_read, err_write):
+                os.close(fd)
+            # the exit handlers of the test process are not for this copy
+            del atexit._exithandlers[:]
+            sys.argv = args
+            try:
+                main()
+                status = 0
+            except SystemExit, exc:
+                status = _exit_status(exc.code)
+            atexit._run_exitfuncs()
+        except:
+            traceback.print_exc()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+    os.close(out_write)
+    os.close(err_write)
+    output = {out_read: [], err_read: []}
+    pending = [out_read, err_read]
+    while pending:
+        for fd in select.select(pending, [], [])[0]:
+            data = os.read(fd, 65536)
+            if data:
+                output[fd].append(data)
+            else:
+                pending.remove(fd)
+                os.close(fd)
+    status = os.waitpid(pid, 0)[1]
+    if os.WIFSIGNALED(status):
+        return_code = -os.WTERMSIG(status)
+    else:
+        return_code = os.WEXITSTATUS(status)
+    return ''.join(output[out_read]), ''.join(output[err_read]), return_code
+
+def _fixture_root():
+    """
+    The directory that holds the fixture workspaces. Worker processes find it
+    in the environment, so they all share the same fixtures.
+    """
+    if 'SCONSTESTER_FIXTURES' not in os.environ:
+        root = tempfile.mkdtemp(prefix='sconstester-fixtures-')
+        os.environ['SCONSTESTER_FIXTURES'] = root
+        if 'SCONSTESTER_NOREMOVE' not in os.environ:
+            atexit.register(shutil.rmtree, root, True)
+    return os.environ['SCONSTESTER_FIXTURES']
+
+def _link_tree(source, target):
+    """ Copy the files below source into target as hard links """
+    for root, dirs, files in os.walk(source):
+        dest = os.path.join(target, os.path.relpath(root, source))
+        for name in dirs:
+            if not os.path.isdir(os.path.join(dest, name)):
+                os.makedirs(os.path.join(dest, name))
+        for name in files:
+            fname = os.path.join(root, name)
+            link = os.path.join(dest, name)
+            if os.path.exists(link):
+                # may be a link to another fixture
+                os.remove(link)
+            try:
+                os.link(fname, link)
+            except OSError:
+                shutil.copy2(fname, link)
+
 class SConsResult:
     """
     Holds the results of a scons run
@@ -38,6 +166,9 @@ class SConsTestCase(unittest.TestCase):
         Write a file inside the temp workspace
         """
         fullname = os.path.join(self.basedir, filename)
+        if os.path.exists(fullname):
+            # replace rather than write through a link to a fixture
+            os.remove(fullname)
         tmpfile = open(fullname, 'w')
         tmpfile.write(data)
         tmpfile.close()
@@ -52,6 +183,27 @@ class SConsTestCase(unittest.TestCase):
             if exc.errno != errno.EEXIST:
                 raise
 
+    def fixture(self, name, create):
+        """
+        Fill the workspace with the files of the fixture called name. The
+        first test to ask for it calls create(self) to write the files, the
+        tests after that get hard links to the same files.
+        """
+        path = os.path.join(_fixture_root(), name)
+        if not os.path.isdir(path):
+            basedir = self.basedir
+            self.basedir = tempfile.mkdtemp(dir=_fixture_root())
+            try:
+                create(self)
+                try:
+                    os.rename(self.basedir, path)
+                except OSError:
+                    # another worker created it first
+                    shutil.rmtree(self.basedir)
+            finally:
+                self.basedir = basedir
+        _link_tree(path, self.basedir)
+
     def apk_contains(self, apk, filename, variant='build'):
         """
         Check if an APK file contains the given filename
@@ -87,7 +239,9 @@ class SConsTestCase(unittest.TestCase):
     def run_scons(self, args=None):
         """
         Run a scons command on the test workspace using the given arguments.
-        Captures stdout, stderr and the return code.
+        Captures stdout, stderr and the return code. With the environment
+        variable SCONSTESTER_INPROCESS set, scons runs in a fork of the test
+        process instead of a new one.
         """
         start = os.getcwd()
         try:
@@ -95,10 +249,15 @@ class SConsTestCase(unittest.TestCase):
             cmd = ['scons']
             if args:
                 cmd.extend(args)
-            prog = Popen(cmd, shell=False, stdout=PIPE, stderr=PIPE)
-            out = prog.stdout.readlines()
-            err = prog.stderr.readlines()
-            return_code = prog.wait()
+            if 'SCONSTESTER_INPROCESS' in os.environ:
+                out, err, return_code = _fork_scons(cmd)
+            else:
+                prog = Popen(cmd, shell=False, stdout=PIPE, stderr=PIPE)
+                # reads both pipes together, so a full one can not block scons
+                out, err = prog.communicate()
+                return_code = prog.returncode
+            out = out.splitlines(True)
+            err = err.splitlines(True)
             if return_code != 0:
                 print ''.join(out), ''.join(err)
             return SConsResult(out, err, return_code)
@@ -114,3 +273,75 @@ class SConsTestCase(unittest.TestCase):
             print self.basedir
         else:
             shutil.rmtree(self.basedir)
+
+def _test_names(tests):
+    """ The ids of the test cases in the suite tests """
+    for test in tests:
+        if isinstance(test, unittest.TestSuite):
+            for name in _test_names(test):
+                yield name
+        else:
+            yield test.id()
+
+def _run_test(name):
+    """ Run the test called name in a worker process """
+    result = unittest.TestResult()
+    start = time.time()
+    unittest.defaultTestLoader.loadTestsFromName(name).run(result)
+    problems = ([('FAIL', error) for test, error in result.failures] +
+                [('ERROR', error) for test, error in result.errors])
+    return name, problems, time.time() - start
+
+def run_parallel(jobs, names=None):
+    """
+    Run the tests of the __main__ module, or the tests called names, spread
+    over jobs worker processes
+    """
+    import multiprocessing
+    module = sys.modules['__main__']
+    loader = unittest.defaultTestLoader
+    if names:
+        suite = loader.loadTestsFromNames(names, module)
+    else:
+        suite = loader.loadTestsFromModule(module)
+    names = list(_test_names(suite))
+    # shared by the workers
+    _fixture_root()
+    start = time.time()
+    pool = multiprocessing.Pool(jobs)
+    problems = []
+    for name, test_problems, elapsed in pool.imap_unordered(_run_test, names):
+        outcome = test_problems and test_problems[0][0] or 'ok'
+        sys.stderr.write('%s ... %s (%.1fs)\n' % (name, outcome, elapsed))
+        problems.extend((kind, name, error) for kind, error in test_problems)
+    pool.close()
+    pool.join()
+
+    for kind, name, error in problems:
+        sys.stderr.write('%s\n%s: %s\n%s\n%s\n' %
+                         ('=' * 70, kind, name, '-' * 70, error))
+    sys.stderr.write('%s\nRan %d test%s in %.3fs\n\n' %
+                     ('-' * 70, len(names), len(names) != 1 and 's' or '',
+                      time.time() - start))
+    if problems:
+        failures = len([p for p in problems if p[0] == 'FAIL'])
+        sys.stderr.write('FAILED (failures=%d, errors=%d)\n' %
+                         (failures, len(problems) - failures))
+        return False
+    sys.stderr.write('OK\n')
+    return True
+
+def main():
+    """
+    Run the tests of the __main__ module like unittest.main. Setting the
+    environment variable SCONSTESTER_JOBS runs them in that many processes,
+    0 means one for each core.
+    """
+    jobs = int(os.environ.get('SCONSTESTER_JOBS', '1'))
+    if jobs == 1:
+        unittest.main()
+    else:
+        if jobs == 0:
+            import multiprocessing
+            jobs = multiprocessing.cpu_count()
+        sys.exit(not run_parallel(jobs, sys.argv[1:]))
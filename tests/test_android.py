@@ -6,10 +6,18 @@ Functional tests for the SCons Android tool
 """
 
 import sconstester
+import fakeadb
+import fakesdk
+import json
 import os
+import random
 import sys
 import base64
+import cPickle
 import StringIO
+import struct
+import zipfile
+import zlib
 
 # print base64.encodestring(open("filename").read())
 # using stock android icon
@@ -71,6 +79,8 @@ var.AddVariables(
     ('ANDROID_SDK', 'Android SDK path'))
 env = Environment(tools=['android'], variables=var)
 var.Save('variables.cache', env)
+# the helper classes go in the test workspace, not the user's home
+env['ANDROID_TOOL_CACHE'] = '#toolcache'
 """
 
 def getNDK():
@@ -123,6 +133,54 @@ def create_resources(tester):
     <string name="app_name">My Test App</string>
 </resources>''')
 
+def tiny_png(red, green, blue):
+    """ A valid 1x1 PNG of the given colour """
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+    return ('\x89PNG\r\n\x1a\n' +
+            chunk('IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 2, 0, 0, 0)) +
+            chunk('IDAT', zlib.compress(struct.pack('>BBBB', 0, red, green,
+                                                    blue))) +
+            chunk('IEND', ''))
+
+def zip_entries(fname):
+    """
+    Map the names in the zip file fname to their data offset and their
+    stored, possibly compressed, bytes
+    """
+    zip_file = zipfile.ZipFile(fname)
+    raw = open(fname, 'rb')
+    result = {}
+    try:
+        for info in zip_file.infolist():
+            raw.seek(info.header_offset)
+            header = struct.unpack('<4s5H3L2H', raw.read(30))
+            offset = info.header_offset + 30 + header[9] + header[10]
+            raw.seek(offset)
+            result[info.filename] = (offset, raw.read(info.compress_size))
+    finally:
+        raw.close()
+        zip_file.close()
+    return result
+
+def assert_aligned_zip(tester, fname):
+    """
+    Check fname is a valid zip with its uncompressed entries aligned to 4
+    bytes, as zipalign leaves them
+    """
+    zip_file = zipfile.ZipFile(fname)
+    try:
+        tester.assertEquals(None, zip_file.testzip())
+        stored = [info.filename for info in zip_file.infolist()
+                  if info.compress_type == zipfile.ZIP_STORED]
+    finally:
+        zip_file.close()
+    entries = zip_entries(fname)
+    for name in stored:
+        tester.assertEquals(0, entries[name][0] % 4, name)
+    return stored
+
 def create_activity(tester):
     srcdir = 'src/com/example/android'
     tester.subdir(srcdir)
@@ -188,14 +246,32 @@ def create_standard_manifest(tester):
 
 def create_android_project(tester, duplicate=0):
     """
-    Add an Android project to a test
+    Add an Android project to a test, linked from a fixture
     """
-    create_variant_build(tester, duplicate)
-    create_resources(tester)
-    srcdir = create_activity(tester)
-    create_standard_manifest(tester)
-
-    return srcdir
+    def create(fixture):
+        create_variant_build(fixture, duplicate)
+        create_resources(fixture)
+        create_activity(fixture)
+        create_standard_manifest(fixture)
+    tester.fixture('android-project-%d' % duplicate, create)
+    return 'src/com/example/android'
+
+def create_fake_tools(tester):
+    """
+    Create the stand-in SDK and JDK tools of fakesdk.py in the test
+    workspace, for tests that look at how the tools were run. Returns the
+    SDK directory and main.scons lines that use the fake JDK tools.
+    """
+    sdk, ndk, bindir = fakesdk.create_fake_sdk(
+            os.path.join(tester.basedir, 'fake'))
+    return sdk, '''
+import os
+os.environ['FAKE_TOOL_SCALE'] = env['ENV']['FAKE_TOOL_SCALE'] = '0'
+env['JAVAC'] = %r
+env['JAVA'] = %r
+env['JARSIGNER'] = %r
+''' % tuple(os.path.join(bindir, tool)
+             for tool in ('javac', 'java', 'jarsigner'))
 
 def create_jni_stub(tester):
     tester.subdir('jni')
@@ -270,7 +346,8 @@ env = Environment(tools=['android'])\n''' % (rootdir))
         self.write_file('main.scons','''
 var = Variables(None, ARGUMENTS)
 var.AddVariables(('ANDROID_SDK', 'Android SDK path'))
-env = Environment(tools=['android'], variables=var)
+env = Environment(tools=['android'], variables=var,
+                  ANDROID_TOOL_CACHE='#toolcache')
 env.AndroidApp('Test')
 ''')
         result = self.run_scons(['ANDROID_SDK='+getSDK()])
@@ -311,6 +388,93 @@ env.Help(var.GenerateHelpText(env))
         self.checkBasicNdkBuild(0)
         self.checkBasicNdkBuild(1)
 
+    def testTrackedNdkBuildLegacy(self):
+        """
+        Test that tracking the Android.mk modules adds their libraries as
+        targets and rebuilds when an included header changes
+        """
+        create_android_ndk_project(self)
+        self.write_file('jni/test.h', 'int not_really_jni(void);\n')
+        self.write_file('jni/test.c', '''#include "test.h"
+int not_really_jni(void) { return 1; }''')
+        self.write_file('jni/Application.mk', 'APP_ABI := armeabi x86\n')
+        self.write_file('main.scons', _TOOL_SETUP + '''
+env['NDK_JOBSERVER'] = True
+lib = env.NdkBuildLegacy('libs/armeabi/libtest.so', [], track_modules=True)
+print sorted(str(t) for t in lib)
+''')
+        result = self.run_scons(['-j2', 'ANDROID_NDK='+getNDK(), 'ANDROID_SDK='+getSDK()])
+        self.assertEquals(0, result.return_code)
+        self.assertTrue("['libs/armeabi/libtest.so', 'libs/x86/libtest.so']\n"
+                        in result.out, result.out)
+        self.assertTrue(self.exists('libs/x86/libtest.so', variant=''))
+
+        # the dependency files from the first build list the header
+        self.write_file('jni/test.h', 'int not_really_jni(void);\n\n')
+        result = self.run_scons(['-j2'])
+        self.assertEquals(0, result.return_code)
+        self.assertTrue([line for line in result.out if 'ndk-build' in line])
+
+    def testJobserverActions(self):
+        """
+        Test that with NDK_JOBSERVER set the Android actions each hold a
+        jobserver token, so that together with ndk-build they stay within
+        the scons -j budget, and that every token is given back
+        """
+        create_android_project(self)
+        sdk, setup = create_fake_tools(self)
+        self.write_file('main.scons', _TOOL_SETUP + setup + '''
+import android, atexit, fcntl, threading
+lock = threading.Lock()
+counts = {'taken': 0, 'held': 0, 'most': 0}
+acquire_job = android.acquire_job
+release_job = android.release_job
+def counting_acquire_job(env):
+    token = acquire_job(env)
+    lock.acquire()
+    counts['taken'] += 1
+    counts['held'] += 1
+    counts['most'] = max(counts['most'], counts['held'])
+    lock.release()
+    return token
+def counting_release_job(env, token):
+    lock.acquire()
+    counts['held'] -= 1
+    lock.release()
+    release_job(env, token)
+android.acquire_job = counting_acquire_job
+android.release_job = counting_release_job
+env['NDK_JOBSERVER'] = True
+env['ANDROID_TRACE'] = '#trace.json'
+env.AndroidApp('Test')
+action = env['BUILDERS']['Dex'].action
+print 'dex action', type(action).__name__, type(action.action).__name__
+def report():
+    read_fd = android.get_jobserver(env)[0]
+    fcntl.fcntl(read_fd, fcntl.F_SETFL, os.O_NONBLOCK)
+    tokens = 0
+    try:
+        while os.read(read_fd, 1):
+            tokens += 1
+    except OSError:
+        pass
+    print 'jobs taken %d held %d most %d' % (
+        counts['taken'], counts['held'], counts['most'])
+    print 'tokens', tokens
+atexit.register(report)
+''')
+        result = self.run_scons(['-j3', 'ANDROID_SDK=' + sdk])
+        self.assertEquals(0, result.return_code)
+        self.assertTrue('dex action JobserverAction TracedAction\n'
+                        in result.out, result.out)
+        jobs = [line.split() for line in result.out
+                if line.startswith('jobs taken ')][0]
+        # aapt, javac, dx, the APK, zipalign at least
+        self.assertTrue(int(jobs[2]) >= 5, jobs)
+        self.assertEquals('0', jobs[4])
+        self.assertTrue(1 <= int(jobs[6]) <= 3, jobs)
+        self.assertTrue('tokens 3\n' in result.out, result.out)
+
     def testDefaultProperties(self):
         """
         Test that default.properties file with empty lines works
@@ -420,6 +584,125 @@ apk = env.AndroidApp('Test', native_folder='libs')
         self.assertTrue('-fno-exceptions' in compile_line, msg)
         self.assertTrue('-mthumb' in compile_line, msg)
 
+    def testPrecompiledHeader(self):
+        """
+        Test that a precompiled header is built for each ABI and used by the
+        C++ sources
+        """
+        create_new_android_ndk_project(self)
+        self.write_file('jni/common.h', '''
+#ifndef COMMON_H
+#define COMMON_H
+class Foo {public: int i;};
+#endif
+''')
+        self.write_file('jni/foo.cpp', '''
+#include "common.h"
+int do_foo(const Foo &f) {return f.i;}
+''')
+        self.write_file('main.scons', _TOOL_SETUP + '''
+lib = env.NdkBuild('libtest.so', ['jni/foo.cpp', 'jni/test.c'],
+                   app_abi='armeabi x86', pch='jni/common.h')
+''')
+        result = self.run_scons(['ANDROID_NDK='+getNDK(), 'ANDROID_SDK='+getSDK()])
+        self.assertEquals(0, result.return_code)
+        self.assertTrue(self.exists('local/libs/armeabi/libtest.so.pch/common.h.gch'))
+        self.assertTrue(self.exists('local/libs/x86/libtest.so.pch/common.h.gch'))
+        self.assertTrue(self.exists('libs/x86/libtest.so'))
+        cpp_lines = [line for line in result.out if 'foo.cpp' in line]
+        c_lines = [line for line in result.out if 'test.c ' in line]
+        self.assertEquals(2, len(cpp_lines))
+        header_dir = os.path.join(self.basedir, 'jni')
+        for line in cpp_lines:
+            args = line.split()
+            self.assertEquals('common.h', args[args.index('-include') + 1])
+            # the .gch is found first, the real header if gcc rejects it
+            search = [args[i + 1] for i, arg in enumerate(args)
+                      if arg == '-iquote']
+            self.assertTrue(search[0].endswith('libtest.so.pch'), line)
+            self.assertTrue(header_dir in search, line)
+        for line in c_lines:
+            self.assertFalse('-include' in line, line)
+
+        # nothing to do on a null build
+        result = self.run_scons()
+        self.assertEquals(0, result.return_code)
+        self.assertFalse([line for line in result.out if '.gch' in line])
+
+    def testUnityBuild(self):
+        """
+        Test that unity mode compiles the inputs in a few combined files, and
+        that editing a source only recompiles its group
+        """
+        create_new_android_ndk_project(self)
+        for i in range(6):
+            self.write_file('jni/part%d.c' % i,
+                            'int part%d(void) { return %d; }\n' % (i, i))
+        self.write_file('main.scons', _TOOL_SETUP + '''
+sources = ['jni/test.c'] + ['jni/part%d.c' % i for i in range(6)]
+lib = env.NdkBuild('libs/armeabi/libtest.so', sources, unity=2)
+''')
+        result = self.run_scons(['ANDROID_NDK='+getNDK(), 'ANDROID_SDK='+getSDK()])
+        self.assertEquals(0, result.return_code)
+        self.assertTrue(self.exists('libs/armeabi/libtest.so'))
+        compiles = [line for line in result.out if ' -c ' in line]
+        self.assertTrue(0 < len(compiles) <= 2, compiles)
+        for line in compiles:
+            self.assertTrue('unity_' in line, line)
+
+        self.write_file('jni/part3.c', 'int part3(void) { return 33; }\n')
+        result = self.run_scons()
+        self.assertEquals(0, result.return_code)
+        compiles = [line for line in result.out if ' -c ' in line]
+        self.assertEquals(1, len(compiles), compiles)
+
+    def testCompileCache(self):
+        """
+        Test that NDK objects are stored in the compile cache, reused after a
+        clean and pruned to the size limit
+        """
+        create_new_android_ndk_project(self)
+        self.write_file('main.scons', _TOOL_SETUP + '''
+env['NDK_COMPILE_CACHE'] = '#ccache'
+env['NDK_COMPILE_CACHE_SIZE'] = ARGUMENTS.get('size', 1024)
+lib = env.NdkBuild('libs/armeabi/libtest.so', ['jni/test.c'])
+''')
+        cache_dir = os.path.join(self.basedir, 'ccache')
+
+        def cached_objects():
+            return [name for root, dirs, files in os.walk(cache_dir)
+                    for name in files]
+
+        result = self.run_scons(['ANDROID_NDK='+getNDK(), 'ANDROID_SDK='+getSDK()])
+        self.assertEquals(0, result.return_code)
+        self.assertEquals(1, len(cached_objects()))
+
+        result = self.run_scons(['-c'])
+        self.assertEquals(0, result.return_code)
+        self.assertFalse(self.exists('jni/test.armeabi-os'))
+        result = self.run_scons()
+        self.assertEquals(0, result.return_code)
+        self.assertTrue(self.exists('libs/armeabi/libtest.so'))
+        self.assertEquals(1, len(cached_objects()))
+
+        # an object that only the cache can give shows the compiler is skipped
+        entry = [os.path.join(root, name)
+                 for root, dirs, files in os.walk(cache_dir)
+                 for name in files][0]
+        original = open(entry, 'rb').read()
+        open(entry, 'wb').write('cached object')
+        result = self.run_scons(['-c'])
+        result = self.run_scons([os.path.join('build', 'jni', 'test.armeabi-os')])
+        self.assertEquals(0, result.return_code)
+        self.assertEquals('cached object',
+                          self.get_file('jni/test.armeabi-os').read())
+        open(entry, 'wb').write(original)
+
+        result = self.run_scons(['-c'])
+        result = self.run_scons(['size=0'])
+        self.assertEquals(0, result.return_code)
+        self.assertEquals([], cached_objects())
+
     def checkLibraryAssembler(self, name, instruction):
         """
         Check the disassembled library contents for the instruction snippet.
@@ -519,6 +802,27 @@ apk = env.AndroidApp('Test', native_folder='libs')
         self.assertTrue(self.exists('libs/armeabi-v7a/libtest.so'))
         self.assertTrue(self.apk_contains('Test-debug.apk', 'lib/armeabi-v7a/libtest.so'))
 
+    def testNeutralInputs(self):
+        """
+        Test that ABI neutral sources are compiled once per compiler
+        """
+        create_new_android_ndk_project(self)
+        self.write_file('jni/table.c', '''
+const int table[] = { 1, 2, 3, 5, 8, 13 };
+''')
+        self.write_file('main.scons', _TOOL_SETUP + '''
+lib = env.NdkBuild('libtest.so', ['jni/test.c'],
+                   app_abi='armeabi armeabi-v7a x86',
+                   neutral_inputs=['jni/table.c'])
+''')
+        result = self.run_scons(['ANDROID_NDK='+getNDK(), 'ANDROID_SDK='+getSDK()])
+        self.assertEquals(0, result.return_code)
+        self.assertTrue(self.exists('libs/armeabi-v7a/libtest.so'))
+        self.assertTrue(self.exists('jni/test.armeabi-v7a-os'))
+        self.assertTrue(self.exists('jni/table.armeabi-os'))
+        self.assertFalse(self.exists('jni/table.armeabi-v7a-os'))
+        self.assertTrue(self.exists('jni/table.x86-os'))
+
     def testMultipleAPKs(self):
         """
         Test that multiple APKs can be built
@@ -566,6 +870,41 @@ print len(env['CXXFLAGS'])
         self.assertEquals('21', cxxflags_len,
               "Expected CXXFLAGS to contain 21 entries (%s)" % cxxflags_len)
 
+    def testSharedToolchain(self):
+        """
+        Test that NdkBuild calls share the toolchain setup, but still see
+        any variable changed in between
+        """
+        create_new_android_ndk_project(self)
+        self.write_file('jni/third.c', 'int third(void) { return 3; }\n')
+        self.write_file('jni/fourth.c', 'int fourth(void) { return 4; }\n')
+        self.write_file('main.scons', _TOOL_SETUP + '''
+import android
+setups = []
+new_toolchain_env = android._new_toolchain_env
+def counting_new_toolchain_env(env, abi):
+    setups.append(abi)
+    return new_toolchain_env(env, abi)
+android._new_toolchain_env = counting_new_toolchain_env
+first = env.NdkBuild('libs/armeabi/libfirst.so', ['jni/test.c'])
+second = env.NdkBuild('libs/armeabi/libsecond.so', ['jni/test.c'])
+env.Append(CPPDEFINES=['EXTRA'])
+third = env.NdkBuild('libs/armeabi/libthird.so', ['jni/third.c'])
+env.Append(CPPFLAGS=['-DLATER'])
+fourth = env.NdkBuild('libs/armeabi/libfourth.so', ['jni/fourth.c'])
+envs = [lib[0][0].get_build_env() for lib in (first, second, third, fourth)]
+print len(envs[1]['CFLAGS'])
+print envs[0]['CC'] == envs[1]['CC']
+print 'EXTRA' in envs[1]['CPPDEFINES'], 'EXTRA' in envs[2]['CPPDEFINES']
+print '-DLATER' in envs[2].get('CPPFLAGS', []), '-DLATER' in envs[3]['CPPFLAGS']
+print len(setups)
+''')
+        result = self.run_scons(['-Q', 'ANDROID_NDK='+getNDK(), 'ANDROID_SDK='+getSDK()])
+        self.assertEquals(0, result.return_code)
+        # the second library shares the toolchain setup of the first
+        self.assertEquals(['19', 'True', 'False True', 'False True', '3'],
+                          [line.strip() for line in result.out[:5]])
+
     def testCPPPATH(self):
         create_new_android_ndk_project(self)
         self.subdir('jni/subdir')
@@ -582,8 +921,10 @@ lib = env.NdkBuild('libs/armeabi/libtest.so', ['jni/test.c', 'jni/test2.c'])
         result = self.run_scons(['-Q', 'ANDROID_NDK='+getNDK(), 'ANDROID_SDK='+getSDK()])
         self.assertEquals(0, result.return_code)
 
-    def testExternalJar(self):
-        create_new_android_ndk_project(self)
+    def createExternalJar(self):
+        """
+        Create external_jar/test_lib.jar with a separate scons run
+        """
         self.subdir('external_jar/src/com/example')
         self.write_file('external_jar/src/com/example/Hello.java', '''\
 package com.example;
@@ -603,6 +944,10 @@ env.Jar(target='test_lib.jar', source=classes)
         # check the external jarfile is created..
         self.assertTrue(self.exists('external_jar/test_lib.jar', '.'))
 
+    def testExternalJar(self):
+        create_new_android_ndk_project(self)
+        self.createExternalJar()
+
         # now make sure we link with it in an Android project...
         self.write_file('main.scons', _TOOL_SETUP + '''
 env['JAVACLASSPATH'] = 'external_jar/test_lib.jar'
@@ -617,6 +962,354 @@ env.AndroidApp('TestExternalJar')
         result = self.run_scons(['ANDROID_SDK='+getSDK()])
         self.assertEquals(0, result.return_code)
 
+    def testPredexExternalJar(self):
+        """
+        Test that library jars are dexed once and merged into classes.dex
+        """
+        create_new_android_ndk_project(self)
+        self.createExternalJar()
+        self.write_file('main.scons', _TOOL_SETUP + '''
+env['JAVACLASSPATH'] = 'external_jar/test_lib.jar'
+env['ANDROID_PREDEX'] = True
+env.AndroidApp('TestExternalJar')
+''')
+        result = self.run_scons(['ANDROID_SDK='+getSDK()])
+        self.assertEquals(0, result.return_code)
+        predex_lines = [line for line in result.out
+                        if line.find('dx --dex --output=predex/') != -1]
+        self.assertEquals(1, len(predex_lines))
+        self.assertTrue(self.apk_contains('TestExternalJar-debug.apk',
+                                          'classes.dex'))
+        # changing the app code must not dex the library again
+        self.write_file('src/com/example/android/MyActivity.java',
+                          '''
+                          package com.example.android;
+                          public class MyActivity { int x; }
+                          ''')
+        result = self.run_scons()
+        self.assertEquals(0, result.return_code)
+        predex_lines = [line for line in result.out
+                        if line.find('dx --dex --output=predex/') != -1]
+        self.assertEquals([], predex_lines)
+        # the dexed jar is found by its contents without the .sconsign
+        os.remove(os.path.join(self.basedir, '.sconsign.dblite'))
+        result = self.run_scons()
+        self.assertEquals(0, result.return_code)
+        predex_lines = [line for line in result.out
+                        if line.find('dx --dex --output=predex/') != -1]
+        self.assertEquals([], predex_lines)
+
+    def testIncrementalDexClasspath(self):
+        """
+        Test that each JAVACLASSPATH jar is passed to dx once with
+        incremental dexing, with and without pre-dexing
+        """
+        create_android_project(self)
+        sdk, setup = create_fake_tools(self)
+        self.subdir('external_jar')
+        lib = zipfile.ZipFile(os.path.join(self.basedir, 'external_jar',
+                                           'lib.jar'), 'w')
+        lib.writestr('com/example/lib/Lib.class', fakesdk.class_file(
+                'com/example/lib/Lib', [], [], [], 'Lib.java', ''))
+        lib.close()
+        for predex in (False, True):
+            self.write_file('main.scons', _TOOL_SETUP + setup + '''
+env['JAVACLASSPATH'] = 'external_jar/lib.jar'
+env['ANDROID_INCREMENTAL_DEX'] = True
+env['ANDROID_PREDEX'] = %r
+env.AndroidApp('Test')
+''' % predex)
+            result = self.run_scons(['ANDROID_SDK=' + sdk])
+            self.assertEquals(0, result.return_code)
+            dx_lines = [line.split() for line in result.out
+                        if ' --output=build/Testclasses.dex ' in line]
+            self.assertEquals(1, len(dx_lines), result.out)
+            jars = [arg for arg in dx_lines[0] if arg.endswith('lib.jar')]
+            self.assertEquals(1, len(jars), dx_lines[0])
+
+    def testIncrementalDex(self):
+        """
+        Test that classes are dexed per package and merged into classes.dex
+        """
+        create_android_project(self)
+        self.write_file('main.scons', _TOOL_SETUP + '''
+env['ANDROID_INCREMENTAL_DEX'] = True
+env.AndroidApp('Test')
+''')
+        result = self.run_scons(['ANDROID_SDK='+getSDK()])
+        self.assertEquals(0, result.return_code)
+        self.assertTrue(self.exists('Test_bin/dex/com.example.android.jar'))
+        self.assertTrue(self.apk_contains('Test-debug.apk', 'classes.dex'))
+        # check rebuild is a no-op
+        result = self.run_scons()
+        self.assertEquals("scons: `.' is up to date.\n", result.out[4])
+        # a new resource changes only the R classes of the package
+        self.write_file('res/values/strings.xml',
+                        '''<?xml version="1.0" encoding="utf-8"?>
+<resources>
+    <string name="app_name">My Test App</string>
+    <string name="another">Another</string>
+</resources>''')
+        result = self.run_scons()
+        self.assertEquals(0, result.return_code)
+        self.assertTrue([line for line in result.out
+                         if 'dex/com.example.android.jar' in line])
+
+    def testIncrementalJavac(self):
+        """
+        Test that only changed sources and the users of a changed API are
+        recompiled, and that a new resource ID recompiles everything
+        """
+        srcdir = create_android_project(self)
+        self.write_file(srcdir + '/Util.java', """
+package com.example.android;
+public class Util {
+    public static int twice(int x) { return x * 2; }
+}
+""")
+        self.write_file(srcdir + '/User.java', """
+package com.example.android;
+class User {
+    int use() { return Util.twice(1); }
+}
+""")
+        self.write_file(srcdir + '/Other.java', """
+package com.example.android;
+class Other {
+    int other() { return 1; }
+}
+""")
+        self.write_file('main.scons', _TOOL_SETUP + '''
+env['ANDROID_INCREMENTAL_JAVAC'] = True
+env.AndroidApp('Test')
+''')
+        def compiled(result):
+            return sorted(os.path.basename(arg) for line in result.out
+                          for arg in line.split() if arg.endswith('.java'))
+        result = self.run_scons(['ANDROID_SDK='+getSDK()])
+        self.assertEquals(0, result.return_code)
+        self.assertEquals(['MyActivity.java', 'Other.java', 'R.java',
+                           'User.java', 'Util.java'], compiled(result))
+        self.assertTrue(self.exists('Test_bin/classes.deps'))
+        self.assertTrue(self.exists(
+                'Test_bin/classes/com/example/android/User.class'))
+
+        # a change that keeps the API only compiles the source itself
+        self.write_file(srcdir + '/Util.java', """
+package com.example.android;
+public class Util {
+    public static int twice(int x) { return x + x; }
+}
+""")
+        result = self.run_scons()
+        self.assertEquals(0, result.return_code)
+        self.assertEquals(['Util.java'], compiled(result))
+
+        # an API change recompiles the users of the class
+        self.write_file(srcdir + '/Util.java', """
+package com.example.android;
+public class Util {
+    public static int twice(int x) { return x + x; }
+    public static int thrice(int x) { return x * 3; }
+}
+""")
+        result = self.run_scons()
+        self.assertEquals(0, result.return_code)
+        self.assertEquals(['User.java', 'Util.java'], compiled(result))
+
+        # R constants are copied into the classes using them
+        self.write_file('res/values/strings.xml', """<?xml version="1.0" encoding="utf-8"?>
+<resources>
+    <string name="app_name">My Test App</string>
+    <string name="another">Another</string>
+</resources>""")
+        result = self.run_scons()
+        self.assertEquals(0, result.return_code)
+        self.assertEquals(['MyActivity.java', 'Other.java', 'R.java',
+                           'User.java', 'Util.java'], compiled(result))
+        result = self.run_scons()
+        self.assertEquals("scons: `.' is up to date.\n", result.out[4])
+
+        # a new constant is an API change
+        self.write_file(srcdir + '/Util.java', """
+package com.example.android;
+public class Util {
+    public static final int SIZE = 1;
+    public static int twice(int x) { return x + x; }
+    public static int thrice(int x) { return x * 3; }
+}
+""")
+        result = self.run_scons()
+        self.assertEquals(0, result.return_code)
+        self.assertEquals(['User.java', 'Util.java'], compiled(result))
+
+        # R.java is generated from the resources, it can not use the constant
+        self.write_file(srcdir + '/Util.java', """
+package com.example.android;
+public class Util {
+    public static final int SIZE = 2;
+    public static int twice(int x) { return x + x; }
+    public static int thrice(int x) { return x * 3; }
+}
+""")
+        result = self.run_scons()
+        self.assertEquals(0, result.return_code)
+        self.assertEquals(['MyActivity.java', 'Other.java', 'User.java',
+                           'Util.java'], compiled(result))
+
+    def testIncrementalJavacRemovedSources(self):
+        """
+        Test that the classes of removed sources, resources and generated
+        sources are removed, along with the stale generated sources
+        """
+        srcdir = create_android_project(self)
+        self.write_file(srcdir + '/Other.java', """
+package com.example.android;
+class Other {
+    int other() { return 1; }
+}
+""")
+        self.write_file('res/layout/main.xml', """<?xml version="1.0" encoding="utf-8"?>
+<LinearLayout xmlns:android="http://schemas.android.com/apk/res/android"/>
+""")
+        self.write_file('main.scons', _TOOL_SETUP + '''
+env['ANDROID_INCREMENTAL_JAVAC'] = True
+env.AndroidApp('Test')
+''')
+        classes = 'Test_bin/classes/com/example/'
+        result = self.run_scons(['ANDROID_SDK='+getSDK()])
+        self.assertEquals(0, result.return_code)
+        self.assertTrue(self.exists(classes + 'android/Other.class'))
+        self.assertTrue(self.exists(classes + 'android/R$layout.class'))
+
+        os.remove(os.path.join(self.basedir, srcdir, 'Other.java'))
+        os.remove(os.path.join(self.basedir, 'res/layout/main.xml'))
+        result = self.run_scons()
+        self.assertEquals(0, result.return_code)
+        self.assertFalse(self.exists(classes + 'android/Other.class'))
+        self.assertFalse(self.exists(classes + 'android/R$layout.class'))
+        self.assertTrue(self.exists(classes + 'android/R$string.class'))
+
+        # the R.java of the old package is stale once the package changes
+        manifest = self.get_file('AndroidManifest.xml', '.').read()
+        self.write_file('AndroidManifest.xml', manifest.replace(
+                'package="com.example.android"', 'package="com.example.other"'))
+        result = self.run_scons()
+        self.assertEquals(0, result.return_code)
+        self.assertFalse(self.exists('Test_gen/com/example/android'))
+        self.assertFalse(self.exists('Test_gen.staging/com/example/android'))
+        self.assertTrue(self.exists('Test_gen/com/example/other/R.java'))
+        self.assertFalse(self.exists(classes + 'android/R.class'))
+        self.assertFalse(self.exists(classes + 'android/R$string.class'))
+        self.assertTrue(self.exists(classes + 'other/R$string.class'))
+        self.assertTrue(self.exists(classes + 'android/MyActivity.class'))
+
+    def testIncrementalJavacSubclasses(self):
+        """
+        Test that an API change recompiles the users of subclasses that
+        inherit it, and that the javac command lines follow -s and
+        JAVACCOMSTR
+        """
+        srcdir = create_android_project(self)
+        sdk, setup = create_fake_tools(self)
+        self.write_file(srcdir + '/Base.java', """
+package com.example.android;
+public class Base {
+    public void base() {}
+}
+""")
+        self.write_file(srcdir + '/Middle.java', """
+package com.example.android;
+public class Middle extends Base {
+}
+""")
+        self.write_file(srcdir + '/Leaf.java', """
+package com.example.android;
+public class Leaf extends Middle {
+}
+""")
+        self.write_file(srcdir + '/User.java', """
+package com.example.android;
+class User {
+    void use(Leaf leaf) { leaf.base(); }
+}
+""")
+        self.write_file('main.scons', _TOOL_SETUP + setup + '''
+env['ANDROID_INCREMENTAL_JAVAC'] = True
+env.AndroidApp('Test')
+''')
+        def compiled(result):
+            return sorted(os.path.basename(arg) for line in result.out
+                          for arg in line.split() if arg.endswith('.java'))
+        result = self.run_scons(['ANDROID_SDK=' + sdk])
+        self.assertEquals(0, result.return_code)
+        self.assertEquals(['Base.java', 'Leaf.java', 'Middle.java',
+                           'MyActivity.java', 'R.java', 'User.java'],
+                          compiled(result))
+
+        self.write_file(srcdir + '/Base.java', """
+package com.example.android;
+public class Base {
+    public void base(int x) {}
+}
+""")
+        result = self.run_scons()
+        self.assertEquals(0, result.return_code)
+        self.assertEquals(['Base.java', 'Leaf.java', 'Middle.java',
+                           'User.java'], compiled(result))
+
+        self.write_file(srcdir + '/Base.java', """
+package com.example.android;
+public class Base {
+    public void base(int x, int y) {}
+}
+""")
+        result = self.run_scons(['-s'])
+        self.assertEquals(0, result.return_code)
+        self.assertEquals([], compiled(result))
+        self.assertEquals([], [line for line in result.out if 'javac' in line])
+
+        self.write_file(srcdir + '/Base.java', """
+package com.example.android;
+public class Base {
+    public void base() {}
+}
+""")
+        self.write_file('main.scons', _TOOL_SETUP + setup + '''
+env['ANDROID_INCREMENTAL_JAVAC'] = True
+env['JAVACCOMSTR'] = 'Compiling $TARGET'
+env.AndroidApp('Test')
+''')
+        result = self.run_scons()
+        self.assertEquals(0, result.return_code)
+        self.assertEquals([], compiled(result))
+        self.assertEquals(1, len([line for line in result.out
+                                  if line.startswith('Compiling ')]))
+
+    def testBuildTrace(self):
+        """
+        Test that ANDROID_TRACE writes a Chrome trace of the build stages
+        """
+        create_new_android_ndk_project(self)
+        self.write_file('main.scons', _TOOL_SETUP + '''
+env['ANDROID_TRACE'] = '#trace.json'
+env.NdkBuild('libtest.so', ['jni/test.c'])
+env.AndroidApp('Test', native_folder='libs')
+''')
+        result = self.run_scons(['ANDROID_NDK='+getNDK(), 'ANDROID_SDK='+getSDK()])
+        self.assertEquals(0, result.return_code)
+        trace = json.load(open(os.path.join(self.basedir, 'trace.json')))
+        events = trace['traceEvents']
+        stages = set(event['name'] for event in events)
+        for stage in ('aapt', 'javac', 'dx', 'apkbuilder', 'zipalign',
+                      'compile', 'link', 'strip'):
+            self.assertTrue(stage in stages, stage)
+        labels = set(event['args']['label'] for event in events)
+        self.assertTrue('Test' in labels, labels)
+        self.assertTrue('armeabi libtest.so' in labels, labels)
+        self.assertTrue([line for line in result.out
+                         if line.startswith('stage ')])
+
     def testNdkNativeActivity(self):
         """
         Test the android:hasCode=false case for native activities
@@ -646,6 +1339,38 @@ apk = env.AndroidApp('Test')
         # check the apk contains *something*
         self.assertTrue(self.apk_contains('Test-debug.apk', 'lib/armeabi/libtest.so'))
 
+    def testNdkImportModule(self):
+        """
+        Test that an imported module is built once per ABI and shared by
+        the libraries that use it
+        """
+        create_android_project(self)
+        self.subdir('jni')
+        native_code = '''\
+#include <android_native_app_glue.h>
+
+void android_main(struct android_app *state)
+{
+	app_dummy();
+}
+'''
+        self.write_file('jni/test.c', native_code)
+        self.write_file('jni/other.c', native_code)
+        self.write_file('main.scons', _TOOL_SETUP + '''
+glue = env.NdkImportModule('android/native_app_glue')
+env.MergeFlags('-landroid')
+env.NdkBuild('libtest.so', ['jni/test.c'], app_abi='armeabi x86',
+             modules=glue)
+env.NdkBuild('libother.so', ['jni/other.c'], app_abi='armeabi x86',
+             modules=glue)
+''')
+        result = self.run_scons(['ANDROID_NDK='+getNDK(), 'ANDROID_SDK='+getSDK()])
+        self.assertEquals(0, result.return_code)
+        self.assertTrue(self.exists('libs/x86/libother.so'))
+        glue_compiles = [line for line in result.out
+                         if 'android_native_app_glue.c' in line]
+        self.assertEquals(2, len(glue_compiles), glue_compiles)
+
     def testProguard(self):
         create_new_android_ndk_project(self)
 
@@ -674,6 +1399,443 @@ apk = env.AndroidApp('Test')
         self.assertEquals(1, len(dex_line))
         self.assertEquals(True, dex_line[0].endswith('obfuscated.jar'), dex_line[0])
 
+    def testSharedToolClasses(self):
+        """
+        Test that the helper classes are compiled into ANDROID_TOOL_CACHE
+        rather than into each build tree
+        """
+        create_android_project(self)
+        self.write_file('main.scons', _TOOL_SETUP + '''
+env.AndroidApp('Test')
+''')
+        result = self.run_scons(['ANDROID_SDK='+getSDK()])
+        self.assertEquals(0, result.return_code)
+        self.assertTrue(self.exists('Test-debug.apk'))
+        self.assertFalse(self.exists('toolclasses'))
+        cached = os.listdir(os.path.join(self.basedir, 'toolcache'))
+        self.assertEquals(1, len(cached))
+        self.assertTrue(cached[0].startswith('toolclasses-'))
+
+    def testManifestParsedOnce(self):
+        """
+        Test that the manifest is parsed once however many times its values
+        are needed
+        """
+        create_android_project(self)
+        self.write_file('main.scons', _TOOL_SETUP + '''
+import android
+parses = []
+parse = android.parse_android_manifest
+def counting_parse(fname):
+    parses.append(fname)
+    return parse(fname)
+android.parse_android_manifest = counting_parse
+env.AndroidApp('Test')
+env.AndroidApp('Other')
+print 'package', android.get_android_package(
+        env.File('#AndroidManifest.xml').abspath)
+print 'parses', len(parses)
+''')
+        result = self.run_scons(['ANDROID_SDK='+getSDK()])
+        self.assertEquals(0, result.return_code)
+        self.assertTrue('package com.example.android\n' in result.out)
+        self.assertTrue('parses 1\n' in result.out, result.out)
+
+    def testMetadataCache(self):
+        """
+        Test that the metadata cache saves parsing the manifest in later
+        runs, until its contents change
+        """
+        create_android_project(self)
+        self.write_file('main.scons', _TOOL_SETUP + '''
+import android
+parses = []
+parse = android.parse_android_manifest
+def counting_parse(fname):
+    parses.append(fname)
+    return parse(fname)
+android.parse_android_manifest = counting_parse
+env['ANDROID_METADATA_CACHE'] = '#metadata.cache'
+env.AndroidApp('Test')
+print 'parses', len(parses)
+''')
+        result = self.run_scons(['ANDROID_SDK='+getSDK()])
+        self.assertEquals(0, result.return_code)
+        self.assertTrue('parses 1\n' in result.out, result.out)
+        self.assertTrue(os.path.exists(
+                os.path.join(self.basedir, 'metadata.cache')))
+
+        result = self.run_scons()
+        self.assertTrue('parses 0\n' in result.out, result.out)
+
+        # a new time stamp alone is not a change
+        manifest = os.path.join(self.basedir, 'AndroidManifest.xml')
+        stat = os.stat(manifest)
+        os.utime(manifest, (stat.st_atime, stat.st_mtime + 10))
+        result = self.run_scons()
+        self.assertTrue('parses 0\n' in result.out, result.out)
+
+        self.write_file('AndroidManifest.xml',
+                        open(manifest).read() + '<!-- changed -->\n')
+        result = self.run_scons()
+        self.assertEquals(0, result.return_code)
+        self.assertTrue('parses 1\n' in result.out, result.out)
+
+    def testSingleAaptRun(self):
+        """
+        Test that one aapt run writes both R.java and the resource package
+        """
+        create_android_project(self)
+        self.write_file('main.scons', _TOOL_SETUP + '''
+env.AndroidApp('Test')
+''')
+        result = self.run_scons(['ANDROID_SDK='+getSDK()])
+        self.assertEquals(0, result.return_code)
+        aapt_lines = [line for line in result.out if ' package ' in line and
+                      line.split()[0].endswith('aapt')]
+        self.assertEquals(1, len(aapt_lines), aapt_lines)
+        self.assertTrue(' -J ' in aapt_lines[0])
+        self.assertTrue(' -F ' in aapt_lines[0])
+        self.assertTrue(self.exists('Test_gen/com/example/android/R.java'))
+        self.assertTrue(self.exists('Test.ap_'))
+
+    def testUnchangedRJava(self):
+        """
+        Test that resource changes which leave R.java the same do not run
+        javac again
+        """
+        create_android_project(self)
+        self.write_file('main.scons', _TOOL_SETUP + '''
+env.AndroidApp('Test')
+''')
+        result = self.run_scons(['ANDROID_SDK='+getSDK()])
+        self.assertEquals(0, result.return_code)
+        def javac_lines(result):
+            return [line for line in result.out
+                    if line.split() and line.split()[0].endswith('javac')]
+        self.assertTrue(javac_lines(result))
+        rfile = os.path.join(self.basedir, 'build',
+                             'Test_gen/com/example/android/R.java')
+        contents = open(rfile).read()
+        # the old R.java is kept, so timestamp deciders see no change either
+        os.utime(rfile, (1000000000, 1000000000))
+
+        self.write_file('res/values/strings.xml',
+                        '''<?xml version="1.0" encoding="utf-8"?>
+<resources>
+    <string name="app_name">A Different Name</string>
+</resources>''')
+        result = self.run_scons()
+        self.assertEquals(0, result.return_code)
+        self.assertTrue([line for line in result.out if 'aapt' in line])
+        self.assertEquals([], javac_lines(result))
+
+        self.write_file('res/drawable/icon.png', tiny_png(255, 0, 0))
+        result = self.run_scons()
+        self.assertEquals(0, result.return_code)
+        self.assertTrue([line for line in result.out if 'aapt' in line])
+        self.assertEquals([], javac_lines(result))
+        self.assertEquals(contents, open(rfile).read())
+        self.assertEquals(1000000000, os.stat(rfile).st_mtime)
+
+    def testToolServer(self):
+        """
+        Test that Java tools run in the tool server, which turns away
+        requests without its token
+        """
+        create_android_project(self)
+        sdk, setup = create_fake_tools(self)
+        log = os.path.join(self.basedir, 'server.log')
+        self.write_file('main.scons', _TOOL_SETUP + setup + '''
+import android
+import socket
+os.environ['FAKE_TOOL_SERVER_LOG'] = %r
+env['ANDROID_TOOL_SERVER'] = True
+env.AndroidApp('Test')
+server = android.get_tool_server(env)
+sock = socket.create_connection(('127.0.0.1', server.port))
+sock.sendall('not the token\\n')
+print 'reply %%r' %% sock.recv(100)
+''' % log)
+        result = self.run_scons(['ANDROID_SDK=' + sdk])
+        self.assertEquals(0, result.return_code)
+        self.assertTrue("reply ''\n" in result.out, result.out)
+        self.assertTrue(self.exists('Test-debug.apk'))
+        served = open(log).read().splitlines()
+        self.assertEquals(1, served.count('started'))
+        self.assertTrue('rejected' in served)
+        self.assertTrue('ran com.android.dx.command.Main' in served)
+        self.assertTrue('ran android.sdklib.ApkBuilderMain' in served)
+
+    def testToolServerFallback(self):
+        """
+        Test that the tool command lines run when the server cannot start
+        """
+        create_android_project(self)
+        sdk, setup = create_fake_tools(self)
+        log = os.path.join(self.basedir, 'server.log')
+        self.write_file('main.scons', _TOOL_SETUP + setup + '''
+os.environ['FAKE_TOOL_SERVER_LOG'] = %r
+env['ANDROID_TOOL_SERVER'] = True
+env['ANDROID_TOOL_SERVER_FLAGS'] = '-XX:+NoSuchOption'
+env.AndroidApp('Test')
+''' % log)
+        result = self.run_scons(['ANDROID_SDK=' + sdk])
+        self.assertEquals(0, result.return_code)
+        self.assertTrue(self.exists('Test-debug.apk'))
+        self.assertFalse(os.path.exists(log))
+
+    def testPythonZipAlign(self):
+        """
+        Test that the in-process zipalign aligns stored entries, copies
+        compressed ones as they are and keeps UTF-8 names
+        """
+        create_variant_build(self, 0)
+        source = os.path.join(self.basedir, 'input.zip')
+        zip_file = zipfile.ZipFile(source, 'w')
+        for name in ('a.png', 'res/raw/ab.ogg', 'res/raw/abc.ogg'):
+            zip_file.writestr(zipfile.ZipInfo(name), name * 7)
+        deflated = zipfile.ZipInfo('classes.dex')
+        deflated.compress_type = zipfile.ZIP_DEFLATED
+        zip_file.writestr(deflated, 'dex' * 1000)
+        zip_file.writestr(zipfile.ZipInfo(u'assets/caf\xe9.txt'), 'coffee')
+        zip_file.close()
+        self.write_file('main.scons', _TOOL_SETUP + '''
+import android
+env.Command('aligned.apk', '#input.zip', android.zipalign)
+''')
+        result = self.run_scons(['ANDROID_SDK='+getSDK()])
+        self.assertEquals(0, result.return_code)
+        aligned = os.path.join(self.basedir, 'build', 'aligned.apk')
+        stored = assert_aligned_zip(self, aligned)
+        self.assertEquals(4, len(stored))
+        before = zip_entries(source)
+        after = zip_entries(aligned)
+        self.assertEquals(before['classes.dex'][1], after['classes.dex'][1])
+        self.assertTrue(u'assets/caf\xe9.txt' in after)
+        zip_file = zipfile.ZipFile(aligned)
+        self.assertEquals('coffee', zip_file.read(u'assets/caf\xe9.txt'))
+        zip_file.close()
+
+    def testReleasePythonPackaging(self):
+        """
+        Test that a release APK is assembled, signed and aligned in Python
+        around jarsigner
+        """
+        create_android_project(self)
+        sdk, setup = create_fake_tools(self)
+        self.write_file('main.scons', _TOOL_SETUP + setup + '''
+env['ANDROID_KEY_STORE'] = 'release.keystore'
+env['ANDROID_KEY_NAME'] = 'release'
+env['ANDROID_PYTHON_PACKAGING'] = True
+env.AndroidApp('Test')
+''')
+        result = self.run_scons(['ANDROID_SDK=' + sdk])
+        self.assertEquals(0, result.return_code)
+        self.assertEquals([], [line for line in result.out
+                               if 'ApkBuilderMain' in line or
+                               line.endswith(' -f 4 build/Test-unaligned.apk '
+                                             'build/Test.apk\n')])
+        self.assertTrue([line for line in result.out if 'jarsigner' in line])
+        apk = os.path.join(self.basedir, 'build', 'Test.apk')
+        assert_aligned_zip(self, apk)
+        self.assertTrue(self.apk_contains('Test.apk', 'classes.dex'))
+        # the aapt package entries are copied without recompressing them
+        package = zip_entries(os.path.join(self.basedir, 'build', 'Test.ap_'))
+        entries = zip_entries(apk)
+        for name in package:
+            self.assertEquals(package[name][1], entries[name][1], name)
+
+    def testIncrementalApk(self):
+        """
+        Test that incremental packaging copies unchanged classes.dex and
+        native library entries from the previous APK and only compresses
+        what changed, and that the APK builder is used until the debug key
+        exists
+        """
+        create_android_project(self)
+        sdk, setup = create_fake_tools(self)
+        self.subdir('libs')
+        self.subdir('libs/armeabi')
+        self.write_file('libs/armeabi/liba.so', 'a' * 5000)
+        self.write_file('libs/armeabi/libb.so', 'b' * 5000)
+        keystore = os.path.join(self.basedir, 'debug.keystore')
+        self.write_file('main.scons', _TOOL_SETUP + setup + '''
+import android
+write_file = android.AlignedZipWriter.write_file
+def counting_write_file(self, arcname, fname, compress=True):
+    print 'compressing', arcname
+    return write_file(self, arcname, fname, compress)
+android.AlignedZipWriter.write_file = counting_write_file
+env['ANDROID_INCREMENTAL_APK'] = True
+env['ANDROID_DEBUG_KEY_STORE'] = %r
+env.AndroidApp('Test', native_folder='#libs')
+''' % keystore)
+
+        def compressed(result):
+            return [line.split()[1] for line in result.out
+                    if line.startswith('compressing ')]
+
+        result = self.run_scons(['ANDROID_SDK=' + sdk])
+        self.assertEquals(0, result.return_code)
+        self.assertTrue([line for line in result.out
+                         if 'ApkBuilderMain' in line])
+        self.assertEquals([], compressed(result))
+
+        self.write_file('debug.keystore', 'key')
+        result = self.run_scons(['ANDROID_SDK=' + sdk])
+        self.assertEquals(0, result.return_code)
+        self.assertEquals(['classes.dex', 'lib/armeabi/liba.so',
+                           'lib/armeabi/libb.so'], compressed(result))
+        self.assertTrue([line for line in result.out
+                         if 'jarsigner' in line and keystore in line])
+
+        self.write_file('libs/armeabi/liba.so', 'c' * 5000)
+        result = self.run_scons(['ANDROID_SDK=' + sdk])
+        self.assertEquals(0, result.return_code)
+        self.assertEquals(['lib/armeabi/liba.so'], compressed(result))
+        apk = os.path.join(self.basedir, 'build', 'Test-debug.apk')
+        assert_aligned_zip(self, apk)
+        contents = zipfile.ZipFile(apk)
+        self.assertEquals('c' * 5000, contents.read('lib/armeabi/liba.so'))
+        self.assertEquals('b' * 5000, contents.read('lib/armeabi/libb.so'))
+        contents.close()
+
+    def testJavaParseCache(self):
+        """
+        Test that the classes of each Java source are kept in the metadata
+        cache and found again when the source changes
+        """
+        srcdir = create_android_project(self)
+        self.write_file('main.scons', _TOOL_SETUP + '''
+env['ANDROID_METADATA_CACHE'] = '#metadata.cache'
+env.AndroidApp('Test')
+''')
+        result = self.run_scons(['ANDROID_SDK='+getSDK()])
+        self.assertEquals(0, result.return_code)
+        source = os.path.join(self.basedir, srcdir, 'MyActivity.java')
+        cache_file = os.path.join(self.basedir, 'metadata.cache')
+        cache = cPickle.load(open(cache_file))
+        pkg_dir, classes = cache[('java-1.4', source)][2]
+        self.assertEquals('com/example/android', pkg_dir)
+        self.assertEquals(['MyActivity'], classes)
+
+        self.write_file(srcdir + '/MyActivity.java', '''
+package com.example.android;
+public class MyActivity {
+    static class Inner {}
+}
+''')
+        result = self.run_scons()
+        self.assertEquals(0, result.return_code)
+        self.assertTrue(self.exists(
+                'Test_bin/classes/com/example/android/MyActivity$Inner.class'))
+        cache = cPickle.load(open(cache_file))
+        self.assertEquals(['MyActivity', 'MyActivity$Inner'],
+                          sorted(cache[('java-1.4', source)][2][1]))
+
+    def testMultiDeviceInstall(self):
+        """
+        Test that install and run fan out to every attached device
+        """
+        create_android_project(self)
+        adb = fakeadb.FakeAdb(['emulator-5554', 'emulator-5556'])
+        try:
+            self.write_file('main.scons', _TOOL_SETUP + '''
+env['ANDROID_ADB_PORT'] = %d
+env.AndroidApp('Test')
+''' % adb.port)
+            result = self.run_scons(['-j2', 'ANDROID_SDK='+getSDK(), 'install'])
+            self.assertEquals(0, result.return_code)
+            apk = self.get_file('Test-debug.apk').read()
+            for serial in adb.serials:
+                self.assertTrue(self.exists('Test-installed-' + serial))
+                self.assertEquals(apk, adb.installed[serial])
+
+            # only the chosen device is started
+            result = self.run_scons(['run-emulator-5556'])
+            self.assertEquals(0, result.return_code)
+            self.assertEquals(['am', 'start'],
+                              adb.commands['emulator-5556'][-1].split()[:2])
+            self.assertFalse([c for c in adb.commands['emulator-5554']
+                              if c.startswith('am start')])
+        finally:
+            adb.stop()
+
+    def testInstallSkipsIdenticalApk(self):
+        """
+        Test that an APK the device already has is not pushed again, even
+        without the local installation marker, but that one replaced on the
+        device is
+        """
+        create_android_project(self)
+        adb = fakeadb.FakeAdb(['emulator-5554'])
+        try:
+            self.write_file('main.scons', _TOOL_SETUP + '''
+env['ANDROID_ADB_PORT'] = %d
+env.AndroidApp('Test')
+''' % adb.port)
+            result = self.run_scons(['ANDROID_SDK='+getSDK(), 'install'])
+            self.assertEquals(0, result.return_code)
+            pushed = adb.bytes_received['emulator-5554']
+            self.assertTrue(pushed > 0)
+
+            # as if installing from another checkout of the same code
+            os.remove(os.path.join(self.basedir, 'build',
+                                   'Test-installed-emulator-5554'))
+            result = self.run_scons(['install'])
+            self.assertEquals(0, result.return_code)
+            self.assertTrue(self.exists('Test-installed-emulator-5554'))
+            self.assertEquals(pushed, adb.bytes_received['emulator-5554'])
+
+            # another APK installed without updating the hash on the device
+            adb.installed['emulator-5554'] = 'another apk'
+            os.remove(os.path.join(self.basedir, 'build',
+                                   'Test-installed-emulator-5554'))
+            result = self.run_scons(['install'])
+            self.assertEquals(0, result.return_code)
+            self.assertEquals(2 * pushed, adb.bytes_received['emulator-5554'])
+            apk = open(os.path.join(self.basedir, 'build', 'Test-debug.apk'),
+                       'rb').read()
+            self.assertEquals(apk, adb.installed['emulator-5554'])
+        finally:
+            adb.stop()
+
+    def testDeltaInstall(self):
+        """
+        Test that a reinstall only sends the parts of the APK that changed
+        """
+        create_android_project(self)
+        # stored uncompressed, so most of the APK stays the same
+        blob = ''.join('%08x' % random.getrandbits(32) for i in range(8192))
+        self.subdir('res/raw')
+        self.write_file('res/raw/blob.ogg', blob)
+        adb = fakeadb.FakeAdb(['emulator-5554'])
+        try:
+            self.write_file('main.scons', _TOOL_SETUP + '''
+env['ANDROID_ADB_PORT'] = %d
+env['ANDROID_DELTA_INSTALL'] = True
+env.AndroidApp('Test')
+''' % adb.port)
+            result = self.run_scons(['ANDROID_SDK='+getSDK(), 'install'])
+            self.assertEquals(0, result.return_code)
+            pushed = adb.bytes_received['emulator-5554']
+
+            self.write_file('src/com/example/android/MyActivity.java',
+                              '''
+                              package com.example.android;
+                              public class MyActivity { int x; }
+                              ''')
+            result = self.run_scons(['install'])
+            self.assertEquals(0, result.return_code)
+            apk = open(os.path.join(self.basedir, 'build', 'Test-debug.apk'),
+                       'rb').read()
+            self.assertEquals(apk, adb.installed['emulator-5554'])
+            delta = adb.bytes_received['emulator-5554'] - pushed
+            self.assertTrue(delta < len(apk) / 2)
+        finally:
+            adb.stop()
+
     def testAnnotations(self):
         create_android_project(self)
 
@@ -695,4 +1857,4 @@ env.AndroidApp('Test')
         self.assertTrue(self.exists('Test_bin/classes/com/example/android/MyActivity.class'))
 
 if __name__ == '__main__':
-    sconstester.unittest.main()
+    sconstester.main()